@@ -10,7 +10,9 @@ commands on a terminal, then you can use 月詠.
 月詠 is the god of the moon in Shinto mythology.
 
 This script adds empty pairs of matching square brackets to 漢字 characters
-read from standard input and outputs the result to standard output.
+read from standard input and outputs the result to standard output.  If a
+reading dictionary is given, then words found in the dictionary get their
+readings between the brackets instead.
 
 Homepage and documentation: https://github.com/joodan-van-github/tsukuyomi
 
@@ -21,10 +23,9 @@ __author__ = "Joodan Van <joodan.van.github@gmail.com>"
 __version__ = "0.1"
 __license__ = "Public Domain"
 
-if __name__ != "__main__":
-  sys.stderr.write("This script is meant to be executed, not imported.\n")
-  sys.exit(1)
-
+import argparse
+import collections
+import concurrent.futures
 import os.path
 import sys
 
@@ -32,9 +33,65 @@ sys.path = [os.path.realpath(os.path.dirname(__file__))] + sys.path
 
 from tsukuyomi import *
 
-for line in sys.stdin:
-  for c in line:
-    sys.stdout.write(c)
-    if ord(c) in KANJI_RANGE:
-      sys.stdout.write("[]")
+# The script's body lives in main() because ProcessPoolExecutor's workers
+# import this file as __mp_main__ when processes are spawned rather than
+# forked; they must not run it again.
+def main():
+  parser = argparse.ArgumentParser(description="Copy standard input to standard output, adding empty 振り仮名 delimiters ('[]') after each 漢字.")
+  parser.add_argument(
+    "--block-size",
+    type=int,
+    dest="block_size",
+    default=1 << 20,
+    help="the number of bytes to read from standard input at a time (default: 1048576)"
+   )
+  parser.add_argument(
+    "--dictionary",
+    dest="dictionary",
+    default=None,
+    help="an EDICT-style dictionary file (or a trie file compiled from one) whose readings fill in the delimiters of the words it contains; the compiled trie is saved next to the dictionary file with a .trie extension"
+   )
+  parser.add_argument(
+    "--jobs",
+    type=int,
+    dest="jobs",
+    default=1,
+    help="the number of processes that add delimiters to blocks of lines in parallel (default: 1)"
+   )
+
+  # Parse and validate the arguments.
+  args = parser.parse_args(sys.argv[1:])
+  if args.block_size <= 0:
+    sys.stderr.write("block_size must be a natural number.\n")
+    sys.exit(1)
+  if args.jobs <= 0:
+    sys.stderr.write("jobs must be a natural number.\n")
+    sys.exit(1)
+
+  if args.dictionary is None:
+    Annotate = Delimit漢字
+  else:
+    try:
+      Annotate = TReadingDictionary.OpenOrCompile(args.dictionary).Annotate
+    except (OSError, ValueError) as e:
+      sys.stderr.write("unable to open the dictionary " + args.dictionary + ": " + str(e) + "\n")
+      sys.exit(2)
+
+  blocks = ReadTextBlocks(sys.stdin.buffer, args.block_size, sys.stdin.encoding, sys.stdin.errors)
+  if args.jobs == 1:
+    for block in blocks:
+      sys.stdout.write(Annotate(block))
+  else:
+    # Keep a bounded number of blocks in flight and write their results in
+    # input order.
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+      pending = collections.deque()
+      for block in blocks:
+        pending.append(executor.submit(Annotate, block))
+        if len(pending) >= 2 * args.jobs:
+          sys.stdout.write(pending.popleft().result())
+      while pending:
+        sys.stdout.write(pending.popleft().result())
 
+if __name__ == "__main__":
+  main()
@@ -29,81 +29,156 @@ import os
 import os.path
 import sys
 
-if __name__ != "__main__":
-  sys.stderr.write("This script is meant to be executed, not imported.\n")
-  sys.exit(1)
-
 sys.path = [os.path.realpath(os.path.dirname(__file__))] + sys.path
 
 from tsukuyomi import *
 
-# Construct the argument parser.
-parser = argparse.ArgumentParser(description="This is the 漢字 stroke order diagram downloader.")
-parser.add_argument(
-  "--max-simultaneous-downloads",
-  type=int,
-  dest="max_simultaneous_downloads",
-  default=multiprocessing.cpu_count(),
-  help="the maximum number of simultaneous downloads permitted (default: " + str(multiprocessing.cpu_count()) + ")"
- )
-parser.add_argument(
-  "設定ファイル",
-  help="path to the file containing the image directory settings"
- )
-
-# Parse the command-line arguments.
-args = parser.parse_args(sys.argv[1:])
-
-# Validate the arguments.
-if args.max_simultaneous_downloads <= 0:
-  sys.stderr.write("max_simultaneous_downloads must be a natural number.\n")
-  sys.exit(1)
-
-# Get image directory settings.
-downloader = TStrokeOrderDiagramFSInfo(args.設定ファイル)
-
-# Scan the files for 漢字 and schedule downloads if necessary.
-漢字のセット = set()
-def ParseTextFile(ファイル):
-  with open(ファイル, "r") as f:
-    for line in f:
-      for c in line:
-        if ord(c) in KANJI_RANGE:
-          漢字のセット.add(c)
-for ファイル in downloader.ファイル:
+def main():
+  # Construct the argument parser.
+  parser = argparse.ArgumentParser(description="This is the 漢字 stroke order diagram downloader.")
+  parser.add_argument(
+    "--max-simultaneous-downloads",
+    type=int,
+    dest="max_simultaneous_downloads",
+    default=multiprocessing.cpu_count(),
+    help="the maximum number of simultaneous downloads permitted (default: " + str(multiprocessing.cpu_count()) + ")"
+   )
+  parser.add_argument(
+    "--max-connections-per-host",
+    type=int,
+    dest="max_connections_per_host",
+    default=4,
+    help="the maximum number of simultaneous connections to each source's server; connections are reused for later downloads (default: 4)"
+   )
+  parser.add_argument(
+    "--retries",
+    type=int,
+    dest="retries",
+    default=DOWNLOAD_RETRIES,
+    help="the maximum number of times that each download is retried after errors that might be temporary (default: " + str(DOWNLOAD_RETRIES) + ")"
+   )
+  parser.add_argument(
+    "--pack",
+    action="store_true",
+    dest="pack",
+    help="don't scan or download anything; move each source's downloaded diagrams into a single pack file"
+   )
+  parser.add_argument(
+    "--resume",
+    action="store_true",
+    dest="resume",
+    help="don't scan any files; only finish the downloads that an earlier run didn't finish"
+   )
+  parser.add_argument(
+    "--scan-jobs",
+    type=int,
+    dest="scan_jobs",
+    default=multiprocessing.cpu_count(),
+    help="the maximum number of processes that scan changed files for 漢字 (default: " + str(multiprocessing.cpu_count()) + ")"
+   )
+  parser.add_argument(
+    "設定ファイル",
+    help="path to the file containing the image directory settings"
+   )
+
+  # Parse the command-line arguments.
+  args = parser.parse_args(sys.argv[1:])
+
+  # Validate the arguments.
+  if args.max_simultaneous_downloads <= 0:
+    sys.stderr.write("max_simultaneous_downloads must be a natural number.\n")
+    sys.exit(1)
+  if args.max_connections_per_host <= 0:
+    sys.stderr.write("max_connections_per_host must be a natural number.\n")
+    sys.exit(1)
+  if args.retries < 0:
+    sys.stderr.write("retries must be a nonnegative integer.\n")
+    sys.exit(1)
+  if args.scan_jobs <= 0:
+    sys.stderr.write("scan_jobs must be a natural number.\n")
+    sys.exit(1)
+
+  # Get image directory settings.
+  downloader = TStrokeOrderDiagramFSInfo(args.設定ファイル)
+
+  # Pack the downloaded diagrams if requested.
+  if args.pack:
+    for source in downloader.GetStrokeOrderDiagramSources():
+      try:
+        count = downloader.PackStrokeOrderDiagrams(source)
+      except (OSError, ValueError) as e:
+        sys.stderr.write("unable to pack the diagrams from " + source + ": " + str(e) + "\n")
+        sys.exit(2)
+      print("Packed " + str(count) + " diagrams from " + source)
+    print("Done")
+    sys.exit(0)
+
+  # Scan the files for 漢字 and schedule downloads if necessary.  Files whose
+  # modification times and sizes match the scan cache aren't read again.  When
+  # resuming, no files are scanned.
+  漢字のセット = set()
+  scan_cache = T漢字ScanCache(downloader.ScanCachePath)
+  scanned_files = []
+  changed_files = {}
+  ファイル = None
   try:
-    if os.path.isdir(ファイル):
-      for dirpath, _, filenames in os.walk(ファイル):
-        for textfile in (os.path.join(dirpath, fp) for fp in filenames):
-          ファイル = textfile
-          ParseTextFile(textfile)
+    for path in (downloader.ファイル if not args.resume else ()):
+      ファイル = path
+      if os.path.isdir(path):
+        paths = (os.path.join(dirpath, fp) for dirpath, _, filenames in os.walk(path) for fp in filenames)
+      else:
+        paths = (path,)
+      for ファイル in paths:
+        stat = os.stat(ファイル)
+        scanned_files.append(ファイル)
+        cached漢字 = scan_cache.Get(ファイル, stat)
+        if cached漢字 is None:
+          changed_files[ファイル] = stat
+        else:
+          漢字のセット.update(cached漢字)
+    if len(changed_files) > 1 and args.scan_jobs > 1:
+      with concurrent.futures.ProcessPoolExecutor(max_workers=min(args.scan_jobs, len(changed_files))) as executor:
+        results = executor.map(Scan漢字File, changed_files, chunksize=16)
+        for ファイル, stat in changed_files.items():
+          漢字 = next(results)
+          scan_cache.Put(ファイル, stat, 漢字)
+          漢字のセット.update(漢字)
     else:
-      ParseTextFile(ファイル)
+      for ファイル, stat in changed_files.items():
+        漢字 = Scan漢字File(ファイル)
+        scan_cache.Put(ファイル, stat, 漢字)
+        漢字のセット.update(漢字)
   except Exception as e:
-    sys.stderr.write("unexpected error while opening or reading the file/directory " + ファイル + ": " + str(e) + "\n")
+    sys.stderr.write("unexpected error while opening or reading the file/directory " + str(ファイル) + ": " + str(e) + "\n")
     sys.exit(2)
-
-# If there are no 漢字 to download, then do nothing.
-if not 漢字のセット:
-  print("漢字がありません。")
-  sys.exit(0)
-
-# Download 漢字 if necessary.
-print("Found " + str(len(漢字のセット)) + " 漢字")
-with concurrent.futures.ThreadPoolExecutor(max_workers=args.max_simultaneous_downloads) as executor:
-  jobs = dict(
-    (executor.submit(downloader.Download, 漢字, source), (漢字, source))
-     for 漢字 in 漢字のセット for source in downloader.EnabledSources
-     if not downloader.Downloaded(漢字, source)
-   )
-  for future in concurrent.futures.as_completed(jobs):
-    漢字, source = jobs[future]
-    if future.exception() is None:
+  if not args.resume:
+    try:
+      scan_cache.Save(scanned_files)
+    except OSError as e:
+      sys.stderr.write("unable to save the scan cache " + scan_cache.Path + ": " + str(e) + "\n")
+
+  # If there are no 漢字 to download, then do nothing.
+  pending_downloads = downloader.CountPendingDownloads()
+  if not 漢字のセット and not pending_downloads:
+    print("漢字がありません。")
+    sys.exit(0)
+
+  # Download 漢字 if necessary.  Downloads that an earlier run didn't finish are
+  # made, too.
+  if not args.resume:
+    print("Found " + str(len(漢字のセット)) + " 漢字")
+  if pending_downloads:
+    print("Resuming " + str(pending_downloads) + " unfinished downloads")
+  def ReportDownload(漢字, source, error):
+    if error is None:
       print("Finished downloading " + 漢字 + " from " + source)
-    elif isinstance(future.exception(), urllib.error.HTTPError):
-      if future.exception().code not in {403, 404}:
-        sys.stderr.write("Unexpected HTTP error while downloading " + 漢字 + " from " + source + ": " + str(future.exception()) + "\n")
+    elif isinstance(error, urllib.error.HTTPError):
+      if error.code not in TStrokeOrderDiagramFSInfo.MISSING_STATUS_CODES:
+        sys.stderr.write("Unexpected HTTP error while downloading " + 漢字 + " from " + source + ": " + str(error) + "\n")
     else:
-      sys.stderr.write("Unexpected error while downloading " + 漢字 + " from " + source + ": " + str(future.exception()) + "\n")
-print("Done")
+      sys.stderr.write("Unexpected error while downloading " + 漢字 + " from " + source + ": " + (str(error) or type(error).__name__) + "\n")
+  downloader.DownloadAll(漢字のセット, ReportDownload, args.max_connections_per_host, args.max_simultaneous_downloads, args.retries)
+  print("Done")
 
+if __name__ == "__main__":
+  main()
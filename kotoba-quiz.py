@@ -21,9 +21,13 @@ __version__ = "0.1"
 __license__ = "Public Domain"
 
 import argparse
+import concurrent.futures
+import io
 import os
 import os.path
 import sys
+import threading
+import time
 import urllib.parse
 
 if __name__ != "__main__":
@@ -37,6 +41,8 @@ from tsukuyomi import *
 
 
 QuizURL = "/"
+AppURL = "/app"
+APIURL = "/api/"
 CurrentDeck = None
 CurrentSession = None
 DeckFactory = None
@@ -50,6 +56,41 @@ ImageSettings = None
 ImageSource = None
 RemainingTimeSecs = 0
 
+# This executor builds decks in the background while the user fills in the
+# setup page, bundles decks' stroke order diagrams, and renders cards before
+# they are drawn.  SpeculativeDeck is None or a tuple containing the session
+# token, deck size, and number of new cards for which a deck is being built
+# and the concurrent.futures.Future that will hold the deck.
+BackgroundExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+SpeculativeDeck = None
+
+# This maps (card, 漢字 source, bundled 漢字) tuples to content that was
+# rendered in the background (see TSourcedフラッシュカード.RenderContent())
+# before the cards were drawn.  The content depends on the source and the
+# diagram bundle, so content rendered for an earlier configuration is never
+# used.
+PrerenderedContent = {}
+
+# These hold the deck for the client-side quiz (see AppURL) and its cards'
+# hashes.  The client fetches the cards ClientBatchSize at a time.
+ClientBatchSize = 20
+ClientCards = []
+ClientCardHashes = frozenset()
+
+# This is the TStaticAsset containing the current deck's stroke order
+# diagrams or None if there is none, and the set of 漢字 whose diagrams it
+# contains.  The bundle is built on BackgroundExecutor after the deck is
+# configured, so the first cards might be rendered without it.
+DiagramBundle = None
+BundledKanji = frozenset()
+
+# This lock guards the globals above, the deck factory, and the stats log.
+# Request handlers must hold it while they touch any of them, but only for
+# as long as it takes to read or change them: Rendering cards and checking
+# submitted records happen outside it, on snapshots, so that concurrent
+# requests from the threaded server don't wait for each other.
+StateLock = threading.RLock()
+
 
 
 def ParseFlashcardSourceFile(flashcard_cb):
@@ -61,38 +102,110 @@ def ParsePerformanceLogFile(log_record_cb):
       for record in ConstructLogParser(fsl):
         log_record_cb(record)
 
+def BuildDeck(size, num_new_cards):
+  with StateLock:
+    return TCardDeck(DeckFactory.ConstructDeck(size, num_new_cards))
+
+def StartSpeculativeDeck():
+  """ Start building a deck with the setup page's default settings in the
+      background.  The configure POST handler will use the deck if the user
+      submits the default settings."""
+  global SpeculativeDeck
+  try:
+    size = int(DefaultMaxDeckSize) if DefaultMaxDeckSize else DeckFactory.NumberOfCards
+    num_new_cards = int(DefaultMaxNewCards) if DefaultMaxNewCards else 0
+  except ValueError:
+    SpeculativeDeck = None
+    return
+  SpeculativeDeck = (CurrentSession, size, num_new_cards, BackgroundExecutor.submit(BuildDeck, size, num_new_cards))
+
+def WaitForSpeculativeDeck():
+  """ Wait until the deck that StartSpeculativeDeck() is building, if any,
+      is finished.  Do not hold StateLock while invoking this function:
+      The deck builder needs it."""
+  speculation = SpeculativeDeck
+  if speculation is not None:
+    concurrent.futures.wait([speculation[3]])
+
+def TakeSpeculativeDeck(session, size, num_new_cards):
+  """ Get the deck that StartSpeculativeDeck() built for the specified
+      session and settings or None if there is no such deck."""
+  global SpeculativeDeck
+  speculation, SpeculativeDeck = SpeculativeDeck, None
+  if speculation is None or speculation[:3] != (session, size, num_new_cards):
+    return None
+  future = speculation[3]
+  if not future.done() or future.exception() is not None:
+    return None
+  return future.result()
+
 @get(QuizURL)
 def Config():
   global CurrentSession
-  CurrentSession = str(random.random())
-  DeckFactory.Refresh()
-  return DeckFactory.RenderConfigPage(DeckName + " -- Setup", CurrentSession, QuizURL,
-   default_time=DefaultTime, default_max_deck_size=DefaultMaxDeckSize,
-   default_max_new_cards=DefaultMaxNewCards, image_settings=ImageSettings)
+  with StateLock:
+    CurrentSession = str(random.random())
+    DeckFactory.Refresh()
+    page = DeckFactory.RenderConfigPage(DeckName + " -- Setup", CurrentSession, QuizURL,
+     default_time=DefaultTime, default_max_deck_size=DefaultMaxDeckSize,
+     default_max_new_cards=DefaultMaxNewCards, image_settings=ImageSettings)
+    StartSpeculativeDeck()
+    return page
+
+def ValidateSession(session):
+  """ Abort the current request unless the specified session token belongs
+      to the current session."""
+  global CurrentSession
+  if not session:
+    abort(400, "no session")
+  if CurrentSession is None:
+    CurrentSession = session
+  elif session != CurrentSession:
+    abort(400, "session is no longer valid")
+
+def ParseTimeLimit():
+  """ Get the quiz's time limit in seconds from the submitted setup form."""
+  secs = 60 * 60 * StrToInt(request.forms.hours, "hours")
+  secs += 60 * StrToInt(request.forms.minutes, "minutes")
+  secs += StrToInt(request.forms.seconds, "seconds")
+  return secs
+
+def ParseDeckSize():
+  """ Get the deck size and the number of new cards from the submitted setup form."""
+  size = (
+    StrToInt(request.forms.size, "size")
+     if request.forms.size
+     else DeckFactory.NumberOfCards
+   )
+  num_new_cards = (
+    StrToInt(request.forms.num_new_cards, "num_new_cards")
+     if request.forms.num_new_cards
+     else 0
+   )
+  return (size, num_new_cards)
 
 @post(QuizURL)
 def HandlePost():
+  if request.forms.method == "configure":
+    WaitForSpeculativeDeck()
+  with StateLock:
+    return HandleLockedPost()
+
+def HandleLockedPost():
   global CurrentDeck
-  global CurrentSession
   global ImageSource
   global RemainingTimeSecs
+  global DiagramBundle
+  global BundledKanji
 
   session = request.forms.session_token
-  if not session:
-    abort(400, "no session")
-  if CurrentSession is None:
-    CurrentSession = session
-  elif session != CurrentSession:
-    abort(400, "session is no longer valid")
+  ValidateSession(session)
 
   method = request.forms.method
   if method == "configure":
     # TODO Detect when another session is running and confirm overwriting it.
 
     # Parse the quiz's configuration and create a deck.
-    RemainingTimeSecs = 60 * 60 * StrToInt(request.forms.hours, "hours")
-    RemainingTimeSecs += 60 * StrToInt(request.forms.minutes, "minutes")
-    RemainingTimeSecs += StrToInt(request.forms.seconds, "seconds")
+    RemainingTimeSecs = ParseTimeLimit()
 
     # Get the 漢字 stroke order diagram source.
     if not request.forms.漢字source:
@@ -101,20 +214,28 @@ def HandlePost():
       abort(400, "漢字source is not a valid remote stroke order diagram source.")
     ImageSource = request.forms.漢字source
 
-    # Parse the flashcards file and create a deck from some of the cards.
-    DeckFactory.Refresh()
-    CurrentDeck = TCardDeck(
-      DeckFactory.ConstructDeck(
-        StrToInt(request.forms.size, "size")
-         if request.forms.size
-         else DeckFactory.NumberOfCards,
-        StrToInt(request.forms.num_new_cards, "num_new_cards")
-         if request.forms.num_new_cards
-         else 0
+    # Create a deck from some of the cards.  Use the deck that was built in
+    # the background if the user kept the default settings; otherwise, parse
+    # the flashcards file again and build a new deck.
+    size, num_new_cards = ParseDeckSize()
+    PrerenderedContent.clear()
+    CurrentDeck = TakeSpeculativeDeck(session, size, num_new_cards)
+    if CurrentDeck is None:
+      DeckFactory.Refresh()
+      CurrentDeck = BuildDeck(
+        size if request.forms.size else DeckFactory.NumberOfCards,
+        num_new_cards
        )
-     )
 
-    # Finally, render the first card.
+    # Finally, start bundling the deck's stroke order diagrams and render
+    # the first card without waiting for the bundle.
+    DiagramBundle = None
+    BundledKanji = frozenset()
+    if ImageSettings is not None and ImageSource in ImageSettings.EnabledSources:
+      漢字 = KANJI_RANGE.Extract("".join(
+        card.前 + card.後ろ + card.Source for card in CurrentDeck.Cards
+       ))
+      BackgroundExecutor.submit(BuildDiagramBundle, CurrentDeck, 漢字, ImageSource)
     return RenderCard()
 
   assert CurrentDeck
@@ -143,29 +264,187 @@ def HandlePost():
   else:
     abort(400, "bad method choice")
 
+def BuildDiagramBundle(deck, 漢字, image_source):
+  """ Bundle the specified 漢字's locally-stored stroke order diagrams from
+      the specified source for the specified deck.  The bundle is dropped if
+      it is empty or if the user configured another quiz meanwhile."""
+  global DiagramBundle
+  global BundledKanji
+  bundle, bundled_kanji = ImageSettings.BuildDiagramBundle(漢字, image_source)
+  with StateLock:
+    if bundled_kanji and CurrentDeck is deck and ImageSource == image_source:
+      DiagramBundle = bundle
+      BundledKanji = bundled_kanji
+
+def PrerenderCard(card, image_source, bundled_kanji):
+  content = card.RenderContent(image_settings=ImageSettings,
+   image_source=image_source, bundled_kanji=bundled_kanji,
+   compact_ruby=True)
+  with StateLock:
+    PrerenderedContent[(card, image_source, bundled_kanji)] = content
+
 def RenderCard():
   stats = CurrentDeck.Statistics
-  return CurrentDeck.GetCard().Render(
+  card = CurrentDeck.GetCard()
+  next_card = CurrentDeck.PeekCard()
+
+  # Let the browser fetch the diagram bundle and the next card's stroke
+  # order diagrams that aren't in it while the user answers this card.
+  diagram_bundle_url = None
+  prefetch_urls = []
+  if DiagramBundle is not None:
+    diagram_bundle_url = StrokeOrderDiagramURLBase + "bundle.js?v=" + DiagramBundle.Fingerprint
+    prefetch_urls.append(diagram_bundle_url)
+  if next_card is not None:
+    prefetch_urls.extend(
+      url for 字, url in sorted(next_card.GetStrokeOrderDiagramURLs(ImageSettings, ImageSource).items())
+       if 字 not in BundledKanji
+     )
+
+  page = card.Render(
     DeckName + " -- " + str(int((stats.NumCards - stats.NumCardsLeft) / stats.NumCards * 100)) + "% Done",
     QuizURL,
     CurrentSession,
+    timeout_secs=RemainingTimeSecs,
+    deck_stats=stats,
+    content=PrerenderedContent.pop((card, ImageSource, BundledKanji), None),
+    diagram_bundle_url=diagram_bundle_url,
+    prefetch_urls=prefetch_urls,
     image_settings=ImageSettings,
     image_source=ImageSource,
-    timeout_secs=RemainingTimeSecs,
-    deck_stats=stats
+    bundled_kanji=BundledKanji,
+    compact_ruby=True
    )
 
+  # Render the next card's content while the user answers this one.
+  if next_card is not None and (next_card, ImageSource, BundledKanji) not in PrerenderedContent:
+    BackgroundExecutor.submit(PrerenderCard, next_card, ImageSource, BundledKanji)
+  return page
+
 def RenderFinishPage(timed_out):
   assert CurrentDeck is not None
   return "Timed out!" if timed_out else "Done!"
 
+@get(AppURL)
+def ConfigApp():
+  global CurrentSession
+  with StateLock:
+    CurrentSession = str(random.random())
+    DeckFactory.Refresh()
+    return DeckFactory.RenderConfigPage(DeckName + " -- Setup", CurrentSession, APIURL + "deck",
+     default_time=DefaultTime, default_max_deck_size=DefaultMaxDeckSize,
+     default_max_new_cards=DefaultMaxNewCards, image_settings=ImageSettings,
+     template_name='quizapp.html')
+
+def RenderClientCards(cards, image_source):
+  return [card.RenderClientData(image_settings=ImageSettings, image_source=image_source) for card in cards]
+
+@post(APIURL + "deck")
+def HandleClientDeckRequest():
+  global ClientCards
+  global ClientCardHashes
+  global ImageSource
+  with StateLock:
+    ValidateSession(request.forms.session_token)
+    time_limit = ParseTimeLimit()
+    if request.forms.漢字source and request.forms.漢字source not in TStrokeOrderDiagramFSInfo.RemoteSources:
+      abort(400, "漢字source is not a valid remote stroke order diagram source.")
+    ImageSource = request.forms.漢字source or None
+    DeckFactory.Refresh()
+    ClientCards = list(DeckFactory.ConstructDeck(*ParseDeckSize()))
+    ClientCardHashes = frozenset(card.Hash for card in ClientCards)
+    session_token, cards, image_source = CurrentSession, ClientCards, ImageSource
+  return {
+    'session_token': session_token,
+    'time_limit': time_limit,
+    'num_cards': len(cards),
+    'cards': RenderClientCards(cards[:ClientBatchSize], image_source)
+   }
+
+@get(APIURL + "cards")
+def HandleClientCardsRequest():
+  start = StrToInt(request.query.start, "start")
+  with StateLock:
+    ValidateSession(request.query.session_token)
+    cards, image_source = ClientCards[start:start + ClientBatchSize], ImageSource
+  return {'cards': RenderClientCards(cards, image_source)}
+
+@post(APIURL + "answers")
+def HandleClientAnswers():
+  """ Record a batch of answers from the client-side quiz.  The request's
+      body must be a JSON object with two keys: "session_token" and
+      "records", a list of [timestamp, card hash, number of retries]
+      records for cards in the current deck that the user passed.  The
+      records are checked like HandleReviews()'s records, appended to the
+      stats log, and applied to the deck factory."""
+  answers = request.json
+  if not isinstance(answers, dict) or not isinstance(answers.get('records'), list):
+    abort(400, "expected a JSON object with a list of records")
+  with StateLock:
+    ValidateSession(answers.get('session_token'))
+    card_hashes = ClientCardHashes
+  try:
+    records = DeckFactory.ValidateStatsRecords(
+      record if isinstance(record, list) else () for record in answers['records']
+     )
+  except TInvalidFlashcardStatsRecord as e:
+    abort(400, "invalid record " + str(e))
+  for _, card_hash, _ in records:
+    if card_hash not in card_hashes:
+      abort(400, "card is not in the current deck: " + card_hash)
+  with StateLock:
+    AppendToStatsLog(records)
+    DeckFactory.ApplyStatsRecords(records)
+  return {'accepted': len(records)}
+
+@post(APIURL + "reviews")
+def HandleReviews():
+  """ Record a batch of reviews that were collected elsewhere, such as by
+      offline clients.  The request's body must be a JSON object whose
+      "records" key maps to a list of [timestamp, card hash, number of
+      retries] records.  The records are checked against the flashcards,
+      appended to the stats log, and applied to the deck factory; either
+      all of them are accepted or none are."""
+  reviews = request.json
+  if not isinstance(reviews, dict) or not isinstance(reviews.get('records'), list):
+    abort(400, "expected a JSON object with a list of records")
+  try:
+    records = DeckFactory.ValidateStatsRecords(
+      record if isinstance(record, list) else () for record in reviews['records']
+     )
+  except TInvalidFlashcardStatsRecord as e:
+    abort(400, "invalid record " + str(e))
+  with StateLock:
+    AppendToStatsLog(records)
+    DeckFactory.ApplyStatsRecords(records)
+  return {'accepted': len(records)}
+
+def AppendToStatsLog(records):
+  """ Append the specified performance records to the stats log, if there
+      is one, with a single write."""
+  if FlashcardsStatsLog is not None and records:
+    buf = io.StringIO()
+    ConstructLogWriter(buf).writerows(records)
+    try:
+      with open(FlashcardsStatsLog, "a") as logf:
+        logf.write(buf.getvalue())
+    except IOError as e:
+      abort(500, "WARNING: Failed to open or write to the stats log: " + str(e) + "\n")
+
+@get(StrokeOrderDiagramURLBase + "bundle.js")
+def ServeDiagramBundle():
+  bundle = DiagramBundle
+  if bundle is None:
+    abort(404, "There is no stroke order diagram bundle.")
+  return bundle.Serve(request.query.v == bundle.Fingerprint)
+
 @get(StrokeOrderDiagramURLBase + "<source>/<kanji>")
 def ServeImage(source, kanji):
   if ImageSettings is None:
     abort(404, "File not found, fool.")
   if urllib.parse.unquote(source) != ImageSource:
     abort(403, "unexpected source")
-  return ImageSettings.ServeStrokeOrderDiagram(kanji, source)
+  return ImageSettings.ServeStrokeOrderDiagram(kanji, source, wait=args.production)
 
 
 
@@ -182,6 +461,14 @@ parser.add_argument(
   dest="ポート番号",
   help="サーバのポート番号です。"
  )
+parser.add_argument(
+  "--production",
+  dest="production",
+  action="store_const",
+  const=True,
+  default=False,
+  help="Serve requests concurrently with a threaded server, compile the HTML templates once at startup, and disable Bottle's debug mode."
+ )
 parser.add_argument(
   "設定ファイル",
   help="path to the file containing the server's settings"
@@ -218,6 +505,11 @@ def ハンドラ(config, パス名, PrintErrorAndExit):
         FlashcardsStatsLog = EnsureAccessibleAbsoluteFilePath(stats_log, 設定ファイルのディレクトリ, os.R_OK | os.W_OK, 'stats-log')
     if 'image-settings' in general:
       ImageSettings = TStrokeOrderDiagramFSInfo(general['image-settings'])
+    if 'render-cache-size' in general:
+      try:
+        TSourcedフラッシュカード.ContentCache = TLRUCache(int(general['render-cache-size']))
+      except ValueError:
+        PrintErrorAndExit("'render-cache-size' is not a natural number: " + general['render-cache-size'])
     if 'name' in general:
       DeckName = general['name'].strip()
       if not DeckName:
@@ -273,6 +565,13 @@ DeckFactory = TCardDeckFactory(
   [TLeitnerBucket(delay) for delay in delays]
  )
 
+# Load the static files that the web pages use.
+LoadStaticAssets()
+
 # Start the server.
-run(host="localhost", port=ポート, debug=True)
+if args.production:
+  PrecompileTemplates()
+  run(host="localhost", port=ポート, server=TThreadedWSGIRefServer, debug=False)
+else:
+  run(host="localhost", port=ポート, debug=True)
 
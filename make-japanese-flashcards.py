@@ -26,43 +26,138 @@ __version__ = "0.1"
 __license__ = "Public Domain"
 
 import argparse
+import collections
+import concurrent.futures
+import csv
 import os.path
 import sys
 
-if __name__ != "__main__":
-  sys.stderr.write("This script is meant to be executed, not imported.\n")
-  sys.exit(1)
-
 sys.path = [os.path.realpath(os.path.dirname(__file__))] + sys.path
 
 from tsukuyomi import *
 
-parser = argparse.ArgumentParser(description="Translate Japanese strings into two-sided flashcard entries in CSV format, replacing 漢字 with 振り仮名 wherever there are 振り仮名 annotations.")
-parser.add_argument(
-  "-r",
-  dest="reversed",
-  action="store_const",
-  const=True,
-  default=False,
-  help="Reverse the generated cards: The original Japanese strings become the backs of the generated cards."
- )
-parser.add_argument(
-  "日本語の言葉",
-  nargs="*",
-  help="日本語の言葉です。"
- )
+# Workers that --jobs spawns import this file as __mp_main__, so the script
+# only runs from main().
+def main():
+  parser = argparse.ArgumentParser(description="Translate Japanese strings into two-sided flashcard entries in CSV format, replacing 漢字 with 振り仮名 wherever there are 振り仮名 annotations.")
+  parser.add_argument(
+    "-r",
+    dest="reversed",
+    action="store_const",
+    const=True,
+    default=False,
+    help="Reverse the generated cards: The original Japanese strings become the backs of the generated cards."
+   )
+  parser.add_argument(
+    "--block-size",
+    type=int,
+    dest="block_size",
+    default=1 << 20,
+    help="the number of bytes to read from standard input at a time (default: 1048576)"
+   )
+  parser.add_argument(
+    "--dedupe",
+    dest="dedupe",
+    metavar="FLASHCARD_FILE",
+    default=None,
+    help="a flashcard file (usually the one that the generated cards will be added to); cards that it already contains are not generated again, and neither are duplicates within the input"
+   )
+  parser.add_argument(
+    "--source",
+    dest="source",
+    default=None,
+    help="the name of the --dedupe flashcard file's source in the 言葉 Flashcards sources configuration file (required with --dedupe because cards' hashes include their sources)"
+   )
+  parser.add_argument(
+    "--jobs",
+    type=int,
+    dest="jobs",
+    default=1,
+    help="the number of processes that transform blocks of lines in parallel (default: 1)"
+   )
+  parser.add_argument(
+    "日本語の言葉",
+    nargs="*",
+    help="日本語の言葉です。"
+   )
+
+  # Parse and validate the arguments.
+  args = parser.parse_args(sys.argv[1:])
+  if args.block_size <= 0:
+    sys.stderr.write("block_size must be a natural number.\n")
+    sys.exit(1)
+  if args.jobs <= 0:
+    sys.stderr.write("jobs must be a natural number.\n")
+    sys.exit(1)
+  if args.dedupe is not None and args.source is None:
+    sys.stderr.write("--dedupe requires --source.\n")
+    sys.exit(1)
+
+  if args.reversed:
+    def GenerateCard(言葉, transformed言葉):
+      return (transformed言葉, 言葉)
+  else:
+    def GenerateCard(言葉, transformed言葉):
+      return (言葉, transformed言葉)
+  # Load the hashes of the cards that already exist.
+  existing_hashes = None
+  if args.dedupe is not None:
+    existing_hashes = set()
+    try:
+      with open(args.dedupe, "r") as f:
+        for row in ConstructLogParser(f):
+          if len(row) != 2:
+            raise TSourcedフラッシュカード.TFormatError("illegal number of fields: " + str(len(row)))
+          existing_hashes.add(TSourcedフラッシュカード(row[0], row[1], args.source).Hash)
+    except (OSError, csv.Error, TSourcedフラッシュカード.TFormatError) as e:
+      sys.stderr.write("unable to read the flashcard file " + args.dedupe + ": " + str(e) + "\n")
+      sys.exit(2)
+
+  def ReadLineBatches():
+    """ Yield lists of input strings: the command-line arguments or blocks of
+        lines read from standard input."""
+    if args.日本語の言葉:
+      yield args.日本語の言葉
+      return
+    for block in ReadTextBlocks(sys.stdin.buffer, args.block_size, sys.stdin.encoding, sys.stdin.errors):
+      lines = block.split("\n")
+      if lines[-1] == "":
+        lines.pop()
+      yield lines
 
-# Parse and validate the arguments.
-args = parser.parse_args(sys.argv[1:])
+  writer = ConstructLogWriter(sys.stdout)
+  num_skipped = 0
+  def WriteCards(lines, transformed_lines):
+    nonlocal num_skipped
+    rows = []
+    for 言葉, transformed言葉 in zip(lines, transformed_lines):
+      row = GenerateCard(言葉, transformed言葉)
+      if existing_hashes is not None:
+        card_hash = TSourcedフラッシュカード(row[0], row[1], args.source).Hash
+        if card_hash in existing_hashes:
+          num_skipped += 1
+          continue
+        existing_hashes.add(card_hash)
+      rows.append(row)
+    writer.writerows(rows)
 
-if args.reversed:
-  def GenerateCard(言葉, transformed言葉):
-    return (transformed言葉, 言葉)
-else:
-  def GenerateCard(言葉, transformed言葉):
-    return (言葉, transformed言葉)
-writer = ConstructLogWriter(sys.stdout)
-言葉と振り仮名 = T言葉と振り仮名Producer()
-for 言葉 in (args.日本語の言葉 if args.日本語の言葉 else (line[:-1] for line in sys.stdin)):
-  writer.writerow(GenerateCard(言葉, ''.join((piece.言葉 if not piece.振り仮名 else piece.振り仮名) for piece in 言葉と振り仮名.ProcessAndReset(言葉))))
+  if args.jobs == 1:
+    for lines in ReadLineBatches():
+      WriteCards(lines, map(Replace漢字With振り仮名, lines))
+  else:
+    # Keep a bounded number of batches in flight and write their cards in
+    # input order.
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+      pending = collections.deque()
+      for lines in ReadLineBatches():
+        chunk_size = max(1, len(lines) // (4 * args.jobs))
+        pending.append((lines, executor.map(Replace漢字With振り仮名, lines, chunksize=chunk_size)))
+        if len(pending) >= 2:
+          WriteCards(*pending.popleft())
+      while pending:
+        WriteCards(*pending.popleft())
+  if num_skipped:
+    sys.stderr.write("Skipped " + str(num_skipped) + " cards that already exist.\n")
 
+if __name__ == "__main__":
+  main()
@@ -14,7 +14,12 @@
        Toggle the 振り仮名 display given that the aforementioned rp and rt tags'
        class is the specified string.
 
-   The 振り仮名を見せて button should invoke this function. */
+   The 振り仮名を見せて button should invoke this function.
+
+   Compact ruby markup (see GenerateCompactHTML5Ruby() in tsukuyomi.py) has
+   no classes or styles on its rp and rt tags.  For that markup, this script
+   toggles the "furigana_visible" class on the div whose class is "toplevel",
+   and sourceflashcard.css does the rest. */
 
 var furigana = 'hidden';
 
@@ -36,6 +41,10 @@ function toggle_visibility(furigana_class) {
       span_node.setAttribute('style', 'visibility:' + furigana);
     }
   }
+  var toplevel = document.getElementsByClassName('toplevel')[0];
+  if (toplevel) {
+    toplevel.classList.toggle('furigana_visible', furigana == 'visible');
+  }
   var show_button = document.getElementsByName('振り仮名を見せて')[0];
   if (furigana == 'visible') {
     show_button.setAttribute('value', 'Hide 振り仮名');
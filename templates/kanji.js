@@ -0,0 +1,36 @@
+/* This JS file handles events for 漢字 in compact ruby markup (see
+   GenerateCompactHTML5Ruby() in tsukuyomi.py).  It doesn't have any
+   template parameters.  Compact markup wraps each 漢字 in a span that has a
+   "data-kanji" attribute and no event handlers; this script listens for
+   events on the whole document instead:
+
+     1. Clicking on a 漢字 opens its jisho.org entry in a new window.
+     2. Moving the mouse over or out of a 漢字 invokes showKanjiImage() or
+        hideKanjiImage(), respectively, if kanjisod.js is loaded. */
+
+function kanjiEventTarget(event) {
+  var target = event.target;
+  return (target && target.hasAttribute && target.hasAttribute('data-kanji') ? target.textContent : null);
+}
+
+document.addEventListener('click', function (event) {
+  var kanji = kanjiEventTarget(event);
+  if (kanji) {
+    var quoted = encodeURIComponent(kanji);
+    window.open('http://jisho.org/kanji/details/' + quoted, quoted);
+  }
+});
+
+document.addEventListener('mouseover', function (event) {
+  var kanji = kanjiEventTarget(event);
+  if (kanji && typeof showKanjiImage == 'function') {
+    showKanjiImage(kanji);
+  }
+});
+
+document.addEventListener('mouseout', function (event) {
+  var kanji = kanjiEventTarget(event);
+  if (kanji && typeof hideKanjiImage == 'function') {
+    hideKanjiImage(kanji);
+  }
+});
@@ -21,26 +21,74 @@
        string parameter 字.
 
    It's pointless to invoke showKanjiImage() and hideKanjiImage() before
-   enableKanjiView() is invoked. */
+   enableKanjiView() is invoked.
+
+   The images should not have "src" attributes, so that the browser doesn't
+   download diagrams that the user never looks at.  Instead, each image
+   should have a "data-src" attribute containing the diagram's URL, a
+   "data-kanji" attribute naming a 漢字 in the KanjiDiagrams object, or both.
+   KanjiDiagrams is defined by the deck's stroke order diagram bundle, whose
+   URL is in the global KanjiDiagramBundleURL if the page has a bundle.
+   enableKanjiView() loads the bundle without blocking the page and fills in
+   the images' sources; until the bundle arrives, images that the user
+   shows come from their "data-src" URLs, and if the bundle fails to load,
+   every image does. */
 
 kanji_diagram_enabled = false;
+kanji_diagram_bundle_requested = false;
+
+function setKanjiImageSources(waiting_for_bundle) {
+  var bundle_loaded = typeof KanjiDiagrams != 'undefined';
+  var images = document.getElementsByTagName('img');
+  var i = 0;
+  for (i = 0; i < images.length; i++) {
+    var image = images.item(i);
+    var kanji = image.getAttribute('data-kanji');
+    if (image.getAttribute('src')) {
+      continue;
+    } else if (kanji && bundle_loaded && KanjiDiagrams[kanji]) {
+      image.setAttribute('src', KanjiDiagrams[kanji]);
+    } else if (image.getAttribute('data-src') && !(kanji && waiting_for_bundle)) {
+      image.setAttribute('src', image.getAttribute('data-src'));
+    }
+  }
+}
+
+function loadKanjiDiagramBundle() {
+  if (kanji_diagram_bundle_requested || typeof KanjiDiagrams != 'undefined' ||
+      typeof KanjiDiagramBundleURL == 'undefined' || !KanjiDiagramBundleURL) {
+    return false;
+  }
+  kanji_diagram_bundle_requested = true;
+  var script = document.createElement('script');
+  script.setAttribute('type', 'text/javascript');
+  script.async = true;
+  script.onload = script.onerror = function () { setKanjiImageSources(false); };
+  script.setAttribute('src', KanjiDiagramBundleURL);
+  document.getElementsByTagName('head')[0].appendChild(script);
+  return true;
+}
 
 function enableKanjiView() {
   kanji_diagram_enabled = true;
   enable_kanji_button = document.getElementsByName('show_kanji')[0];
   enable_kanji_button.setAttribute('style', 'display: none;');
+  setKanjiImageSources(loadKanjiDiagramBundle());
 }
 
 function showKanjiImage(kanji) {
   kanji_image = document.getElementsByName('漢字diagram' + kanji)[0];
-  if (kanji_diagram_enabled) {
+  if (kanji_diagram_enabled && kanji_image) {
+    if (!kanji_image.getAttribute('src') && kanji_image.getAttribute('data-src')) {
+      kanji_image.setAttribute('src', kanji_image.getAttribute('data-src'));
+    }
     kanji_image.setAttribute('style', 'display: block; max-width: 100%; margin-left: auto; margin-right: auto');
   }
 }
 
 function hideKanjiImage(kanji) {
   kanji_image = document.getElementsByName('漢字diagram' + kanji)[0];
-  if (kanji_diagram_enabled) {
+  if (kanji_diagram_enabled && kanji_image) {
     kanji_image.setAttribute('style', 'display: none;');
   }
 }
@@ -0,0 +1,289 @@
+/* This JS file runs 言葉 flashcard quizzes in the browser (see quizapp.html).
+   It doesn't have any template parameters.  It expects the elements defined
+   in quizapp.html and talks to the server through these JSON API calls:
+
+     POST <form action>
+       Create a deck from the setup form's fields.  The response contains
+       the session token, the time limit in seconds, the number of cards in
+       the deck, and the first batch of cards.
+     GET /api/cards?session_token=<token>&start=<n>
+       Get the batch of cards that starts with the deck's nth card.
+     POST /api/answers
+       Record a batch of passed cards.  The body is a JSON object containing
+       the session token and a list of [timestamp, card hash, number of
+       retries] records; timestamps are in seconds since the epoch.
+
+   Each card is an object with the keys "hash", "front", "back", "source",
+   and "diagrams"; see TSourcedフラッシュカード.RenderClientData().  Failed
+   cards are shuffled back into the deck after all other cards are drawn,
+   just like TCardDeck does on the server. */
+
+var ANSWER_BATCH_SIZE = 10;
+var KANJI_PATTERN = /[㐀-䶿一-鿏豈-﫿]/;
+
+var session_token = null;
+var num_cards = 0;       // the number of cards in the deck
+var num_fetched = 0;     // the number of cards fetched from the server
+var fetching = false;
+var cards = [];          // fetched cards that haven't been drawn
+var failed_cards = [];
+var retries = {};        // maps card hashes to retry counts
+var answers = [];        // passed cards that haven't been sent to the server
+var current_card = null;
+var kanji_diagrams_enabled = false;
+var secs_left = 0;
+var timer = null;
+var stats = {passed: 0, failed: 0, seen: 0, left: 0};
+
+function request(method, url, body, content_type, callback) {
+  var xhr = new XMLHttpRequest();
+  xhr.open(method, url, true);
+  if (content_type) {
+    xhr.setRequestHeader('Content-Type', content_type);
+  }
+  xhr.onreadystatechange = function () {
+    if (xhr.readyState == 4) {
+      if (xhr.status == 200) {
+        if (callback) {
+          callback(JSON.parse(xhr.responseText));
+        }
+      } else {
+        finish('The server rejected a request: ' + xhr.status);
+      }
+    }
+  };
+  xhr.send(body);
+}
+
+function escapeHTML(text) {
+  return text.replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;').replace(/"/g, '&quot;');
+}
+
+function renderKanji(text) {
+  var html = '';
+  for (var i = 0; i < text.length; i++) {
+    var c = text.charAt(i);
+    html += (KANJI_PATTERN.test(c) ? '<span class="kanji" data-kanji="' + c + '">' + c + '</span>' : escapeHTML(c));
+  }
+  return html;
+}
+
+function renderSegments(segments) {
+  var html = '';
+  for (var i = 0; i < segments.length; i++) {
+    if (segments[i][1]) {
+      html += '<ruby>' + renderKanji(segments[i][0]) + '<rp> (</rp><rt>' + escapeHTML(segments[i][1]) + '<rp>) </rp></rt></ruby>';
+    } else {
+      html += renderKanji(segments[i][0]);
+    }
+  }
+  return html;
+}
+
+function shuffle(a) {
+  for (var i = a.length - 1; i > 0; i--) {
+    var j = Math.floor(Math.random() * (i + 1));
+    var t = a[i];
+    a[i] = a[j];
+    a[j] = t;
+  }
+}
+
+function fetchCards() {
+  if (fetching || num_fetched >= num_cards) {
+    return;
+  }
+  fetching = true;
+  request('GET', '/api/cards?session_token=' + encodeURIComponent(session_token) + '&start=' + num_fetched, null, null, function (response) {
+    fetching = false;
+    num_fetched += response.cards.length;
+    cards = cards.concat(response.cards);
+    if (current_card == null) {
+      drawCard();
+    }
+  });
+}
+
+function sendAnswers(on_done) {
+  if (!answers.length) {
+    if (on_done) {
+      on_done();
+    }
+    return;
+  }
+  var batch = answers;
+  answers = [];
+  request('POST', '/api/answers', JSON.stringify({session_token: session_token, records: batch}), 'application/json', function () {
+    if (on_done) {
+      on_done();
+    }
+  });
+}
+
+function updateStats() {
+  document.getElementById('num_cards_passed').textContent = stats.passed;
+  document.getElementById('num_cards_failed').textContent = stats.failed;
+  document.getElementById('num_cards_seen').textContent = stats.seen;
+  document.getElementById('num_cards_left').textContent = stats.left;
+  document.getElementById('num_cards_total').textContent = num_cards;
+  document.title = document.title.replace(/ -- .*$/, '') + ' -- ' + Math.floor((num_cards - stats.left) / num_cards * 100) + '% Done';
+}
+
+function updateTimer() {
+  if (secs_left > 0) {
+    document.getElementById('time_left').textContent =
+     Math.floor(secs_left / 3600) + '時' + Math.floor((secs_left % 3600) / 60) + '分' + (secs_left % 60) + '秒';
+  }
+}
+
+function tick() {
+  secs_left -= 1;
+  updateTimer();
+  if (secs_left <= 0) {
+    finish('Timed out!');
+  }
+}
+
+function drawCard() {
+  // Prefetch the next batch before the current one runs out.
+  if (cards.length < 5) {
+    fetchCards();
+  }
+  if (!cards.length) {
+    if (num_fetched < num_cards) {
+      current_card = null;  // fetchCards() will draw a card when it is done.
+      return;
+    }
+    if (!failed_cards.length) {
+      finish('Done!');
+      return;
+    }
+    shuffle(failed_cards);
+    cards = failed_cards;
+    failed_cards = [];
+  }
+  current_card = cards.shift();
+  stats.seen += 1;
+  document.getElementById('front_content').innerHTML = renderSegments(current_card.front);
+  document.getElementById('back_content').innerHTML = renderSegments(current_card.back);
+  document.getElementById('source_content').innerHTML = renderSegments(current_card.source);
+  document.getElementById('diagram').innerHTML = '';
+  document.getElementById('hidden_portion').style.visibility = 'hidden';
+  document.getElementById('show_form').style.visibility = 'visible';
+  document.getElementById('show_kanji').style.display =
+   (kanji_diagrams_enabled || !Object.keys(current_card.diagrams).length ? 'none' : 'inline');
+  updateStats();
+}
+
+function answer(passed) {
+  var hash = current_card.hash;
+  if (passed) {
+    if (!(hash in retries)) {
+      stats.passed += 1;
+    }
+    stats.left -= 1;
+    answers.push([Date.now() / 1000, hash, retries[hash] || 0]);
+    if (answers.length >= ANSWER_BATCH_SIZE) {
+      sendAnswers(null);
+    }
+  } else {
+    if (!(hash in retries)) {
+      stats.failed += 1;
+    }
+    retries[hash] = (retries[hash] || 0) + 1;
+    failed_cards.push(current_card);
+  }
+  drawCard();
+}
+
+function finish(message) {
+  if (timer != null) {
+    clearInterval(timer);
+    timer = null;
+  }
+  sendAnswers(null);
+  document.getElementById('quiz').style.display = 'none';
+  document.getElementById('finished').textContent = message;
+  document.getElementById('finished').style.display = 'block';
+}
+
+function showDiagram(event) {
+  var kanji = event.target.getAttribute('data-kanji');
+  if (kanji_diagrams_enabled && kanji && current_card.diagrams[kanji]) {
+    document.getElementById('diagram').innerHTML =
+     '<img alt="漢字 Diagram" style="display: block; max-width: 100%; margin-left: auto; margin-right: auto" src="' +
+     escapeHTML(current_card.diagrams[kanji]) + '" />';
+  }
+}
+
+function hideDiagram(event) {
+  if (event.target.getAttribute('data-kanji')) {
+    document.getElementById('diagram').innerHTML = '';
+  }
+}
+
+function openDictionary(event) {
+  var kanji = event.target.getAttribute('data-kanji');
+  if (kanji) {
+    var quoted = encodeURIComponent(kanji);
+    window.open('http://jisho.org/kanji/details/' + quoted, quoted);
+  }
+}
+
+function startQuiz(form) {
+  var fields = [];
+  for (var i = 0; i < form.elements.length; i++) {
+    var field = form.elements[i];
+    if (field.name && (field.type != 'radio' || field.checked)) {
+      fields.push(encodeURIComponent(field.name) + '=' + encodeURIComponent(field.value));
+    }
+  }
+  request('POST', form.getAttribute('action'), fields.join('&'), 'application/x-www-form-urlencoded', function (response) {
+    session_token = response.session_token;
+    num_cards = response.num_cards;
+    num_fetched = response.cards.length;
+    cards = response.cards;
+    stats.left = num_cards;
+    secs_left = response.time_limit;
+    document.getElementById('setup').style.display = 'none';
+    document.getElementById('quiz').style.display = 'block';
+    if (secs_left > 0) {
+      updateTimer();
+      timer = setInterval(tick, 1000);
+    }
+    drawCard();
+  });
+}
+
+window.addEventListener('load', function () {
+  var form = document.getElementById('setup').getElementsByTagName('form')[0];
+  form.addEventListener('submit', function (event) {
+    event.preventDefault();
+    startQuiz(form);
+  });
+  var quiz = document.getElementById('quiz');
+  quiz.addEventListener('mouseover', showDiagram);
+  quiz.addEventListener('mouseout', hideDiagram);
+  quiz.addEventListener('click', openDictionary);
+  document.getElementById('show_answer').addEventListener('click', function () {
+    document.getElementById('show_form').style.visibility = 'hidden';
+    document.getElementById('hidden_portion').style.visibility = 'visible';
+  });
+  document.getElementById('show_kanji').addEventListener('click', function () {
+    kanji_diagrams_enabled = true;
+    document.getElementById('show_kanji').style.display = 'none';
+  });
+  document.getElementById('show_furigana').addEventListener('click', function () {
+    var button = document.getElementById('show_furigana');
+    quiz.classList.toggle('furigana');
+    button.value = (quiz.classList.contains('furigana') ? 'Hide 振り仮名' : '振り仮名を見せて');
+  });
+  document.getElementById('failure').addEventListener('click', function () { answer(false); });
+  document.getElementById('success').addEventListener('click', function () { answer(true); });
+  window.addEventListener('beforeunload', function () {
+    if (answers.length && navigator.sendBeacon) {
+      navigator.sendBeacon('/api/answers', new Blob([JSON.stringify({session_token: session_token, records: answers})], {type: 'application/json'}));
+      answers = [];
+    }
+  });
+});
@@ -11,12 +11,17 @@
      4. a single span or div named "time_left" that contains a string
         displaying the amount of time left.
 
-   This JS will modify most of the aforementioned elements every second. */
+   This JS will modify most of the aforementioned elements every second.
+   It does nothing on pages without a "time_left" element, so pages without
+   time limits can include it (for example, in a bundle). */
 
 var secs_left = 1;
 var t = setTimeout("UpdateSecondsDisplay();", 1000);
 
 function UpdateSecondsDisplay() {
+  if (!document.getElementById("time_left")) {
+    return;
+  }
   rts_elem = document.getElementsByName("rts")[0];
   secs_left = rts_elem.getAttribute("value");
   secs_left = secs_left - 1;
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+月詠 (Tsukuyomi) is a set of Python tools for learning the Japanese language.
+
+This script measures how the throughput of kotoba-quiz.py's dynamic requests
+(the client-side quiz's card batches and answers) scales with the number of
+concurrent clients.  Start kotoba-quiz.py first (with or without
+--production) and pass its URL to this script.  The script starts a
+client-side quiz, which resets the server's current session, and then has
+the clients fetch card batches for a few seconds and submit answers for a
+few seconds.  Submitted answers are appended to the server's stats log, so
+point the server at a throwaway stats log.
+
+Requests to a local server take a fraction of a millisecond to arrive, so
+without --latency the numbers only show how fast one core runs the
+handlers.  Real clients are further away, and --latency makes each client
+wait between connecting and sending its request.  These numbers (requests
+per second, three-second runs, --latency 0.02) were measured on a
+single-core machine that also ran the clients:
+
+  clients   default server       --production
+            cards  answers      cards  answers
+        1      44       44         45       46
+        4     173      175        179      181
+       16     132      146        472      456
+       32      42      159        466      503
+
+The default server handles one connection at a time, so it stops scaling
+once its listen backlog fills (some requests failed at 16 and 32 clients).
+The threaded server keeps scaling until the core is busy: Handlers hold
+StateLock only while they read or change the shared state, so requests
+wait for each other only for those moments.  Without --latency, the
+threaded server handled 650-760 card requests and 730-1016 answer
+requests per second at every number of clients.
+
+This file was released to the public domain in 2012.  See LICENSE for details.
+"""
+
+__author__ = "Joodan Van <joodan.van.github@gmail.com>"
+__version__ = "0.1"
+__license__ = "Public Domain"
+
+import argparse
+import html.parser
+import http.client
+import itertools
+import json
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+class TSessionTokenParser(html.parser.HTMLParser):
+  """ Extract the session token from the client-side quiz's setup page."""
+
+  def __init__(self):
+    super().__init__()
+    self.SessionToken = None
+
+  def handle_starttag(self, tag, attrs):
+    attrs = dict(attrs)
+    if tag == "input" and attrs.get("name") == "session_token":
+      self.SessionToken = attrs.get("value")
+
+def StartQuiz(base_url, deck_size, image_source):
+  """ Start a client-side quiz on the server at the specified URL and return
+      its session token and its cards' hashes."""
+  parser = TSessionTokenParser()
+  with urllib.request.urlopen(base_url + "/app") as response:
+    parser.feed(response.read().decode("UTF-8"))
+  if parser.SessionToken is None:
+    sys.stderr.write("The server's setup page has no session token.\n")
+    sys.exit(1)
+  form = {'session_token': parser.SessionToken, 'size': str(deck_size), 'num_new_cards': str(deck_size), 'minutes': '30'}
+  if image_source:
+    form['漢字source'] = image_source
+  with urllib.request.urlopen(base_url + "/api/deck", urllib.parse.urlencode(form).encode("UTF-8")) as response:
+    deck = json.loads(response.read().decode("UTF-8"))
+  return deck['session_token'], deck['num_cards'], [card['hash'] for card in deck['cards']]
+
+def SendRequest(url, body, latency):
+  """ Send a request for the specified URL (a POST of the specified JSON
+      body unless it is None) and read the response.  The request is sent
+      'latency' seconds after the connection opens, which is how a server
+      sees a client that is that far away: The server's thread for the
+      connection waits for the request meanwhile."""
+  parts = urllib.parse.urlsplit(url)
+  connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=60)
+  try:
+    connection.connect()
+    if latency:
+      time.sleep(latency)
+    path = parts.path + ("?" + parts.query if parts.query else "")
+    if body is None:
+      connection.request("GET", path)
+    else:
+      connection.request("POST", path, body, {'Content-Type': 'application/json'})
+    response = connection.getresponse()
+    response.read()
+    if response.status != 200:
+      raise OSError("HTTP status " + str(response.status))
+  finally:
+    connection.close()
+
+def RunClient(next_request, latency, deadline, counts, index):
+  """ Send the requests that next_request() returns until the deadline
+      passes.  This stores the numbers of completed and failed requests in
+      counts[index]."""
+  num_requests = 0
+  num_errors = 0
+  while time.monotonic() < deadline:
+    try:
+      SendRequest(*next_request(), latency=latency)
+      num_requests += 1
+    except OSError:
+      num_errors += 1
+  counts[index] = (num_requests, num_errors)
+
+def Measure(next_request, num_clients, seconds, latency):
+  """ Return the numbers of requests per second that the specified number
+      of concurrent clients completed and that failed (for example, because
+      the server's connection backlog overflowed)."""
+  counts = [(0, 0)] * num_clients
+  started = time.monotonic()
+  deadline = started + seconds
+  threads = [
+    threading.Thread(target=RunClient, args=(next_request, latency, deadline, counts, index))
+     for index in range(num_clients)
+   ]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.monotonic() - started
+  return sum(c[0] for c in counts) / elapsed, sum(c[1] for c in counts) / elapsed
+
+def main():
+  parser = argparse.ArgumentParser(description="Measure kotoba-quiz.py's dynamic request throughput.")
+  parser.add_argument(
+    "--clients",
+    default="1,2,4,8,16,32",
+    dest="clients",
+    help="comma-separated numbers of concurrent clients to measure (default: 1,2,4,8,16,32)"
+   )
+  parser.add_argument(
+    "--seconds",
+    type=float,
+    default=3.0,
+    dest="seconds",
+    help="how long each measurement lasts (default: 3)"
+   )
+  parser.add_argument(
+    "--latency",
+    type=float,
+    default=0.0,
+    dest="latency",
+    help="how many seconds each client waits between connecting and sending its request, to simulate clients on a network (default: 0)"
+   )
+  parser.add_argument(
+    "--deck-size",
+    type=int,
+    default=200,
+    dest="deck_size",
+    help="the number of cards in the quiz's deck (default: 200)"
+   )
+  parser.add_argument(
+    "--漢字source",
+    default=None,
+    dest="image_source",
+    help="the stroke order diagram source to request (default: none)"
+   )
+  parser.add_argument(
+    "url",
+    help="the URL of a running kotoba-quiz.py server, such as http://localhost:8080"
+   )
+  args = parser.parse_args(sys.argv[1:])
+  try:
+    num_clients = [int(n) for n in args.clients.split(",")]
+  except ValueError:
+    sys.stderr.write("--clients must be a comma-separated list of natural numbers\n")
+    sys.exit(2)
+  if any(n <= 0 for n in num_clients):
+    sys.stderr.write("--clients must be a comma-separated list of natural numbers\n")
+    sys.exit(2)
+
+  base_url = args.url.rstrip("/")
+  session_token, num_cards, hashes = StartQuiz(base_url, args.deck_size, args.image_source)
+  starts = itertools.cycle(range(0, max(num_cards, 1), 20))
+  def NextCardsRequest():
+    return (base_url + "/api/cards?" + urllib.parse.urlencode({'session_token': session_token, 'start': next(starts)}), None)
+  def NextAnswersRequest():
+    now = time.time()
+    return (base_url + "/api/answers", json.dumps({'session_token': session_token, 'records': [[now, card_hash, 0] for card_hash in hashes[:2]]}).encode("UTF-8"))
+  print("clients  cards/s  answers/s  errors/s")
+  for n in num_clients:
+    cards_rate, cards_errors = Measure(NextCardsRequest, n, args.seconds, args.latency)
+    answers_rate, answers_errors = Measure(NextAnswersRequest, n, args.seconds, args.latency)
+    print("%7d  %7.0f  %9.0f  %8.0f" % (n, cards_rate, answers_rate, cards_errors + answers_errors))
+
+if __name__ == "__main__":
+  main()
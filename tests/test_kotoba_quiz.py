@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for kotoba-quiz.py's request handlers.  Each test case starts the
+server in a child process with a throwaway configuration.  Run them from the
+repository's root directory with "python -m unittest discover tests".
+
+This file was released to the public domain in 2012.  See LICENSE for details.
+"""
+
+import html.parser
+import json
+import os
+import os.path
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import urllib.error
+import urllib.parse
+import urllib.request
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+
+class TSessionTokenParser(html.parser.HTMLParser):
+  """ Extract the session token from a setup page."""
+
+  def __init__(self):
+    super().__init__()
+    self.SessionToken = None
+
+  def handle_starttag(self, tag, attrs):
+    attrs = dict(attrs)
+    if tag == "input" and attrs.get("name") == "session_token":
+      self.SessionToken = attrs.get("value")
+
+class TKotobaQuizServerTestCase(unittest.TestCase):
+  """ A test case that runs kotoba-quiz.py on a free port with a small
+      flashcards file and an empty stats log."""
+
+  FLASHCARDS = [
+    ("日[ひ]本[ほん]", "Japan"),
+    ("先[せん]生[せい]", "teacher"),
+    ("学[がく]生[せい]", "student")
+   ]
+
+  @classmethod
+  def setUpClass(cls):
+    cls.directory = tempfile.mkdtemp()
+    with socket.socket() as s:
+      s.bind(("localhost", 0))
+      port = s.getsockname()[1]
+    with open(os.path.join(cls.directory, "cards.txt"), "w", encoding="UTF-8") as f:
+      for 前, 後ろ in cls.FLASHCARDS:
+        f.write('"' + 前 + '","' + 後ろ + '"\n')
+    with open(os.path.join(cls.directory, "sources.cfg"), "w", encoding="UTF-8") as f:
+      f.write("[sources]\nテスト: cards.txt\n")
+    cls.stats_log = os.path.join(cls.directory, "stats.log")
+    open(cls.stats_log, "w").close()
+    with open(os.path.join(cls.directory, "quiz.cfg"), "w", encoding="UTF-8") as f:
+      f.write("[general]\nflashcards-file: sources.cfg\nstats-log: stats.log\nport: " + str(port) + "\n\n[delays]\n1\n")
+    cls.server = subprocess.Popen(
+      [sys.executable, os.path.join(REPOSITORY_DIRECTORY, "kotoba-quiz.py"), os.path.join(cls.directory, "quiz.cfg")],
+      stdout=subprocess.DEVNULL,
+      stderr=subprocess.DEVNULL
+     )
+    cls.base_url = "http://localhost:" + str(port)
+    deadline = time.monotonic() + 10
+    while True:
+      try:
+        with socket.create_connection(("localhost", port), timeout=1):
+          break
+      except OSError:
+        if time.monotonic() > deadline or cls.server.poll() is not None:
+          cls.tearDownClass()
+          raise unittest.SkipTest("kotoba-quiz.py did not start")
+        time.sleep(0.1)
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.server.terminate()
+    cls.server.wait()
+    shutil.rmtree(cls.directory)
+
+  def StartClientQuiz(self):
+    """ Start a client-side quiz containing every card and return its
+        session token and the cards' hashes."""
+    parser = TSessionTokenParser()
+    with urllib.request.urlopen(self.base_url + "/app") as response:
+      parser.feed(response.read().decode("UTF-8"))
+    form = {'session_token': parser.SessionToken, 'size': str(len(self.FLASHCARDS)), 'num_new_cards': str(len(self.FLASHCARDS)), 'minutes': '5'}
+    with urllib.request.urlopen(self.base_url + "/api/deck", urllib.parse.urlencode(form).encode("UTF-8")) as response:
+      deck = json.loads(response.read().decode("UTF-8"))
+    return deck['session_token'], [card['hash'] for card in deck['cards']]
+
+  def PostJSON(self, path, value):
+    """ Post the specified value as JSON and return the response's status
+        code."""
+    request = urllib.request.Request(self.base_url + path, json.dumps(value).encode("UTF-8"), {'Content-Type': 'application/json'})
+    try:
+      with urllib.request.urlopen(request) as response:
+        response.read()
+        return response.status
+    except urllib.error.HTTPError as e:
+      return e.code
+
+  def ReadStatsLog(self):
+    with open(self.stats_log, "r") as f:
+      return f.read()
+
+
+
+class TClientAnswersTest(TKotobaQuizServerTestCase):
+
+  def testAcceptsAnswersWithClientTimestamps(self):
+    session_token, hashes = self.StartClientQuiz()
+    answered = time.time() - 60
+    self.assertEqual(self.PostJSON("/api/answers", {'session_token': session_token, 'records': [[answered, hashes[0], 2], [answered + 1, hashes[1], 0]]}), 200)
+    log = self.ReadStatsLog()
+    self.assertIn('"%r","%s","2"' % (answered, hashes[0]), log)
+    self.assertIn('"%r","%s","0"' % (answered + 1, hashes[1]), log)
+
+  def testRejectsMalformedRecords(self):
+    session_token, hashes = self.StartClientQuiz()
+    log = self.ReadStatsLog()
+    now = time.time()
+    for record in (
+      [hashes[0], 0],
+      [now, [hashes[0]], 0],
+      [now, {hashes[0]: 0}, 0],
+      [now, None, 0],
+      [now, "not a hash", 0],
+      [now, hashes[0], -1],
+      [now, hashes[0], 1.5],
+      [now, hashes[0], True],
+      [float("inf"), hashes[0], 0],
+      [now + 30 * 24 * 60 * 60, hashes[0], 0],
+      [True, hashes[0], 0]
+     ):
+      with self.subTest(record=record):
+        self.assertEqual(self.PostJSON("/api/answers", {'session_token': session_token, 'records': [record]}), 400)
+    self.assertEqual(self.ReadStatsLog(), log)
+
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the command-line scripts.  The scripts run in child processes.
+Their process pools are tested with the "spawn" start method, whose workers
+import the script as __mp_main__ instead of inheriting its state.  Run the
+tests from the repository's root directory with
+"python -m unittest discover tests".
+
+This file was released to the public domain in 2012.  See LICENSE for details.
+"""
+
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+""" This program runs the script named by its first argument as __main__
+    with the remaining arguments after making "spawn" the default start
+    method of the script's process pools."""
+SPAWN_LAUNCHER = """
+import multiprocessing, runpy, sys
+multiprocessing.set_start_method("spawn")
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+
+
+class TScriptTestCase(unittest.TestCase):
+  """ A test case that runs scripts in a fresh temporary directory."""
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.directory)
+
+  def WriteFile(self, name, contents):
+    """ Write the specified string to the specified file in the temporary
+        directory and return the file's path."""
+    パス = os.path.join(self.directory, name)
+    with open(パス, "w", encoding="UTF-8") as f:
+      f.write(contents)
+    return パス
+
+  def RunScript(self, script, arguments, input="", spawn=False):
+    """ Run the specified script with the specified arguments and standard
+        input and return its standard output.  If 'spawn' is True, then the
+        script's process pools spawn their workers.  The test fails if the
+        script fails."""
+    command = [sys.executable]
+    if spawn:
+      command += ["-c", SPAWN_LAUNCHER]
+    command += [os.path.join(REPOSITORY_DIRECTORY, script)] + arguments
+    result = subprocess.run(command, input=input.encode("UTF-8"), stdout=subprocess.PIPE,
+     stderr=subprocess.PIPE, cwd=self.directory, timeout=120, env=dict(os.environ, PYTHONIOENCODING="UTF-8"))
+    self.assertEqual(result.returncode, 0, result.stderr.decode("UTF-8", "replace"))
+    return result.stdout.decode("UTF-8")
+
+
+
+class TAddFuriganaDelimitersTest(TScriptTestCase):
+
+  TEXT = "日本語を勉強します。\n先生は日本人です。\n漢字を書きます。\n" * 20
+
+  def testSpawnedJobsMatchOneJob(self):
+    expected = self.RunScript("add-furigana-delimiters.py", [], self.TEXT)
+    self.assertIn("日[]本[]語[]", expected)
+    self.assertEqual(self.RunScript("add-furigana-delimiters.py", ["--jobs", "2", "--block-size", "64"], self.TEXT, spawn=True), expected)
+
+  def testSpawnedJobsWithDictionaryMatchOneJob(self):
+    dictionary = self.WriteFile("edict", "日本 [にほん] /(n) Japan/\n先生 [せんせい] /(n) teacher/\n")
+    expected = self.RunScript("add-furigana-delimiters.py", ["--dictionary", dictionary], self.TEXT)
+    self.assertIn("日本[にほん]語[]", expected)
+    self.assertEqual(self.RunScript("add-furigana-delimiters.py", ["--dictionary", dictionary, "--jobs", "2", "--block-size", "64"], self.TEXT, spawn=True), expected)
+
+
+
+class TMakeJapaneseFlashcardsTest(TScriptTestCase):
+
+  TEXT = "".join("日[に]本[ほん]語[ご]の文[ぶん]" + str(i) + "です。\n" for i in range(200))
+
+  def testSpawnedJobsMatchOneJob(self):
+    expected = self.RunScript("make-japanese-flashcards.py", [], self.TEXT)
+    self.assertIn("にほんごのぶん0です。", expected)
+    self.assertEqual(self.RunScript("make-japanese-flashcards.py", ["--jobs", "2", "--block-size", "256"], self.TEXT, spawn=True), expected)
+
+  def testSpawnedJobsSkipExistingCards(self):
+    existing = self.WriteFile("cards.csv", self.RunScript("make-japanese-flashcards.py", [], self.TEXT[:self.TEXT.index("\n") + 1]))
+    expected = self.RunScript("make-japanese-flashcards.py", ["--dedupe", existing, "--source", "テスト"], self.TEXT)
+    self.assertNotIn("にほんごのぶん0です。", expected)
+    self.assertIn("にほんごのぶん1です。", expected)
+    self.assertEqual(self.RunScript("make-japanese-flashcards.py", ["--dedupe", existing, "--source", "テスト", "--jobs", "2", "--block-size", "256"], self.TEXT, spawn=True), expected)
+
+
+
+class TDownloadKanjiImagesTest(TScriptTestCase):
+
+  def testSpawnedScanJobs(self):
+    os.mkdir(os.path.join(self.directory, "texts"))
+    texts = ["日本語", "先生", "漢字", "学生"]
+    for i, text in enumerate(texts):
+      self.WriteFile(os.path.join("texts", str(i) + ".txt"), text + "\n")
+    # Every diagram is on disk already, so nothing is downloaded.
+    os.makedirs(os.path.join(self.directory, "img", "jisho.org"))
+    for 字 in "".join(texts):
+      self.WriteFile(os.path.join("img", "jisho.org", 字 + ".jpg"), "diagram")
+    settings = self.WriteFile("img.cfg", "[general]\nimage-directory: img\n\n[enabled-sources]\njisho.org\n\n[files]\ntexts\n")
+    output = self.RunScript("download-kanji-images.py", ["--scan-jobs", "2", settings], spawn=True)
+    self.assertIn("Found " + str(len(set("".join(texts)))) + " 漢字", output)
+
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,634 @@
+# -*- coding: utf-8 -*-
+"""
+Unit tests for tsukuyomi.py.  Run them from the repository's root directory
+with "python -m unittest discover tests".
+
+This file was released to the public domain in 2012.  See LICENSE for details.
+"""
+
+import asyncio
+import http.client
+import http.server
+import json
+import os
+import os.path
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+
+sys.path = [os.path.dirname(os.path.dirname(os.path.realpath(__file__)))] + sys.path
+
+from tsukuyomi import *
+
+
+
+class TTemporaryDirectoryTestCase(unittest.TestCase):
+  """ A test case that gets a fresh temporary directory for every test."""
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.directory)
+
+  def WriteFile(self, name, contents):
+    """ Write the specified string to the specified file in the temporary
+        directory and return the file's path."""
+    パス = os.path.join(self.directory, name)
+    with open(パス, "w", encoding="UTF-8") as f:
+      f.write(contents)
+    return パス
+
+
+
+class TStandInRequestHandler(http.server.BaseHTTPRequestHandler):
+  """ This handler serves the files in its server's Files dictionary, which
+      maps names to bytes, over keep-alive connections.  The first part of
+      each request's path chooses how the file is served:
+
+        /file/<name> -- with a Content-Length
+        /chunked/<name> -- with the chunked transfer coding
+        /slow/<name> -- like /file/, but after server.Delay seconds
+        /truncated/<name> -- like /file/, but responses that aren't ranges
+          end halfway through the file and close the connection
+        /status/<code> -- an empty response with the specified status
+
+      Range requests get 206 responses, and missing files get 404 responses.
+      The server records each request's path and Range header in Requests
+      and counts its connections in NumConnections."""
+
+  protocol_version = "HTTP/1.1"
+
+  def setup(self):
+    super().setup()
+    with self.server.Lock:
+      self.server.NumConnections += 1
+
+  def log_message(self, format, *args):
+    pass
+
+  def do_GET(self):
+    behavior, _, name = self.path[1:].partition("/")
+    range_header = self.headers.get("Range")
+    with self.server.Lock:
+      self.server.Requests.append((self.path, range_header))
+    if behavior == "slow":
+      time.sleep(self.server.Delay)
+    if behavior == "status":
+      self.SendEmptyResponse(int(name))
+      return
+    data = self.server.Files.get(name)
+    if data is None:
+      self.SendEmptyResponse(404)
+      return
+    offset = int(range_header[len("bytes="):].rstrip("-")) if range_header else 0
+    body = data[offset:]
+    self.send_response(206 if offset else 200)
+    if offset:
+      self.send_header("Content-Range", "bytes %d-%d/%d" % (offset, len(data) - 1, len(data)))
+    if behavior == "chunked":
+      self.send_header("Transfer-Encoding", "chunked")
+      self.end_headers()
+      for i in range(0, len(body), 1000):
+        chunk = body[i:i + 1000]
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+      self.wfile.write(b"0\r\n\r\n")
+    else:
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      if behavior == "truncated" and not offset:
+        self.wfile.write(body[:len(body) // 2])
+        self.close_connection = True
+      else:
+        self.wfile.write(body)
+
+  def SendEmptyResponse(self, status):
+    self.send_response(status)
+    self.send_header("Content-Length", "0")
+    if status == 503:
+      self.send_header("Retry-After", "0")
+    self.end_headers()
+
+class TStandInServerTestCase(TTemporaryDirectoryTestCase):
+  """ A test case that runs a local HTTP server (see TStandInRequestHandler)
+      in place of the remote stroke order diagram sources."""
+
+  FILES = {
+    "a": bytes(range(256)) * 400,
+    "b": b"chunked diagram " * 5000,
+    "c": b"slow diagram"
+   }
+
+  def setUp(self):
+    super().setUp()
+    self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), TStandInRequestHandler)
+    self.server.Files = dict(self.FILES)
+    self.server.Delay = 0.2
+    self.server.Lock = threading.Lock()
+    self.server.Requests = []
+    self.server.NumConnections = 0
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.start()
+    self.addCleanup(self.server.server_close)
+    self.addCleanup(thread.join)
+    self.addCleanup(self.server.shutdown)
+
+  def URL(self, path):
+    """ Get the URL of the specified path on the stand-in server."""
+    return "http://127.0.0.1:" + str(self.server.server_address[1]) + path
+
+  def OpenImageSettings(self, config, behavior="file"):
+    """ Construct a TStrokeOrderDiagramFSInfo from the specified
+        configuration file whose jisho.org source is the stand-in server,
+        which serves each 漢字's diagram at /<behavior>/<code point>."""
+    image_settings = TStrokeOrderDiagramFSInfo(config)
+    url = lambda 字: self.URL("/" + behavior + "/" + str(ord(字)))
+    image_settings.RemoteSources = dict(image_settings.RemoteSources)
+    image_settings.RemoteSources["jisho.org"] = (
+      lambda 字, パス, タイムアウト: DownloadDiagramFile(url(字), パス, タイムアウト, retries=0),
+      url,
+      image_settings.RemoteSources["jisho.org"][2]
+     )
+    return image_settings
+
+  def CountRequests(self, path):
+    """ Get the number of requests that the stand-in server received for
+        the specified path."""
+    with self.server.Lock:
+      return sum(1 for request_path, _ in self.server.Requests if request_path == path)
+
+  def ReadFile(self, パス):
+    with open(パス, "rb") as f:
+      return f.read()
+
+
+
+class TCardDeckFactoryValidateStatsRecordsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.cards = [TSourcedフラッシュカード("日", "ひ", "テスト"), TSourcedフラッシュカード("月", "つき", "テスト")]
+    self.factory = TCardDeckFactory(
+      lambda flashcard_cb: [flashcard_cb(card) for card in self.cards],
+      lambda log_record_cb: None,
+      [TLeitnerBucket(0), TLeitnerBucket(86400)]
+     )
+
+  def assertInvalid(self, record):
+    with self.assertRaises(TInvalidFlashcardStatsRecord):
+      self.factory.ValidateStatsRecords([record])
+
+  def testAcceptsValidRecords(self):
+    now = time.time()
+    self.assertEqual(
+      self.factory.ValidateStatsRecords([[now, self.cards[0].Hash, 2], [str(now), self.cards[1].Hash, 0.0]]),
+      [(now, self.cards[0].Hash, 2), (now, self.cards[1].Hash, 0)]
+     )
+
+  def testRejectsHashesThatAreNotStrings(self):
+    now = time.time()
+    self.assertInvalid([now, [self.cards[0].Hash], 0])
+    self.assertInvalid([now, {self.cards[0].Hash: 0}, 0])
+    self.assertInvalid([now, None, 0])
+    self.assertInvalid([now, "unknown", 0])
+
+  def testRejectsNonFiniteAndFutureTimestamps(self):
+    for timestamp in (float("nan"), float("inf"), float("-inf"), "nan", "inf", 1e20, time.time() + 2 * TCardDeckFactory.MAX_CLOCK_SKEW, True):
+      with self.subTest(timestamp=timestamp):
+        self.assertInvalid([timestamp, self.cards[0].Hash, 0])
+
+  def testRejectsNonIntegralRetryCounts(self):
+    for num_retries in (True, False, 1.5, float("nan"), float("inf"), "1.5", None, [1], -1):
+      with self.subTest(num_retries=num_retries):
+        self.assertInvalid([time.time(), self.cards[0].Hash, num_retries])
+
+
+
+class T言葉と振り仮名ProducerTest(unittest.TestCase):
+
+  DELIMITERS = [("[", "]"), ("(", ")"), ("「", "」"), ("{", "}"), ("|", "|")]
+
+  def Parse(self, producer, text):
+    """ Parse the specified text with Process() and Finish(), character
+        by character, and return the results as (言葉, 振り仮名) tuples."""
+    producer.Reset()
+    producer.Process(iter(text))
+    producer.Finish()
+    results = [(r.言葉, r.振り仮名) for r in producer.Results]
+    producer.Reset()
+    return results
+
+  def testTokenizeMatchesProcess(self):
+    generator = random.Random(20120101)
+    for 振り仮名start, 振り仮名end in self.DELIMITERS:
+      producer = T言葉と振り仮名Producer(振り仮名start, 振り仮名end)
+      alphabet = ["日", "本", "語", "学", "に", "ほ", "ん", "ア", "a", " ", "。", 振り仮名start, 振り仮名end]
+      for i in range(2000):
+        text = "".join(generator.choice(alphabet) for j in range(generator.randrange(12)))
+        with self.subTest(delimiters=振り仮名start + 振り仮名end, text=text):
+          expected = self.Parse(producer, text)
+          self.assertEqual([(r.言葉, r.振り仮名) for r in producer.Tokenize(text)], expected)
+          self.assertEqual([(r.言葉, r.振り仮名) for r in producer.ProcessAndReset(text)], expected)
+          self.assertEqual(producer.Replace漢字(text), "".join(振り仮名 or 言葉 for 言葉, 振り仮名 in expected))
+
+
+
+class TReadingDictionaryTest(TTemporaryDirectoryTestCase):
+
+  def Compile(self, dictionary):
+    return TReadingDictionary.OpenOrCompile(self.WriteFile("edict", dictionary))
+
+  def testReadingsWithSeveralTagGroups(self):
+    dictionary = self.Compile(
+      "日本;日本国 [にほん(日本)(P);にっぽんこく(日本国)] /(n) Japan/(P)/\n"
+      "学生 [がくせい(P)] /(n) student/(P)/\n"
+     )
+    self.assertEqual(dictionary.Annotate("日本"), "日本[にほん]")
+    self.assertEqual(dictionary.Annotate("日本国"), "日本国[にっぽんこく]")
+    self.assertEqual(dictionary.Annotate("学生"), "学生[がくせい]")
+
+
+
+class TStaticAssetTest(unittest.TestCase):
+
+  def setUp(self):
+    self.asset = TStaticAsset(b"var x = 1;\n" * 100, "test.js")
+
+  def Serve(self, **headers):
+    """ Serve the asset for a GET request with the specified headers (given
+        as WSGI environment keys without the HTTP_ prefix)."""
+    environ = {'REQUEST_METHOD': "GET"}
+    environ.update(("HTTP_" + key, value) for key, value in headers.items())
+    request.bind(environ)
+    return self.asset.Serve(False)
+
+  def testContentCodingNegotiation(self):
+    for accept_encoding, gzipped in (
+      ("", False),
+      ("gzip", True),
+      ("deflate, gzip;q=0.5", True),
+      ("gzip;q=0", False),
+      ("gzip; q=0.0, identity", False),
+      ("*", True),
+      ("*, gzip;q=0", False),
+      ("identity, *;q=0", False)
+     ):
+      with self.subTest(accept_encoding=accept_encoding):
+        response = self.Serve(ACCEPT_ENCODING=accept_encoding)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers.get('Content-Encoding') == "gzip", gzipped)
+
+  def testEncodingsHaveDistinctEntityTags(self):
+    plain = self.Serve().headers['ETag']
+    gzipped = self.Serve(ACCEPT_ENCODING="gzip").headers['ETag']
+    self.assertNotEqual(plain, gzipped)
+    self.assertEqual(self.Serve(IF_NONE_MATCH=plain).status, 304)
+    self.assertEqual(self.Serve(IF_NONE_MATCH=plain, ACCEPT_ENCODING="gzip").status, 200)
+    self.assertEqual(self.Serve(IF_NONE_MATCH=gzipped, ACCEPT_ENCODING="gzip").status, 304)
+    self.assertEqual(self.Serve(IF_NONE_MATCH=gzipped).status, 200)
+
+  def testIfNoneMatchLists(self):
+    etag = self.Serve().headers['ETag']
+    for if_none_match, status in (
+      ('"other", ' + etag, 304),
+      ('W/' + etag, 304),
+      ('"other",W/' + etag + ' , "more"', 304),
+      ('*', 304),
+      ('"other"', 200),
+      (etag[:-2] + '"', 200),
+      ('"' + etag + '"', 200)
+     ):
+      with self.subTest(if_none_match=if_none_match):
+        self.assertEqual(self.Serve(IF_NONE_MATCH=if_none_match).status, status)
+
+
+
+class TAsyncHTTPDownloaderTest(TStandInServerTestCase):
+
+  def Download(self, jobs, timeout=5, max_connections_per_host=4, retries=0):
+    """ Download the specified (path on the stand-in server, file name)
+        pairs into the temporary directory and return a dictionary mapping
+        the file names to the downloads' exceptions (None if they
+        succeeded)."""
+    results = {}
+    downloader = TAsyncHTTPDownloader(timeout, max_connections_per_host, retries=retries)
+    downloader.DownloadAll(
+      [(self.URL(path), os.path.join(self.directory, name), name) for path, name in jobs],
+      results.__setitem__
+     )
+    return results
+
+  def testReusesConnections(self):
+    jobs = [("/file/a", "a"), ("/chunked/b", "b"), ("/slow/c", "c"), ("/file/a", "a2"), ("/chunked/b", "b2")]
+    self.assertEqual(self.Download(jobs, max_connections_per_host=1), dict((name, None) for _, name in jobs))
+    for path, name in jobs:
+      self.assertEqual(self.ReadFile(os.path.join(self.directory, name)), self.FILES[path[-1]])
+    self.assertEqual(self.server.NumConnections, 1)
+    self.assertFalse([name for name in os.listdir(self.directory) if name.endswith(".part")])
+
+  def testErrorsAreHTTPErrors(self):
+    results = self.Download([("/status/404", "missing"), ("/file/none", "none"), ("/status/503", "unavailable")], retries=1)
+    for name, code in (("missing", 404), ("none", 404), ("unavailable", 503)):
+      with self.subTest(name=name):
+        self.assertIsInstance(results[name], urllib.error.HTTPError)
+        self.assertEqual(results[name].code, code)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, name)))
+    # Only the temporary error is retried.
+    self.assertEqual(self.CountRequests("/status/404"), 1)
+    self.assertEqual(self.CountRequests("/status/503"), 2)
+
+  def testSlowResponsesTimeOut(self):
+    results = self.Download([("/slow/c", "c")], timeout=self.server.Delay / 4)
+    self.assertIsInstance(results["c"], asyncio.TimeoutError)
+    self.assertFalse(os.path.exists(os.path.join(self.directory, "c")))
+
+  def testResumesPartialDownloads(self):
+    for path, name in (("/file/a", "a"), ("/chunked/b", "b")):
+      with open(GetPartialDownloadPath(os.path.join(self.directory, name)), "wb") as f:
+        f.write(self.FILES[name][:1000])
+    self.assertEqual(self.Download([("/file/a", "a"), ("/chunked/b", "b")]), {"a": None, "b": None})
+    for name in ("a", "b"):
+      self.assertEqual(self.ReadFile(os.path.join(self.directory, name)), self.FILES[name])
+    self.assertEqual(sorted(self.server.Requests), [("/chunked/b", "bytes=1000-"), ("/file/a", "bytes=1000-")])
+
+  def testResumesInterruptedDownloads(self):
+    results = self.Download([("/truncated/a", "a")])
+    self.assertTrue(IsTransientDownloadError(results["a"]))
+    part = GetPartialDownloadPath(os.path.join(self.directory, "a"))
+    self.assertEqual(self.ReadFile(part), self.FILES["a"][:len(self.FILES["a"]) // 2])
+    self.assertEqual(self.Download([("/truncated/a", "a")]), {"a": None})
+    self.assertEqual(self.ReadFile(os.path.join(self.directory, "a")), self.FILES["a"])
+    self.assertEqual(self.server.Requests[-1], ("/truncated/a", "bytes=" + str(len(self.FILES["a"]) // 2) + "-"))
+    self.assertFalse(os.path.exists(part))
+
+class TResumableDownloadTest(TStandInServerTestCase):
+
+  def testDownloadDiagramFileResumesInterruptedDownloads(self):
+    パス = os.path.join(self.directory, "a")
+    half = len(self.FILES["a"]) // 2
+    with self.assertRaises(http.client.IncompleteRead):
+      DownloadDiagramFile(self.URL("/truncated/a"), パス, 5, retries=0)
+    self.assertFalse(os.path.exists(パス))
+    self.assertEqual(self.ReadFile(GetPartialDownloadPath(パス)), self.FILES["a"][:half])
+    DownloadDiagramFile(self.URL("/truncated/a"), パス, 5, retries=0)
+    self.assertEqual(self.ReadFile(パス), self.FILES["a"])
+    self.assertEqual(self.server.Requests[-1], ("/truncated/a", "bytes=" + str(half) + "-"))
+    self.assertFalse(os.path.exists(GetPartialDownloadPath(パス)))
+
+  def testDownloadAllFinishesReloadedManifests(self):
+    os.makedirs(os.path.join(self.directory, "img", "jisho.org"))
+    config = self.WriteFile("img.cfg", "[general]\nimage-directory: img\n\n[enabled-sources]\njisho.org\n")
+    for 字 in "日月":
+      self.server.Files[str(ord(字))] = bytes(字, encoding="UTF-8")
+    image_settings = self.OpenImageSettings(config)
+    manifest = TDownloadManifest(image_settings.DownloadManifestPath)
+    manifest.Add("日", "jisho.org")
+    manifest.Add("月", "jisho.org")
+    manifest.Save()
+    self.assertEqual(TDownloadManifest(manifest.Path).GetPending("jisho.org"), set("日月"))
+    self.assertEqual(image_settings.CountPendingDownloads(), 2)
+    results = {}
+    image_settings.DownloadAll("", lambda 字, source, error: results.__setitem__(字, error))
+    self.assertEqual(results, {"日": None, "月": None})
+    for 字 in "日月":
+      self.assertEqual(self.ReadFile(image_settings.ConstructStrokeOrderDiagramPath(字, "jisho.org")), bytes(字, encoding="UTF-8"))
+    self.assertFalse(os.path.exists(manifest.Path))
+    self.assertEqual(image_settings.CountPendingDownloads(), 0)
+
+class TStrokeOrderDiagramPackTest(TTemporaryDirectoryTestCase):
+
+  def setUp(self):
+    super().setUp()
+    os.makedirs(os.path.join(self.directory, "img", "jisho.org"))
+    self.image_settings = TStrokeOrderDiagramFSInfo(self.WriteFile("img.cfg",
+      "[general]\nimage-directory: img\nread-through: no\n\n[enabled-sources]\njisho.org\n"
+     ))
+    self.image_settings.INDEX_REVALIDATION_INTERVAL = 0
+    self.pack_path = os.path.join(self.directory, "img", "jisho.org", TStrokeOrderDiagramFSInfo.PACK_FILE_NAME)
+
+  def WriteDiagram(self, 字):
+    """ Write a diagram for the specified 漢字 to its own file and return
+        the diagram."""
+    diagram = bytes(字, encoding="UTF-8") * (ord(字) % 100 + 1)
+    with open(self.image_settings.ConstructStrokeOrderDiagramPath(字, "jisho.org"), "wb") as f:
+      f.write(diagram)
+    return diagram
+
+  def Serve(self, 字, **headers):
+    """ Serve the specified 漢字's diagram for a GET request with the
+        specified headers (given as WSGI environment keys without the HTTP_
+        prefix)."""
+    environ = {'REQUEST_METHOD': "GET"}
+    environ.update(("HTTP_" + key, value) for key, value in headers.items())
+    request.bind(environ)
+    return self.image_settings.ServeStrokeOrderDiagram(str(ord(字)), "jisho.org")
+
+  def testRoundTrip(self):
+    diagrams = {"日": b"sun", "月": b"", "火": self.WriteFile("fire", "fire diagram")}
+    TStrokeOrderDiagramPack.Write(self.pack_path, diagrams)
+    pack = TStrokeOrderDiagramPack(self.pack_path)
+    self.assertEqual(sorted(pack), sorted(diagrams))
+    self.assertEqual(bytes(pack.Get("日")), b"sun")
+    self.assertEqual(bytes(pack.Get("月")), b"")
+    self.assertEqual(bytes(pack.Get("火")), b"fire diagram")
+    self.assertIsNone(pack.Get("水"))
+    self.assertNotIn("水", pack)
+
+  def testPackedDiagramsAreServed(self):
+    expected = dict((字, self.WriteDiagram(字)) for 字 in "日月")
+    self.assertEqual(self.image_settings.PackStrokeOrderDiagrams("jisho.org"), 2)
+    # Packing again adds the new diagrams to the existing ones.
+    expected["火"] = self.WriteDiagram("火")
+    self.assertEqual(self.image_settings.PackStrokeOrderDiagrams("jisho.org"), 1)
+    self.assertEqual(sorted(os.listdir(os.path.dirname(self.pack_path))), [TStrokeOrderDiagramFSInfo.PACK_FILE_NAME])
+    for 字 in "日月火":
+      with self.subTest(字=字):
+        self.assertTrue(self.image_settings.Downloaded(字, "jisho.org"))
+        self.assertEqual(bytes(self.image_settings.GetStrokeOrderDiagramData(字, "jisho.org")), expected[字])
+        response = self.Serve(字)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.output, expected[字])
+        self.assertEqual(response.headers['Content-Type'], "image/jpeg")
+        self.assertEqual(self.Serve(字, IF_MODIFIED_SINCE=response.headers['Last-Modified']).status, 304)
+
+  def testRejectsEntriesPastTheEnd(self):
+    TStrokeOrderDiagramPack.Write(self.pack_path, {"日": b"sun", "月": b"moon"})
+    with open(self.pack_path, "r+b") as f:
+      f.truncate(os.path.getsize(self.pack_path) - 1)
+    with self.assertRaises(ValueError):
+      TStrokeOrderDiagramPack(self.pack_path)
+
+  def testClosesInvalidPacks(self):
+    if not os.path.exists("/proc/self/maps"):
+      self.skipTest("this platform doesn't list memory mappings in /proc")
+    TStrokeOrderDiagramPack.Write(self.pack_path, {"日": b"sun"})
+    with open(self.pack_path, "r+b") as f:
+      f.truncate((TStrokeOrderDiagramPack.HEADER_WORDS + 1) * 8)
+    try:
+      TStrokeOrderDiagramPack(self.pack_path)
+    except ValueError:
+      # The exception's traceback keeps the rejected pack alive, so its map
+      # is still open here unless the constructor closed it.
+      with open("/proc/self/maps", "r") as f:
+        self.assertNotIn(self.pack_path, f.read())
+    else:
+      self.fail("the truncated pack was accepted")
+
+
+
+class TSourcedFlashcardContentCacheTest(TTemporaryDirectoryTestCase):
+
+  def setUp(self):
+    super().setUp()
+    os.mkdir(os.path.join(self.directory, "img"))
+    os.mkdir(os.path.join(self.directory, "img", "jisho.org"))
+    self.image_settings = TStrokeOrderDiagramFSInfo(self.WriteFile("img.cfg",
+      "[general]\nimage-directory: img\nread-through: no\n\n[enabled-sources]\njisho.org\n"
+     ))
+    self.image_settings.INDEX_REVALIDATION_INTERVAL = 0
+    self.card = TSourcedフラッシュカード("日", "ひ", "テスト")
+
+  def Render(self, bundled_kanji=frozenset()):
+    return self.card.RenderContent(image_settings=self.image_settings,
+     image_source="jisho.org", bundled_kanji=bundled_kanji)['bottom_content']
+
+  def WriteDiagram(self, 字):
+    with open(self.image_settings.ConstructStrokeOrderDiagramPath(字, "jisho.org"), "wb") as f:
+      f.write(b"diagram")
+
+  def testDownloadedDiagramsInvalidateCachedContent(self):
+    remote = self.Render()
+    self.assertIn(GetJishoDotOrgURL("日"), remote)
+    self.WriteDiagram("日")
+    local = self.Render()
+    self.assertNotIn(GetJishoDotOrgURL("日"), local)
+    self.assertIn(StrokeOrderDiagramURLBase + "jisho.org/" + str(ord("日")), local)
+
+  def testOnlyBundledDiagramsComeFromTheBundle(self):
+    self.card = TSourcedフラッシュカード("日月", "ひつき", "テスト")
+    self.WriteDiagram("日")
+    _, bundled_kanji = self.image_settings.BuildDiagramBundle("日月", "jisho.org")
+    self.assertEqual(bundled_kanji, frozenset("日"))
+    # 月's diagram was downloaded after the bundle was built, so the page
+    # must request it on its own.
+    self.WriteDiagram("月")
+    content = self.Render(bundled_kanji)
+    self.assertIn('data-kanji="日"', content)
+    self.assertNotIn('data-kanji="月"', content)
+    self.assertIn(StrokeOrderDiagramURLBase + "jisho.org/" + str(ord("月")), content)
+    # The page uses 日's URL until the bundle arrives.
+    self.assertIn(StrokeOrderDiagramURLBase + "jisho.org/" + str(ord("日")), content)
+
+  def testOtherCardsBundledKanjiDontInvalidateCachedContent(self):
+    self.WriteDiagram("日")
+    content = self.card.RenderContent(image_settings=self.image_settings,
+     image_source="jisho.org", bundled_kanji=frozenset("日"))
+    self.assertIs(self.card.RenderContent(image_settings=self.image_settings,
+     image_source="jisho.org", bundled_kanji=frozenset("日月火")), content)
+    self.assertIsNot(self.card.RenderContent(image_settings=self.image_settings,
+     image_source="jisho.org", bundled_kanji=frozenset("月火")), content)
+
+class TMissingDiagramsTest(TStandInServerTestCase):
+
+  def setUp(self):
+    super().setUp()
+    os.makedirs(os.path.join(self.directory, "img", "jisho.org"))
+    self.config = self.WriteFile("img.cfg",
+      "[general]\nimage-directory: img\nmissing-ttl: 1\n\n[enabled-sources]\njisho.org\n"
+     )
+    self.missing_path = os.path.join(self.directory, "img", "jisho.org", TStrokeOrderDiagramFSInfo.MISSING_FILE_NAME)
+
+  def ReadMissingDiagrams(self):
+    with open(self.missing_path, "r", encoding="UTF-8") as f:
+      return json.load(f)
+
+  def testRecordsExpire(self):
+    now = time.time()
+    with open(self.missing_path, "w", encoding="UTF-8") as f:
+      json.dump({"日": now - 12 * 60 * 60, "月": now - 2 * 24 * 60 * 60}, f)
+    image_settings = self.OpenImageSettings(self.config)
+    self.assertTrue(image_settings.IsKnownMissing("日", "jisho.org"))
+    self.assertIsNone(image_settings.GetStrokeOrderDiagramURL("日", "jisho.org"))
+    self.assertFalse(image_settings.IsKnownMissing("月", "jisho.org"))
+    self.assertIsNotNone(image_settings.GetStrokeOrderDiagramURL("月", "jisho.org"))
+    image_settings.SaveMissingDiagrams()
+    self.assertEqual(list(self.ReadMissingDiagrams()), ["日"])
+
+  def testRecordsSurviveReloading(self):
+    self.server.Files[str(ord("火"))] = b"diagram"
+    results = {}
+    self.OpenImageSettings(self.config).DownloadAll("日火", lambda 字, source, error: results.__setitem__(字, error), retries=0)
+    self.assertEqual(results["日"].code, 404)
+    self.assertIsNone(results["火"])
+    self.assertEqual(list(self.ReadMissingDiagrams()), ["日"])
+    image_settings = self.OpenImageSettings(self.config)
+    self.assertTrue(image_settings.IsKnownMissing("日", "jisho.org"))
+    self.assertTrue(image_settings.Downloaded("火", "jisho.org"))
+    # Neither diagram is requested again.
+    image_settings.DownloadAll("日火", lambda 字, source, error: self.fail(字), retries=0)
+    self.assertEqual(len(self.server.Requests), 2)
+
+class TReadThroughTest(TStandInServerTestCase):
+
+  def setUp(self):
+    super().setUp()
+    os.makedirs(os.path.join(self.directory, "img", "jisho.org"))
+    for 字 in "日火":
+      self.server.Files[str(ord(字))] = bytes(字, encoding="UTF-8")
+    self.image_settings = self.OpenImageSettings(
+      self.WriteFile("img.cfg", "[general]\nimage-directory: img\n\n[enabled-sources]\njisho.org\n"),
+      "slow"
+     )
+
+  def Serve(self, 字, wait):
+    """ Serve the specified 漢字's diagram for a GET request and return the
+        response, including responses that are raised."""
+    request.bind({'REQUEST_METHOD': "GET", 'SERVER_PROTOCOL': "HTTP/1.1"})
+    try:
+      return self.image_settings.ServeStrokeOrderDiagram(str(ord(字)), "jisho.org", wait=wait)
+    except HTTPResponse as e:
+      return e
+
+  def testConcurrentRequestsShareOneDownload(self):
+    statuses = []
+    def Serve():
+      response = self.Serve("日", True)
+      statuses.append(response.status)
+      response.output.close()
+    threads = [threading.Thread(target=Serve) for _ in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(statuses, [200] * len(threads))
+    self.assertEqual(self.CountRequests("/slow/" + str(ord("日"))), 1)
+    self.assertEqual(self.image_settings.GetStrokeOrderDiagramData("日", "jisho.org"), bytes("日", encoding="UTF-8"))
+
+  def testMissingDiagramsAreRecorded(self):
+    self.assertEqual(self.Serve("月", True).status, 404)
+    with open(os.path.join(self.directory, "img", "jisho.org", TStrokeOrderDiagramFSInfo.MISSING_FILE_NAME), "r", encoding="UTF-8") as f:
+      self.assertEqual(list(json.load(f)), ["月"])
+    # The source isn't asked again.
+    self.assertEqual(self.Serve("月", False).status, 404)
+    self.assertEqual(self.CountRequests("/slow/" + str(ord("月"))), 1)
+
+  def testRedirectsWithoutWaitingByDefault(self):
+    started = time.monotonic()
+    response = self.Serve("火", False)
+    self.assertLess(time.monotonic() - started, self.server.Delay)
+    self.assertEqual(response.status, 303)
+    self.assertEqual(response.headers['Location'], self.URL("/slow/" + str(ord("火"))))
+    # The download continues in the background, and later requests are
+    # served from disk.
+    self.image_settings.FetchStrokeOrderDiagram("火", "jisho.org").result()
+    response = self.Serve("火", False)
+    self.assertEqual(response.status, 200)
+    response.output.close()
+    self.assertEqual(self.CountRequests("/slow/" + str(ord("火"))), 1)
+
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -19,20 +19,37 @@ __version__ = "0.1"
 __license__ = "Public Domain"
 
 import argparse
+import array
+import asyncio
+import base64
+import bisect
+import codecs
 import collections
+import concurrent.futures
 import configparser
 import csv
 import errno
+import gzip
 import hashlib
 import heapq
+import http.client
 import io
 import itertools
 import jinja2
+import json
+import math
+import mimetypes
+import mmap
 import os
 import os.path
 import random
+import re
+import socketserver
+import ssl
 import sys
+import threading
 import time
+import urllib.error
 import urllib.parse
 import urllib.request
 
@@ -155,6 +172,48 @@ def EnsureAccessibleAbsoluteFilePath(path, base, perms, path_title=None, error_c
     PrintErrorAndExit(" does not have the expected access permissions.")
   return path
 
+def PrecompileTemplates():
+  """ Compile every HTML template in TemplateDirectory and stop checking the
+      template files for changes.  After this function returns,
+      JinjaEnvironment.get_template() never touches the filesystem for those
+      templates, so edits to them require a restart.  Servers should
+      invoke this once at startup when they run in production mode."""
+  JinjaEnvironment.auto_reload = False
+  for name in JinjaEnvironment.list_templates(extensions=["html"]):
+    JinjaEnvironment.get_template(name)
+
+def ReadTextBlocks(stream, block_size, encoding, errors="strict"):
+  """ Read the specified binary stream in blocks and yield the decoded text.
+      Multibyte characters split across reads are held back until they are
+      complete.  Each yielded string except possibly the last ends with a
+      newline, so blocks are made of whole lines and can be processed
+      independently; a line longer than a block is yielded whole once its
+      end is read.  This function expects the following parameters:
+
+        stream :: binary file-like object
+          The stream to read, such as sys.stdin.buffer.
+        block_size :: int
+          The number of bytes to read at a time.
+        encoding :: str
+          The stream's text encoding.
+        errors :: str
+          The decoder's error handling scheme (see codecs).
+
+    """
+  decoder = codecs.getincrementaldecoder(encoding)(errors)
+  pending = ""
+  while True:
+    data = stream.read(block_size)
+    text = pending + decoder.decode(data, not data)
+    if not data:
+      if text:
+        yield text
+      return
+    end = text.rfind("\n") + 1
+    if end:
+      yield text[:end]
+    pending = text[end:]
+
 def StrToInt(text, name):
   """ Convert a string to an integer.  This is meant to be invoked while
       servicing an HTTP request.  'text' is the string that will be converted.
@@ -269,6 +328,96 @@ class TRandomSelector(object):
     """the sample list's capacity in entries"""
     return self.__capacity
 
+class TLRUCache(object):
+  """Instances of this class are bounded, thread-safe mappings that evict
+  their least recently used entries when they are full.
+
+  The cache counts lookups that find their keys (hits) and lookups that
+  don't (misses) so that clients can tune the cache's capacity.
+
+  """
+  def __init__(self, capacity):
+    """Construct a new, empty cache that holds at most 'capacity' entries.
+
+    Arguments:
+
+      capacity :: int -- the cache's capacity in entries; zero disables
+       the cache
+
+    """
+    if capacity < 0:
+      raise ValueError("capacity must be positive or zero")
+    self.__capacity = int(capacity)
+    self.__entries = collections.OrderedDict()
+    self.__lock = threading.Lock()
+    self.__hits = 0
+    self.__misses = 0
+    super().__init__()
+
+  def __len__(self):
+    """Get the number of cached entries."""
+    return len(self.__entries)
+
+  def Clear(self):
+    """Remove all entries from the cache.  This does not reset the hit and
+    miss counters."""
+    with self.__lock:
+      self.__entries.clear()
+
+  def Get(self, key, default=None):
+    """Get the value associated with the specified key.
+
+    A successful lookup marks the entry as the most recently used one.
+
+    Arguments:
+
+      key -- a hashable object
+      default -- the value to return if the key is not cached
+
+    """
+    with self.__lock:
+      try:
+        value = self.__entries[key]
+      except KeyError:
+        self.__misses += 1
+        return default
+      self.__entries.move_to_end(key)
+      self.__hits += 1
+      return value
+
+  def Put(self, key, value):
+    """Associate the specified value with the specified key, evicting the
+    least recently used entry if the cache is full.
+
+    Arguments:
+
+      key -- a hashable object
+      value -- an object
+
+    """
+    if self.__capacity == 0:
+      return
+    with self.__lock:
+      self.__entries[key] = value
+      self.__entries.move_to_end(key)
+      while len(self.__entries) > self.__capacity:
+        self.__entries.popitem(last=False)
+
+  @property
+  def Capacity(self):
+    """the cache's capacity in entries"""
+    return self.__capacity
+
+  @property
+  def Hits(self):
+    """the number of lookups that found their keys"""
+    return self.__hits
+
+  @property
+  def Misses(self):
+    """the number of lookups that did not find their keys"""
+    return self.__misses
+
 
 
 ################################################################################
@@ -282,7 +431,11 @@ class T言葉と振り仮名(object):
      two advantages:
 
        1. the elements of the pair are named; and
-       2. the pair is immutable."""
+       2. the pair is immutable.
+
+     Pairs are hashable, so they can be set members and dictionary keys."""
+
+  __slots__ = ("__言葉", "__振り仮名")
 
   def __init__(self, 言葉, 振り仮名):
     """Create a 言葉-振り仮名 pair."""
@@ -293,6 +446,12 @@ class T言葉と振り仮名(object):
   def __eq__(self, that):
     return isinstance(that, T言葉と振り仮名) and self.言葉 == that.言葉 and self.振り仮名 == that.振り仮名
 
+  def __hash__(self):
+    return hash((self.__言葉, self.__振り仮名))
+
+  def __repr__(self):
+    return "T言葉と振り仮名(%r, %r)" % (self.__言葉, self.__振り仮名)
+
   def __lt__(self, that):
     return (self.言葉, self.振り仮名) < (that.言葉, that.振り仮名)
 
@@ -306,28 +465,105 @@ class T言葉と振り仮名(object):
     """the reading text (振り仮名) part of the pair"""
     return self.__振り仮名
 
-class TRange(object):
-  """ Instances of this class represent simple numeric ranges of the form
-      [low, high].  This class supports fast membership testing; in other
-      words, for some value 'n', an instance of this class can quickly
-      determine whether it contains 'n'."""
-
-  def __init__(self, low, high):
-    """ Construct a new inclusive range [low, high].  'low' must be
-        less than or equal to 'high'."""
-    assert low <= high
-    self.__low = low
-    self.__high = high
+class TCharacterTranslationTable(dict):
+  """ Instances of this class are str.translate() tables that replace the
+      characters in a TCharacterClass with formatted strings and leave all
+      other characters unchanged.  Entries are computed the first time
+      str.translate() looks up their characters, so translating text
+      whose characters were seen before doesn't invoke any Python code.
+      Get instances from TCharacterClass.GetTranslationTable()."""
+
+  def __init__(self, character_class, format):
+    """ Construct a new translation table.
+
+        Arguments:
+
+          character_class :: TCharacterClass -- the characters to replace
+          format :: str -- a %-style format string with one "%s" field,
+            which is replaced with each character in 'character_class'
+
+        """
+    self.__character_class = character_class
+    self.__format = format
     super().__init__()
 
-  def __contains__(self, val):
-    """ Determine whether the specified value is within this range."""
-    return val >= self.__low and val <= self.__high
+  def __missing__(self, cp):
+    char = chr(cp)
+    value = self.__format % char if cp in self.__character_class else char
+    self[cp] = value
+    return value
+
+class TCharacterClass(frozenset):
+  """ Instances of this class are precomputed sets of Unicode code points
+      built from one or more inclusive ranges.  Membership tests for single
+      code points (e.g., "ord(字) in KANJI_RANGE") are frozenset lookups,
+      so they don't invoke a Python __contains__() method.  Instances
+      also have compiled regular expressions that classify whole strings
+      at once."""
+
+  def __new__(cls, *ranges):
+    """ Construct a new character class from the specified (low, high)
+        pairs of code points.  Each range is inclusive."""
+    for low, high in ranges:
+      assert low <= high
+    self = super().__new__(cls, (cp for low, high in ranges for cp in range(low, high + 1)))
+    self.__ranges = tuple(ranges)
+    self.__regex_class = "[" + "".join(
+      re.escape(chr(low)) + "-" + re.escape(chr(high)) for low, high in ranges
+     ) + "]"
+    self.__pattern = re.compile(self.__regex_class)
+    self.__translation_tables = {}
+    return self
+
+  def Extract(self, text):
+    """ Get the set of the specified string's characters that are in this
+        character class."""
+    return set(self.__pattern.findall(text))
+
+  def GetTranslationTable(self, format):
+    """ Get a TCharacterTranslationTable that replaces each character in
+        this character class with 'format' % character.  Tables are
+        shared, so callers must not modify them.
+
+        Arguments:
+
+          format :: str -- a %-style format string with one "%s" field
+
+        """
+    try:
+      return self.__translation_tables[format]
+    except KeyError:
+      return self.__translation_tables.setdefault(format, TCharacterTranslationTable(self, format))
+
+  def Search(self, text):
+    """ Determine whether the specified string has any characters in this
+        character class."""
+    return self.__pattern.search(text) is not None
 
-# Unicode character ranges of interest.
-KANJI_RANGE = TRange(0x4e00, 0x9fcf)
-KANA_RANGE = TRange(0x3000, 0x30ff)
-FULLWIDTH_RANGE = TRange(0x0ff00, 0x0ffef)
+  @property
+  def Pattern(self):
+    """a compiled regular expression that matches one character in this
+    character class"""
+    return self.__pattern
+
+  @property
+  def Ranges(self):
+    """the tuple of inclusive (low, high) code point ranges that make up
+    this character class"""
+    return self.__ranges
+
+  @property
+  def RegexClass(self):
+    """a regular expression character set ("[...]") that matches one
+    character in this character class"""
+    return self.__regex_class
+
+# Unicode character classes of interest.  漢字 include the CJK Unified
+# Ideographs, CJK Unified Ideographs Extension A, and CJK Compatibility
+# Ideographs blocks.
+KANJI_RANGE = TCharacterClass((0x3400, 0x4dbf), (0x4e00, 0x9fcf), (0xf900, 0xfaff))
+KANA_RANGE = TCharacterClass((0x3000, 0x30ff))
+FULLWIDTH_RANGE = TCharacterClass((0x0ff00, 0x0ffef))
 
 class T言葉と振り仮名Producer(object):
   """ Instances of this class parse strings of Japanese text into lists
@@ -366,6 +602,10 @@ class T言葉と振り仮名Producer(object):
     self.__results = []
     self.__buffer = io.StringIO()
     self.__buffer_start = self.__buffer.tell()
+    self.__pattern = re.compile("(%s+)(?:%s([^%s]*)(?:%s|\\Z))?" % (
+      KANJI_RANGE.RegexClass, re.escape(振り仮名start), re.escape(振り仮名end),
+      re.escape(振り仮名end)
+     ))
     super().__init__()
 
   def __AddResult(self, 言葉, 振り仮名):
@@ -433,7 +673,13 @@ class T言葉と振り仮名Producer(object):
 
   def ProcessAndReset(self, text):
     """ Invoke Process() for the specified iterable of characters, reset the processor, and return the results.
-        This combines Process(), Finish(), and Reset() into one method."""
+        This combines Process(), Finish(), and Reset() into one method.
+
+        If 'text' is a string and the parser has not processed anything
+        since it was last reset, then this uses Tokenize() instead of
+        Process().  Both produce the same results."""
+    if isinstance(text, str) and self.__IsReset:
+      return self.Tokenize(text)
     try:
       self.Process(text)
       self.Finish()
@@ -442,6 +688,55 @@ class T言葉と振り仮名Producer(object):
       self.Reset()
     return results
 
+  def Tokenize(self, text):
+    """ Parse the specified string and return a new list of T言葉と振り仮名.
+
+        This produces the same results as Process() followed by Finish()
+        on a freshly reset parser, but it matches 漢字 and their 振り仮名
+        with a single compiled regular expression instead of examining
+        each character.  It does not use or modify the parser's state.
+
+        Arguments:
+
+          text :: str -- the text to parse
+
+        """
+    results = []
+    plain = []
+    position = 0
+    for match in self.__pattern.finditer(text):
+      plain.append(text[position:match.start()])
+      position = match.end()
+      if match.group(2):
+        if any(plain):
+          results.append(T言葉と振り仮名(''.join(plain), ""))
+        plain = []
+        results.append(T言葉と振り仮名(match.group(1), match.group(2)))
+      else:
+        # Runs of 漢字 with missing or empty 振り仮名 are plain text.
+        # Empty delimiters (e.g., "漢字[]") are dropped, just like Process()
+        # drops them.
+        plain.append(match.group(1))
+    plain.append(text[position:])
+    if any(plain):
+      results.append(T言葉と振り仮名(''.join(plain), ""))
+    return results
+
+  def Replace漢字(self, text):
+    """ Return a copy of the specified string in which each run of 漢字 that
+        has 振り仮名 is replaced by its 振り仮名 and the 振り仮名 delimiters
+        are removed.  The result is the same as joining the 振り仮名 (or,
+        where there is none, the 言葉) of the T言葉と振り仮名 that
+        Tokenize() produces, but no T言葉と振り仮名 are constructed.  This
+        does not use or modify the parser's state.
+
+        Arguments:
+
+          text :: str -- the text to transform
+
+        """
+    return self.__pattern.sub(lambda match: match.group(2) or match.group(1), text)
+
   def Reset(self):
     """Reset the parser and empty the Results list."""
     self.__漢字 = False
@@ -457,12 +752,355 @@ class T言葉と振り仮名Producer(object):
   def __BufferIsEmpty(self):
     return self.__buffer.tell() == self.__buffer_start
 
+  @property
+  def __IsReset(self):
+    return not (self.__漢字 or self.__results) and self.__BufferIsEmpty
+
   @property
   def Results(self):
     """ the list of T言葉と振り仮名 that the parser produced
         (Invoke Finish() first!)"""
     return self.__results
 
+"""This LRU cache maps strings to the tuples of T言葉と振り仮名 that
+Parse言葉と振り仮名() produced for them.  Flashcard sources are shared by
+many cards, so they are parsed repeatedly."""
+SegmentationCache = TLRUCache(4096)
+
+# Tokenize() doesn't use the parser's state, so threads can share this.
+_SegmentationProducer = T言葉と振り仮名Producer()
+
+def Parse言葉と振り仮名(text):
+  """ Parse the specified string into a tuple of T言葉と振り仮名 using
+      T言葉と振り仮名Producer's default 振り仮名 delimiters.  Results are
+      cached in SegmentationCache.
+
+      Arguments:
+
+        text :: str -- the text to parse
+
+      """
+  results = SegmentationCache.Get(text)
+  if results is None:
+    results = tuple(_SegmentationProducer.Tokenize(text))
+    SegmentationCache.Put(text, results)
+  return results
+
+# This matches the empty string after each 漢字.
+_AFTER漢字 = re.compile("(?<=%s)" % KANJI_RANGE.RegexClass)
+
+def Replace漢字With振り仮名(text):
+  """ Return a copy of the specified string in which each 漢字 that has
+      振り仮名 (see Parse言葉と振り仮名()) is replaced by its 振り仮名.
+      make-japanese-flashcards.py uses this to generate the backs of cards,
+      so it must be importable by worker processes."""
+  return _SegmentationProducer.Replace漢字(text)
+
+def Delimit漢字(text, 振り仮名start='[', 振り仮名end=']'):
+  """ Return a copy of the specified string with an empty pair of 振り仮名
+      delimiters after each 漢字.  This splits the text after each 漢字 and
+      joins the pieces with the delimiters, so no Python code runs per
+      character and it is fast enough for whole files.
+
+      Arguments:
+
+        text :: str -- the text to delimit
+        振り仮名start :: str -- the opening 振り仮名 delimiter
+        振り仮名end :: str -- the closing 振り仮名 delimiter
+
+      """
+  return (振り仮名start + 振り仮名end).join(_AFTER漢字.split(text))
+
+class TReadingDictionary(object):
+  """ Instances of this class map Japanese words to their readings so that
+      text can be annotated with 振り仮名 automatically.  Dictionaries are
+      compiled from EDICT-style files (see Compile()) into trie files that
+      are memory-mapped when they are opened, so opening a dictionary
+      doesn't parse anything and processes that open the same dictionary
+      share its pages.
+
+      A compiled trie file is an array of native-endian unsigned 32-bit
+      integers (array typecode 'I') followed by a UTF-8 string table:
+
+        header :: 8 words -- the magic bytes (2 words), an endianness
+          check value, the length of the longest key, the number of
+          nodes, the number of edges, the length of the string table in
+          bytes, and a reserved word
+        nodes :: 4 words per node -- the index of the node's first edge,
+          the number of edges, and the offset and length of the node's
+          value in the string table (the offset is NO_VALUE if the node
+          has no value); node 0 is the root
+        edge characters :: 1 word per edge -- the code point of each
+          edge's character; each node's edges are sorted by code point
+        edge targets :: 1 word per edge -- the index of each edge's node
+
+      A node's value is the annotated text that replaces its key, such as
+      "漢字[かんじ]" for the key "漢字" or "食[た]べる" for "食べる"."""
+
+  MAGIC = b"TKYTRIE\x01"
+  ENDIANNESS_CHECK = 0x01020304
+  NO_VALUE = 0xffffffff
+  HEADER_WORDS = 8
+
+  # These parse EDICT-style lines.  See Compile().
+  __EDICT_LINE = re.compile(r"^(\S+) \[(\S+)\] /(.*)$")
+  __EDICT_READING = re.compile(r"([^;(]+)((?:\([^)]*\))*)")
+  __EDICT_TAGS = re.compile(r"\(([^)]*)\)")
+  __EDICT_PRIORITY = re.compile(r"(^|/)\(P\)/")
+  __漢字THEN仮名 = re.compile("(%s+)(\\w*)$" % KANJI_RANGE.RegexClass)
+
+  """This maps the paths of opened trie files to TReadingDictionary
+  instances.  See Open()."""
+  __opened = {}
+  __opened_lock = threading.Lock()
+
+  def __init__(self, trie_path):
+    """ Memory-map the specified compiled trie file.  Use Open() instead
+        of constructing instances directly so that they are shared.
+
+        Arguments:
+
+          trie_path :: str -- the path to a file written by Compile()
+
+        """
+    self.__path = trie_path
+    with open(trie_path, "rb") as f:
+      self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header_bytes = self.HEADER_WORDS * 4
+    if len(self.__map) < header_bytes or self.__map[:len(self.MAGIC)] != self.MAGIC:
+      raise ValueError(trie_path + " is not a compiled reading dictionary")
+    words = memoryview(self.__map)[:header_bytes].cast("I")
+    if words[2] != self.ENDIANNESS_CHECK:
+      raise ValueError(trie_path + " was compiled on a machine with a different byte order")
+    self.__max_key_length, node_count, edge_count, strings_length = words[3:7]
+    nodes_end = header_bytes + node_count * 16
+    characters_end = nodes_end + edge_count * 4
+    targets_end = characters_end + edge_count * 4
+    self.__nodes = memoryview(self.__map)[header_bytes:nodes_end].cast("I")
+    self.__characters = memoryview(self.__map)[nodes_end:characters_end].cast("I")
+    self.__targets = memoryview(self.__map)[characters_end:targets_end].cast("I")
+    self.__strings = memoryview(self.__map)[targets_end:targets_end + strings_length]
+    super().__init__()
+
+  def __reduce__(self):
+    # Pickle dictionaries by path so that worker processes reopen them.
+    return (TReadingDictionary.Open, (self.__path,))
+
+  @classmethod
+  def Open(cls, trie_path):
+    """ Get the TReadingDictionary for the specified compiled trie file,
+        opening it if it isn't already open in this process."""
+    trie_path = os.path.realpath(trie_path)
+    with cls.__opened_lock:
+      dictionary = cls.__opened.get(trie_path)
+      if dictionary is None:
+        dictionary = cls.__opened[trie_path] = cls(trie_path)
+      return dictionary
+
+  @classmethod
+  def OpenOrCompile(cls, dictionary_path):
+    """ Open the dictionary at the specified path.  If the path refers to
+        an EDICT-style file rather than a compiled trie file, then this
+        opens the compiled file at the same path plus ".trie", compiling
+        it first if it is missing or older than the EDICT-style file."""
+    with open(dictionary_path, "rb") as f:
+      if f.read(len(cls.MAGIC)) == cls.MAGIC:
+        return cls.Open(dictionary_path)
+    trie_path = dictionary_path + os.extsep + "trie"
+    if not os.path.isfile(trie_path) or os.path.getmtime(trie_path) < os.path.getmtime(dictionary_path):
+      cls.Compile(dictionary_path, trie_path)
+    return cls.Open(trie_path)
+
+  @classmethod
+  def Compile(cls, dictionary_path, trie_path):
+    """ Compile an EDICT-style dictionary file into a trie file.
+
+        Each line of the dictionary must look like
+
+          漢字;漢じ [かんじ;かんし] /(n) Chinese characters/(P)/
+
+        Lines that don't, such as EDICT's header line, are ignored, as are
+        readings marked with restrictions that exclude a headword.  Only
+        headwords consisting of 漢字 followed by optional 仮名 that end the
+        reading (送り仮名) can be annotated, so other headwords are
+        skipped.  When a headword has several readings, the first reading
+        of the first entry marked (P) (common) wins; otherwise, the first
+        reading wins.  The file may be encoded in UTF-8 or EUC-JP.
+
+        Arguments:
+
+          dictionary_path :: str -- the path to the EDICT-style file
+          trie_path :: str -- the path of the trie file to write; it is
+            replaced atomically
+
+        """
+    with open(dictionary_path, "rb") as f:
+      data = f.read()
+    try:
+      text = data.decode("utf-8")
+    except UnicodeDecodeError:
+      text = data.decode("euc-jp", "replace")
+
+    # Map keys to (priority, annotated text).
+    entries = {}
+    for line in text.splitlines():
+      match = cls.__EDICT_LINE.match(line)
+      if match is None:
+        continue
+      headwords = [re.sub(r"\(.*?\)", "", h) for h in match.group(1).split(";")]
+      readings = [
+        (r.group(1), [tag for tags in cls.__EDICT_TAGS.findall(r.group(2)) for tag in tags.split(";")])
+         for r in cls.__EDICT_READING.finditer(match.group(2))
+       ]
+      priority = cls.__EDICT_PRIORITY.search(match.group(3)) is not None
+      for headword in headwords:
+        if headword in entries and (entries[headword][0] or not priority):
+          continue
+        for reading, tags in readings:
+          # Groups of parentheses after a reading hold tags such as "P" and
+          # the headwords that the reading is restricted to.
+          restrictions = [tag for tag in tags if tag in headwords]
+          if restrictions and headword not in restrictions:
+            continue
+          annotated = cls.__Annotate(headword, reading)
+          if annotated is not None:
+            entries[headword] = (priority, annotated)
+          break
+
+    # Build the trie in memory, then flatten it breadth-first.
+    root = {}
+    for key, (_, annotated) in entries.items():
+      node = root
+      for char in key:
+        node = node.setdefault(char, {})
+      node[None] = annotated
+    nodes = array.array("I")
+    characters = array.array("I")
+    targets = array.array("I")
+    strings = io.BytesIO()
+    queue = collections.deque([root])
+    next_node = 1
+    while queue:
+      node = queue.popleft()
+      children = sorted((c, child) for c, child in node.items() if c is not None)
+      if None in node:
+        value = node[None].encode("utf-8")
+        nodes.extend((len(characters), len(children), strings.tell(), len(value)))
+        strings.write(value)
+      else:
+        nodes.extend((len(characters), len(children), cls.NO_VALUE, 0))
+      for c, child in children:
+        characters.append(ord(c))
+        targets.append(next_node)
+        queue.append(child)
+        next_node += 1
+    strings = strings.getvalue()
+    header = array.array("I", [0, 0, cls.ENDIANNESS_CHECK,
+     max((len(key) for key in entries), default=0), len(nodes) // 4,
+     len(characters), len(strings), 0])
+    header_bytes = header.tobytes()
+    header_bytes = cls.MAGIC + header_bytes[len(cls.MAGIC):]
+
+    temp_path = trie_path + os.extsep + "tmp"
+    with open(temp_path, "wb") as f:
+      f.write(header_bytes)
+      nodes.tofile(f)
+      characters.tofile(f)
+      targets.tofile(f)
+      f.write(strings)
+    os.replace(temp_path, trie_path)
+
+  @classmethod
+  def __Annotate(cls, headword, reading):
+    """ Get the annotated text for the specified headword and reading, or
+        None if the headword can't be annotated."""
+    match = cls.__漢字THEN仮名.match(headword)
+    if match is None:
+      return None
+    漢字, 送り仮名 = match.groups()
+    if KANJI_RANGE.Search(送り仮名) or not reading.endswith(送り仮名):
+      return None
+    振り仮名 = reading[:len(reading) - len(送り仮名)]
+    if not 振り仮名 or "[" in 振り仮名 or "]" in 振り仮名:
+      return None
+    return 漢字 + "[" + 振り仮名 + "]" + 送り仮名
+
+  def LongestMatch(self, text, start):
+    """ Find the longest key in this dictionary that starts at the
+        specified index of the specified string.  This examines at most
+        MaxKeyLength characters.
+
+        Returns a tuple containing the key's length and its annotated
+        text, or None if no key matches."""
+    nodes = self.__nodes
+    characters = self.__characters
+    node = 0
+    match = None
+    for index in range(start, min(len(text), start + self.__max_key_length)):
+      first = nodes[node * 4]
+      end = first + nodes[node * 4 + 1]
+      cp = ord(text[index])
+      edge = bisect.bisect_left(characters, cp, first, end)
+      if edge == end or characters[edge] != cp:
+        break
+      node = self.__targets[edge]
+      offset = nodes[node * 4 + 2]
+      if offset != self.NO_VALUE:
+        match = (index + 1 - start, offset, nodes[node * 4 + 3])
+    if match is None:
+      return None
+    length, offset, value_length = match
+    return (length, str(self.__strings[offset:offset + value_length], "utf-8"))
+
+  def Annotate(self, text, 振り仮名start='[', 振り仮名end=']'):
+    """ Return a copy of the specified string in which every 漢字 is
+        followed by 振り仮名 delimiters, like Delimit漢字() does.  Each
+        dictionary word that starts with a 漢字 is annotated with its
+        reading, preferring the longest word at each position; other 漢字
+        get empty delimiters.  This takes time linear in the length of
+        the text.
+
+        Arguments:
+
+          text :: str -- the text to annotate
+          振り仮名start :: str -- the opening 振り仮名 delimiter
+          振り仮名end :: str -- the closing 振り仮名 delimiter
+
+        """
+    custom = (振り仮名start, 振り仮名end) != ('[', ']')
+    buf = io.StringIO()
+    position = 0
+    pattern = KANJI_RANGE.Pattern
+    while True:
+      match = pattern.search(text, position)
+      if match is None:
+        buf.write(text[position:])
+        return buf.getvalue()
+      start = match.start()
+      buf.write(text[position:start])
+      word = self.LongestMatch(text, start)
+      if word is None:
+        buf.write(text[start])
+        buf.write(振り仮名start)
+        buf.write(振り仮名end)
+        position = start + 1
+      else:
+        length, annotated = word
+        if custom:
+          annotated = annotated.replace("[", 振り仮名start, 1).replace("]", 振り仮名end, 1)
+        buf.write(annotated)
+        position = start + length
+
+  @property
+  def MaxKeyLength(self):
+    """the length of the longest key in the dictionary"""
+    return self.__max_key_length
+
+  @property
+  def Path(self):
+    """the path to the compiled trie file"""
+    return self.__path
+
 def GenerateHTML5Ruby(言葉と振り仮名sequence, buf, kanji_class,
  kanji_onclick_generator, kanji_onmouseover_generator,
  kanji_onmouseout_generator, 振り仮名のクラス, 振り仮名が見える=True):
@@ -499,25 +1137,144 @@ def GenerateHTML5Ruby(言葉と振り仮名sequence, buf, kanji_class,
       for 字 in ペア.言葉:
         (Write漢字 if ord(字) in KANJI_RANGE else buf.write)(字)
 
+def GenerateCompactHTML5Ruby(言葉と振り仮名sequence, buf, kanji_class):
+  """ Write compact HTML5 ruby-annotated text from the specified iterable of
+      T言葉と振り仮名 into the specified buffer.  Unlike GenerateHTML5Ruby(),
+      this function does not write event handlers or styles into every tag:
+      Each 漢字 becomes a span whose class is 'kanji_class' and that has a
+      "data-kanji" attribute, and the rp and rt tags are bare.  kanji.js
+      handles the spans' events with delegated listeners, and the
+      "furigana_visible" class on an enclosing element (see furigana.js and
+      sourceflashcard.css) controls whether the 振り仮名 are visible.
+      Initially, they are hidden."""
+  spans = KANJI_RANGE.GetTranslationTable('<span class="' + kanji_class.replace("%", "%%") + '" data-kanji>%s</span>')
+
+  for ペア in 言葉と振り仮名sequence:
+    if ペア.振り仮名:
+      buf.write('<ruby>')
+      buf.write(ペア.言葉.translate(spans))
+      buf.write('<rp> (</rp><rt>')
+      buf.write(ペア.振り仮名)
+      buf.write('<rp>) </rp></rt></ruby>')
+    else:
+      buf.write(ペア.言葉.translate(spans))
+
+
 
 
 ################################################################################
 # Functions for downloading 漢字 stroke order diagrams from remote sources
 ################################################################################
 
-def WriteDiagramFile(データ, ファイルのパス名):
-  """ Write the bytes represented by データ to a new file at the path ファイルのパス名.
-      The file must not already exist.  This will delete the file if an IO
-      error occurs."""
+""" These settings control how diagram downloads that fail for reasons that
+    might be temporary are retried.  Each download is retried up to
+    DOWNLOAD_RETRIES times.  The delay before the nth retry is a random
+    number of seconds between zero and
+    min(DOWNLOAD_RETRY_MAX_DELAY, DOWNLOAD_RETRY_BASE_DELAY * 2 ** (n - 1))
+    unless the server asks for a specific delay with a Retry-After header.
+    See IsTransientDownloadError() and GetDownloadRetryDelay()."""
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_RETRY_BASE_DELAY = 0.5
+DOWNLOAD_RETRY_MAX_DELAY = 30.0
+TRANSIENT_HTTP_STATUS_CODES = frozenset((408, 425, 429, 500, 502, 503, 504))
+
+""" This is the number of bytes that downloads read from the network and
+    write to disk at a time."""
+DOWNLOAD_READ_SIZE = 64 * 1024
+
+def IsTransientDownloadError(error):
+  """ Determine whether the specified exception, which made a download fail,
+      might not happen if the download were retried."""
+  if isinstance(error, urllib.error.HTTPError):
+    return error.code in TRANSIENT_HTTP_STATUS_CODES
+  if isinstance(error, urllib.error.URLError):
+    if not isinstance(error.reason, OSError):
+      return False
+    error = error.reason
+  if isinstance(error, (ssl.SSLCertVerificationError, FileNotFoundError, FileExistsError, PermissionError, IsADirectoryError, NotADirectoryError)):
+    return False
+  return isinstance(error, (OSError, EOFError, http.client.HTTPException, asyncio.TimeoutError))
+
+def GetDownloadRetryDelay(attempt, error):
+  """ Get the number of seconds to wait before retrying a download after the
+      specified number of retries (zero before the first retry) when the
+      download failed because of the specified exception."""
+  headers = getattr(error, "headers", None)
+  if headers is not None:
+    try:
+      return max(0.0, min(float(headers.get("retry-after")), DOWNLOAD_RETRY_MAX_DELAY))
+    except (TypeError, ValueError):
+      pass
+  return random.uniform(0, min(DOWNLOAD_RETRY_MAX_DELAY, DOWNLOAD_RETRY_BASE_DELAY * 2 ** attempt))
+
+def GetPartialDownloadPath(ファイルのパス名):
+  """ Get the path of the file that holds the incomplete download of the
+      file at the specified path."""
+  return ファイルのパス名 + os.extsep + "part"
+
+def PrepareDownloadedBody(f, offset, status, content_range):
+  """ Prepare the partial download file 'f', which contained 'offset' bytes
+      when the download's request was sent, for the body of a successful
+      response with the specified status code and Content-Range header value
+      (None if there isn't one).  The file is emptied unless the response
+      continues the partial download.  This raises http.client.HTTPException
+      if the response is a range that doesn't start at 'offset'."""
+  if status == 206:
+    match = re.match(r"\s*bytes\s+(\d+)-", content_range or "")
+    if offset and match and int(match.group(1)) == offset:
+      return
+    f.seek(0)
+    f.truncate()
+    raise http.client.HTTPException("the server sent an unexpected range: " + str(content_range))
+  f.seek(0)
+  f.truncate()
+
+def DownloadDiagramFile(url, ファイルのパス名, タイムアウト, retries=DOWNLOAD_RETRIES):
+  """ Download the specified URL into a new file at the path ファイルのパス名.
+      The file must not already exist.  The response is streamed into a
+      partial file (see GetPartialDownloadPath()) that is renamed to
+      ファイルのパス名 once it is complete, so a crash never leaves a
+      truncated diagram behind.  A partial file left by an earlier attempt
+      is continued with an HTTP Range request; servers that don't support
+      ranges send the whole file again.  Errors that might be temporary are
+      retried up to 'retries' times with exponential backoff.  If the
+      download still fails, then the partial file is kept for the next
+      attempt if the error might be temporary and deleted otherwise.  Each
+      request will timeout after タイムアウト seconds."""
   assert not os.path.exists(ファイルのパス名)
-  try:
-    with データ as remote_data:
-      with open(ファイルのパス名, "wb") as f:
-        f.write(データ.read())
-  except Exception as e:
-    if os.path.exists(ファイルのパス名):
-      os.unlink(ファイルのパス名)
-    raise e
+  part = GetPartialDownloadPath(ファイルのパス名)
+  attempt = 0
+  while True:
+    offset = 0
+    try:
+      with open(part, "ab") as f:
+        offset = f.tell()
+        request = urllib.request.Request(url, headers=({"Range": "bytes=" + str(offset) + "-"} if offset else {}))
+        with urllib.request.urlopen(request, timeout=タイムアウト) as データ:
+          PrepareDownloadedBody(f, offset, データ.status, データ.headers.get("Content-Range"))
+          while True:
+            data = データ.read(DOWNLOAD_READ_SIZE)
+            if not data:
+              break
+            f.write(data)
+          # read() doesn't complain if the connection closes early.
+          if データ.length:
+            raise http.client.IncompleteRead(b"", データ.length)
+      os.replace(part, ファイルのパス名)
+      return
+    except Exception as e:
+      if isinstance(e, urllib.error.HTTPError) and e.code == 416 and offset:
+        # The partial file doesn't match the remote file anymore.
+        os.unlink(part)
+        continue
+      if not IsTransientDownloadError(e):
+        if os.path.exists(part):
+          os.unlink(part)
+        raise
+      if attempt >= retries:
+        raise
+      time.sleep(GetDownloadRetryDelay(attempt, e))
+      attempt += 1
 
 def GetJishoDotOrgURL(漢字):
   """ Get a URL string for the specified 漢字's stroke order diagram from jisho.org."""
@@ -529,7 +1286,7 @@ def DownloadJishoDotOrgDiagram(漢字, ファイルのパス名, タイムアウ
   """ Download the stroke order diagram for the specified 漢字 from jisho.org.
       The image will be stored in the path specified by ファイルのパス名.
       The download will timeout after タイムアウト seconds."""
-  WriteDiagramFile(urllib.request.urlopen(GetJishoDotOrgURL(漢字), timeout=タイムアウト), ファイルのパス名)
+  DownloadDiagramFile(GetJishoDotOrgURL(漢字), ファイルのパス名, タイムアウト)
 
 def GetSaigaJPURL(漢字):
   """ Get a URL string for the specified 漢字's stroke order diagram from saiga-jp.com."""
@@ -541,7 +1298,7 @@ def DownloadSaigaJPDiagram(漢字, ファイルのパス名, タイムアウト)
   """ Download the animated stroke order diagram for the specified 漢字 from saiga-jp.com.
       The image will be stored in the path specified by ファイルのパス名.
       The download will timeout after タイムアウト seconds."""
-  WriteDiagramFile(urllib.request.urlopen(GetSaigaJPURL(漢字), timeout=タイムアウト), ファイルのパス名)
+  DownloadDiagramFile(GetSaigaJPURL(漢字), ファイルのパス名, タイムアウト)
 
 def GetSLJFAQURL(漢字):
   """ Get a URL string for the specified 漢字's stroke order diagram from sljfaq.org."""
@@ -553,7 +1310,543 @@ def DownloadSLJFAQDiagram(漢字, ファイルのパス名, タイムアウト):
   """ Download the stroke order diagram for the specified 漢字 from kanji.sljfaq.org.
       The image will be stored in the path specified by ファイルのパス名.
       The download will timeout after タイムアウト seconds."""
-  WriteDiagramFile(urllib.request.urlopen(GetSLJFAQURL(漢字), timeout=タイムアウト), ファイルのパス名)
+  DownloadDiagramFile(GetSLJFAQURL(漢字), ファイルのパス名, タイムアウト)
+
+
+
+class TAsyncHTTPDownloader(object):
+  """ Instances of this class download files over HTTP/1.1 with asyncio.
+      Connections are kept alive and reused for later requests to the same
+      host, the number of simultaneous connections to each host is capped,
+      and response bodies are streamed to disk as they arrive.  HTTPS and
+      redirects are supported.  Like DownloadDiagramFile(), downloads are
+      written to partial files that are renamed once they are complete,
+      interrupted downloads are resumed with Range requests, and temporary
+      errors are retried with exponential backoff.  Failed downloads raise
+      the same urllib.error.HTTPError exceptions that
+      urllib.request.urlopen() raises, so callers can handle both kinds of
+      downloads alike."""
+
+  MAX_REDIRECTS = 5
+  READ_SIZE = DOWNLOAD_READ_SIZE
+  USER_AGENT = "Tsukuyomi/" + __version__
+
+  def __init__(self, timeout, max_connections_per_host=4, max_downloads=None, retries=DOWNLOAD_RETRIES):
+    """ Construct a new downloader.  This expects the following parameters:
+
+          timeout :: int | float
+            The maximum number of seconds that each HTTP request may take,
+            not counting time spent waiting for a connection.
+          max_connections_per_host :: int
+            The maximum number of simultaneous connections to each host.
+          max_downloads :: int
+            The maximum number of downloads in progress at once, or None if
+            only the per-host limit applies.
+          retries :: int
+            The maximum number of times that each download is retried after
+            errors that might be temporary.
+
+      """
+    assert max_connections_per_host > 0
+    assert retries >= 0
+    self.__timeout = timeout
+    self.__retries = retries
+    self.__max_connections_per_host = max_connections_per_host
+    self.__max_downloads = max_downloads
+    self.__pools = {}
+    super().__init__()
+
+  class THostPool(object):
+    """ Instances of this class hold a host's idle keep-alive connections
+        and limit the number of connections to the host."""
+
+    def __init__(self, max_connections):
+      self.Semaphore = asyncio.Semaphore(max_connections)
+      self.Idle = []
+      super().__init__()
+
+  def DownloadAll(self, jobs, callback):
+    """ Download files and block until all of the downloads finish.  This
+        runs its own event loop, so it must not be invoked from a coroutine.
+
+        'jobs' is an iterable of (url, path, context) tuples, where 'path'
+        is the path of the file to create (see Download()).  'callback' is
+        invoked with each job's context and None when the job succeeds or
+        with the job's context and the exception that made it fail."""
+    async def Main():
+      limit = asyncio.Semaphore(self.__max_downloads) if self.__max_downloads else None
+      async def Run(url, パス, context):
+        try:
+          if limit is None:
+            await self.Download(url, パス)
+          else:
+            async with limit:
+              await self.Download(url, パス)
+        except Exception as e:
+          callback(context, e)
+        else:
+          callback(context, None)
+      try:
+        await asyncio.gather(*(Run(*job) for job in jobs))
+      finally:
+        self.Close()
+    asyncio.run(Main())
+
+  async def Download(self, url, パス):
+    """ Download the specified URL into a new file at the specified path.
+        The file must not already exist.  See DownloadDiagramFile() for how
+        partial files, resumption, and retries work.  This raises
+        urllib.error.HTTPError if the server responds with an error and
+        asyncio.TimeoutError if a request takes too long."""
+    assert not os.path.exists(パス)
+    part = GetPartialDownloadPath(パス)
+    attempt = 0
+    while True:
+      offset = 0
+      try:
+        with open(part, "ab") as f:
+          offset = f.tell()
+          await self.__Fetch(url, f)
+        os.replace(part, パス)
+        return
+      except Exception as e:
+        if isinstance(e, urllib.error.HTTPError) and e.code == 416 and offset:
+          # The partial file doesn't match the remote file anymore.
+          os.unlink(part)
+          continue
+        if not IsTransientDownloadError(e):
+          if os.path.exists(part):
+            os.unlink(part)
+          raise
+        if attempt >= self.__retries:
+          raise
+        await asyncio.sleep(GetDownloadRetryDelay(attempt, e))
+        attempt += 1
+
+  def Close(self):
+    """ Close all idle connections."""
+    for pool in self.__pools.values():
+      for _, writer in pool.Idle:
+        writer.close()
+    self.__pools = {}
+
+  async def __Fetch(self, url, f):
+    offset = f.tell()
+    def OpenBody(status, headers):
+      if status not in (200, 206):
+        return None
+      PrepareDownloadedBody(f, offset, status, headers.get("content-range"))
+      return f.write
+    for _ in range(self.MAX_REDIRECTS + 1):
+      parts = urllib.parse.urlsplit(url)
+      if parts.scheme not in ("http", "https"):
+        raise ValueError("unsupported URL scheme: " + url)
+      port = parts.port or (443 if parts.scheme == "https" else 80)
+      key = (parts.scheme, parts.hostname, port)
+      pool = self.__pools.get(key)
+      if pool is None:
+        pool = self.__pools[key] = self.THostPool(self.__max_connections_per_host)
+      target = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+      request = bytes(
+        "GET " + target + " HTTP/1.1\r\n" +
+        "Host: " + parts.netloc + "\r\n" +
+        "User-Agent: " + self.USER_AGENT + "\r\n" +
+        "Accept: */*\r\n" +
+        ("Range: bytes=" + str(offset) + "-\r\n" if offset else "") +
+        "Connection: keep-alive\r\n\r\n",
+        encoding="ascii"
+       )
+      # The timeout starts once a connection slot is free so that queued
+      # downloads don't time out while they wait.
+      async with pool.Semaphore:
+        status, reason, headers = await asyncio.wait_for(
+          self.__Exchange(pool, key, request, OpenBody), self.__timeout
+         )
+      if status in (200, 206):
+        return
+      if status in (301, 302, 303, 307, 308) and "location" in headers:
+        url = urllib.parse.urljoin(url, headers["location"])
+        continue
+      raise urllib.error.HTTPError(url, status, reason, headers, None)
+    raise urllib.error.HTTPError(url, status, "too many redirects", headers, None)
+
+  async def __Exchange(self, pool, key, request, open_body):
+    """ Send the request over an idle or new connection to the host and
+        read the response.  'open_body' is invoked with the response's
+        status code and headers before the body is read and returns the
+        function that the body is passed to, or None if the body should be
+        discarded.  A request that fails on a
+        reused connection is retried once on a new connection because the
+        server might have closed the idle connection."""
+    while True:
+      reused = bool(pool.Idle)
+      if reused:
+        reader, writer = pool.Idle.pop()
+      else:
+        scheme, host, port = key
+        reader, writer = await asyncio.open_connection(host, port,
+         ssl=(ssl.create_default_context() if scheme == "https" else None),
+         limit=self.READ_SIZE)
+      try:
+        writer.write(request)
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+          raise ConnectionResetError("the server closed the connection")
+      except (ConnectionError, asyncio.IncompleteReadError):
+        writer.close()
+        if reused:
+          continue
+        raise
+      except BaseException:
+        writer.close()
+        raise
+      break
+    try:
+      version, status, reason = (str(status_line, encoding="latin-1").rstrip("\r\n").split(" ", 2) + [""])[:3]
+      status = int(status)
+      headers = {}
+      while True:
+        line = await reader.readline()
+        if not line:
+          raise ConnectionResetError("the server closed the connection")
+        line = str(line, encoding="latin-1").rstrip("\r\n")
+        if not line:
+          break
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+      keep_alive = (
+        headers.get("connection", "").lower() != "close"
+         if version == "HTTP/1.1"
+         else headers.get("connection", "").lower() == "keep-alive"
+       )
+      sink = open_body(status, headers) or (lambda data: None)
+      if status in (204, 304) or 100 <= status < 200:
+        pass
+      elif headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+          size = int(str(await reader.readline(), encoding="latin-1").split(";")[0].strip(), 16)
+          if size == 0:
+            while (await reader.readline()).strip():
+              pass
+            break
+          while size:
+            data = await reader.readexactly(min(size, self.READ_SIZE))
+            sink(data)
+            size -= len(data)
+          await reader.readexactly(2)
+      elif "content-length" in headers:
+        remaining = int(headers["content-length"])
+        while remaining:
+          try:
+            data = await reader.readexactly(min(remaining, self.READ_SIZE))
+          except asyncio.IncompleteReadError as e:
+            # Keep what arrived so that the download can be resumed.
+            sink(e.partial)
+            raise
+          sink(data)
+          remaining -= len(data)
+      else:
+        keep_alive = False
+        while True:
+          data = await reader.read(self.READ_SIZE)
+          if not data:
+            break
+          sink(data)
+    except BaseException:
+      writer.close()
+      raise
+    if keep_alive:
+      pool.Idle.append((reader, writer))
+    else:
+      writer.close()
+    return (status, reason, headers)
+
+
+
+def Scan漢字File(パス):
+  """ Get a string containing each distinct 漢字 in the specified text file,
+      sorted by code point.  download-kanji-images.py runs this in worker
+      processes, so it must stay a module-level function."""
+  with open(パス, "r") as f:
+    return "".join(sorted(KANJI_RANGE.Extract(f.read())))
+
+class T漢字ScanCache(object):
+  """ Instances of this class remember the 漢字 found in scanned files so that
+      download-kanji-images.py only rescans files that changed.  Entries are
+      keyed by path and validated against the files' modification times
+      and sizes.  The cache is stored as a JSON file."""
+
+  VERSION = 1
+
+  def __init__(self, パス):
+    """ Load the cache stored at the specified path.  The cache is empty if
+        the file doesn't exist or can't be parsed."""
+    self.__path = パス
+    self.__entries = {}
+    try:
+      with open(パス, "r", encoding="UTF-8") as f:
+        data = json.load(f)
+      if data.get("version") == self.VERSION:
+        self.__entries = data["files"]
+    except (OSError, ValueError, KeyError, AttributeError):
+      pass
+    super().__init__()
+
+  def Get(self, パス, stat):
+    """ Get the 漢字 string stored for the specified file, or None if the
+        file isn't cached or changed since it was cached.  'stat' must be
+        the file's os.stat_result."""
+    entry = self.__entries.get(パス)
+    if entry is None or entry[0] != stat.st_mtime_ns or entry[1] != stat.st_size:
+      return None
+    return entry[2]
+
+  def Put(self, パス, stat, 漢字):
+    """ Store the 漢字 string for the specified file, whose os.stat_result
+        is 'stat'."""
+    self.__entries[パス] = [stat.st_mtime_ns, stat.st_size, 漢字]
+
+  def Save(self, パス名):
+    """ Write the cache to its file, keeping only the entries for the paths
+        in the specified collection.  The file is replaced atomically."""
+    パス名 = set(パス名)
+    data = {
+      "version": self.VERSION,
+      "files": dict((パス, entry) for パス, entry in self.__entries.items() if パス in パス名)
+     }
+    temp_path = self.__path + os.extsep + "tmp"
+    with open(temp_path, "w", encoding="UTF-8") as f:
+      json.dump(data, f, ensure_ascii=False)
+    os.replace(temp_path, self.__path)
+
+  @property
+  def Path(self):
+    """the path to the cache file"""
+    return self.__path
+
+class TDownloadManifest(object):
+  """ Instances of this class record the diagram downloads of a batch that
+      haven't finished yet so that an interrupted batch can continue where
+      it left off.  The manifest is stored as a JSON file mapping sources
+      to strings of 漢字; the file is deleted when nothing is pending."""
+
+  VERSION = 1
+
+  """the minimum number of seconds between writes of the manifest while a
+  batch is running"""
+  SAVE_INTERVAL = 1.0
+
+  def __init__(self, パス):
+    """ Load the manifest stored at the specified path.  The manifest is
+        empty if the file doesn't exist or can't be parsed."""
+    self.__path = パス
+    self.__pending = {}
+    self.__saved = None
+    self.__dirty = False
+    try:
+      with open(パス, "r", encoding="UTF-8") as f:
+        data = json.load(f)
+      if data.get("version") == self.VERSION:
+        self.__pending = dict((source, set(漢字)) for source, 漢字 in data["pending"].items())
+    except (OSError, ValueError, KeyError, AttributeError, TypeError):
+      pass
+    super().__init__()
+
+  def GetPending(self, source):
+    """ Get the set of 漢字 whose diagrams from the specified source are
+        pending.  Don't modify the set."""
+    return self.__pending.get(source, frozenset())
+
+  def Add(self, 字, source):
+    """ Record that the specified 漢字's diagram from the specified source
+        is pending."""
+    self.__pending.setdefault(source, set()).add(字)
+    self.__dirty = True
+
+  def Remove(self, 字, source):
+    """ Record that the specified 漢字's diagram from the specified source
+        isn't pending anymore."""
+    self.__pending.get(source, set()).discard(字)
+    self.__dirty = True
+
+  def Save(self, force=True):
+    """ Write the manifest to its file if it changed.  The file is replaced
+        atomically.  If 'force' is False, then the manifest isn't written
+        if it was written less than SAVE_INTERVAL seconds ago."""
+    now = time.monotonic()
+    if not self.__dirty or (not force and self.__saved is not None and now < self.__saved + self.SAVE_INTERVAL):
+      return
+    pending = dict((source, "".join(sorted(漢字))) for source, 漢字 in self.__pending.items() if 漢字)
+    if pending:
+      temp_path = self.__path + os.extsep + "tmp"
+      with open(temp_path, "w", encoding="UTF-8") as f:
+        json.dump({"version": self.VERSION, "pending": pending}, f, ensure_ascii=False, sort_keys=True)
+      os.replace(temp_path, self.__path)
+    elif os.path.exists(self.__path):
+      os.unlink(self.__path)
+    self.__saved = now
+    self.__dirty = False
+
+  @property
+  def Path(self):
+    """the path to the manifest file"""
+    return self.__path
+
+class TStrokeOrderDiagramPack(object):
+  """ Instances of this class read packs, which store all of a source's
+      stroke order diagrams in one file so that image directories don't
+      need one file per diagram.  Packs are memory-mapped when they are
+      opened, so opening a pack doesn't read the diagrams and serving a
+      diagram only touches the diagram's pages.
+
+      A pack is an array of native-endian unsigned 64-bit integers (array
+      typecode 'Q') followed by the diagrams' bytes:
+
+        header :: 4 words -- the magic bytes, an endianness check value,
+          the number of diagrams, and a reserved word
+        code points :: 1 word per diagram -- the code point of each
+          diagram's 漢字, in ascending order
+        offsets :: 1 word per diagram -- the offset of each diagram's bytes
+          from the start of the file
+        lengths :: 1 word per diagram -- the length of each diagram in
+          bytes
+
+      """
+
+  MAGIC = b"TKYPACK\x01"
+  ENDIANNESS_CHECK = 0x0102030405060708
+  HEADER_WORDS = 4
+
+  def __init__(self, パス):
+    """ Memory-map the specified pack file.
+
+        Arguments:
+
+          パス :: str -- the path to a file written by Write()
+
+        """
+    self.__path = パス
+    with open(パス, "rb") as f:
+      self.__mtime = os.fstat(f.fileno()).st_mtime
+      self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    # The header and the index are copied out of the map, so the map can be
+    # closed if they are invalid.
+    try:
+      header_bytes = self.HEADER_WORDS * 8
+      if len(self.__map) < header_bytes or self.__map[:len(self.MAGIC)] != self.MAGIC:
+        raise ValueError(パス + " is not a stroke order diagram pack")
+      words = array.array("Q", self.__map[:header_bytes])
+      if words[1] != self.ENDIANNESS_CHECK:
+        raise ValueError(パス + " was written on a machine with a different byte order")
+      count = words[2]
+      if len(self.__map) < header_bytes + count * 24:
+        raise ValueError(パス + " is truncated")
+      index = array.array("Q", self.__map[header_bytes:header_bytes + count * 24])
+      self.__code_points = index[:count]
+      self.__offsets = index[count:count * 2]
+      self.__lengths = index[count * 2:]
+      if any(offset + length > len(self.__map) for offset, length in zip(self.__offsets, self.__lengths)):
+        raise ValueError(パス + " is truncated")
+    except BaseException:
+      self.__map.close()
+      raise
+    super().__init__()
+
+  def __contains__(self, 字):
+    return self.__Find(字) is not None
+
+  def __iter__(self):
+    return (chr(cp) for cp in self.__code_points)
+
+  def __len__(self):
+    return len(self.__code_points)
+
+  @classmethod
+  def Write(cls, パス, diagrams):
+    """ Write a pack containing the specified diagrams.  The pack is
+        replaced atomically.
+
+        Arguments:
+
+          パス :: str -- the path of the pack file
+          diagrams :: dict -- maps 漢字 to the paths of diagram files or
+            to bytes-like objects containing diagrams
+
+        """
+    items = sorted((ord(字), diagram) for 字, diagram in diagrams.items())
+    lengths = array.array("Q", (
+      os.path.getsize(diagram) if isinstance(diagram, str) else len(diagram)
+       for _, diagram in items
+     ))
+    offsets = array.array("Q")
+    offset = (cls.HEADER_WORDS + len(items) * 3) * 8
+    for length in lengths:
+      offsets.append(offset)
+      offset += length
+    header = array.array("Q", [0, cls.ENDIANNESS_CHECK, len(items), 0])
+    header_bytes = header.tobytes()
+    header_bytes = cls.MAGIC + header_bytes[len(cls.MAGIC):]
+
+    temp_path = パス + os.extsep + "tmp"
+    with open(temp_path, "wb") as f:
+      f.write(header_bytes)
+      array.array("Q", (cp for cp, _ in items)).tofile(f)
+      offsets.tofile(f)
+      lengths.tofile(f)
+      for (_, diagram), length in zip(items, lengths):
+        if isinstance(diagram, str):
+          with open(diagram, "rb") as d:
+            diagram = d.read()
+          if len(diagram) != length:
+            raise ValueError("the diagram file changed while it was being packed")
+        f.write(diagram)
+    os.replace(temp_path, パス)
+
+  def Get(self, 字):
+    """ Get a memoryview of the specified 漢字's diagram, or None if the pack
+        doesn't contain it."""
+    i = self.__Find(字)
+    if i is None:
+      return None
+    offset = self.__offsets[i]
+    return memoryview(self.__map)[offset:offset + self.__lengths[i]]
+
+  def Serve(self, 字, content_type):
+    """ Serve the specified 漢字's diagram with the specified Content-Type
+        like Bottle's static_file() serves files: The response's
+        Last-Modified header is the pack's modification time, and
+        If-Modified-Since and HEAD requests are obeyed.  This must be
+        invoked while handling a GET request.  This returns a Bottle
+        HTTPResponse, or an HTTPError if the pack doesn't contain the
+        diagram."""
+    diagram = self.Get(字)
+    if diagram is None:
+      return HTTPError(404, "File does not exist.")
+    header = {
+      'Content-Type': content_type,
+      'Content-Length': str(len(diagram)),
+      'Last-Modified': time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(self.__mtime))
+     }
+    ims = request.environ.get('HTTP_IF_MODIFIED_SINCE')
+    if ims:
+      ims = parse_date(ims.split(";")[0].strip())
+    if ims is not None and ims >= int(self.__mtime):
+      return HTTPResponse(status=304, header=header)
+    return HTTPResponse(b'' if request.method == 'HEAD' else bytes(diagram), header=header)
+
+  def __Find(self, 字):
+    cp = ord(字)
+    i = bisect.bisect_left(self.__code_points, cp)
+    if i == len(self.__code_points) or self.__code_points[i] != cp:
+      return None
+    return i
+
+  @property
+  def Path(self):
+    """the path to the pack file"""
+    return self.__path
+
 
 
 
@@ -578,6 +1871,32 @@ class TStrokeOrderDiagramFSInfo(object):
     "sljfaq.org": (DownloadSLJFAQDiagram, GetSLJFAQURL, "png")
    }
 
+  """the HTTP status codes with which sources report missing diagrams"""
+  MISSING_STATUS_CODES = frozenset((403, 404, 410))
+
+  """the number of seconds for which the in-memory indexes of the diagrams
+  on disk are trusted before their directories' modification times are
+  checked again; diagrams that other processes add become visible after
+  at most this long"""
+  INDEX_REVALIDATION_INTERVAL = 2.0
+
+  """the name of the file in each source's image directory that records
+  the diagrams that the source doesn't have"""
+  MISSING_FILE_NAME = "missing.json"
+
+  """the name of the TStrokeOrderDiagramPack file in each source's image
+  directory (see PackStrokeOrderDiagrams())"""
+  PACK_FILE_NAME = "diagrams.pack"
+
+  """the maximum number of diagrams that ServeStrokeOrderDiagram() downloads
+  at once in the background"""
+  READ_THROUGH_WORKERS = 4
+
+  """the number of seconds for which ServeStrokeOrderDiagram() waits for a
+  background download before it redirects the browser to the source when
+  the server handles requests concurrently"""
+  READ_THROUGH_WAIT = 5.0
+
   def __init__(self, 設定ファイルのパス):
     """ Construct a 漢字 stroke order diagram downloader that uses the specified configuration file's settings."""
     # Flags and default settings
@@ -586,6 +1905,19 @@ class TStrokeOrderDiagramFSInfo(object):
     self.__ファイル = []
     self.__enabled_sources = []
     self.__image_directory = None
+    self.__scan_cache_path = None
+    self.__download_manifest_path = None
+    self.__missing_ttl = None
+    self.__missing = {}
+    self.__indexes = {}
+    self.__read_through = True
+    self.__fetches = {}
+    self.__generation = 0
+    # Servers use this object from request, prerendering, and download
+    # threads at once.  This lock guards the directory indexes, the records
+    # of missing diagrams, and the table of background downloads.
+    self.__lock = threading.RLock()
+    self.__fetch_executor = None
 
     # Parse the configuration file.
     def ProcessSettings(config, パス名, PrintErrorAndExit):
@@ -605,6 +1937,18 @@ class TStrokeOrderDiagramFSInfo(object):
         except ValueError:
           PrintErrorAndExit("timeout is not a number: " + section['timeout'])
       self.__image_directory = section.get('image-directory', None)
+      self.__scan_cache_path = section.get('scan-cache', None)
+      self.__download_manifest_path = section.get('download-manifest', None)
+      if 'missing-ttl' in section:
+        try:
+          self.__missing_ttl = float(section['missing-ttl']) * 24 * 60 * 60
+        except ValueError:
+          PrintErrorAndExit("missing-ttl is not a number: " + section['missing-ttl'])
+      if 'read-through' in section:
+        value = section['read-through'].lower()
+        if value not in ("yes", "no", "true", "false", "on", "off", "1", "0"):
+          PrintErrorAndExit("read-through is not yes or no: " + section['read-through'])
+        self.__read_through = value in ("yes", "true", "on", "1")
 
     ツールの設定ファイルを分析する(設定ファイルのパス, ProcessSettings)
 
@@ -618,8 +1962,37 @@ class TStrokeOrderDiagramFSInfo(object):
       sys.exit(3)
     if self.__タイムアウト is None:
       self.__タイムアウト = 30
+    if self.__missing_ttl is None:
+      self.__missing_ttl = 30 * 24 * 60 * 60
+    if self.__scan_cache_path is None:
+      self.__scan_cache_path = os.path.abspath(設定ファイルのパス) + os.extsep + "scan-cache"
+    else:
+      self.__scan_cache_path = EnsureAbsolutePath(self.__scan_cache_path, self.__設定ファイルのディレクトリ)
+    if self.__download_manifest_path is None:
+      self.__download_manifest_path = os.path.abspath(設定ファイルのパス) + os.extsep + "download-manifest"
+    else:
+      self.__download_manifest_path = EnsureAbsolutePath(self.__download_manifest_path, self.__設定ファイルのディレクトリ)
     super().__init__()
 
+  def BuildDiagramBundle(self, 漢字, source):
+    """ Bundle the locally-stored stroke order diagrams from the specified
+        source for the 漢字 characters in the specified iterable into a
+        single JS file.  The file defines the global object KanjiDiagrams,
+        which maps each 漢字 with a local diagram to a data URL containing
+        the diagram; kanjisod.js uses it.  This returns a tuple containing a
+        TStaticAsset, so that servers can serve the bundle with caching
+        headers, and a frozenset of the 漢字 in the bundle.  Clients can
+        then download the diagrams for a whole deck with one request."""
+    assert source in self.EnabledSources
+    content_type = mimetypes.guess_type("diagram" + os.extsep + self.RemoteSources[source][2])[0]
+    diagrams = {}
+    for 字 in 漢字:
+      diagram = self.GetStrokeOrderDiagramData(字, source)
+      if diagram is not None:
+        diagrams[字] = "data:" + content_type + ";base64," + str(base64.b64encode(diagram), encoding="ascii")
+    script = "var KanjiDiagrams = " + json.dumps(diagrams, ensure_ascii=False, sort_keys=True) + ";\n"
+    return (TStaticAsset(bytes(script, encoding="UTF-8"), "bundle.js"), frozenset(diagrams))
+
   def ConstructStrokeOrderDiagramPath(self, 字, source):
     """ Get a string representing the path to the stroke order diagram for the specified 漢字 from the specified source.
         The file might not exist."""
@@ -632,50 +2005,122 @@ class TStrokeOrderDiagramFSInfo(object):
     source_dir = os.path.join(self.ImageDirectory, source)
     if not os.path.exists(source_dir):
       os.mkdir(source_dir)
-    for 字 in 漢字:
-      if ord(字) in KANJI_RANGE:
-        self.RemoteSources[source][0](字, self.ConstructStrokeOrderDiagramPath(字, source), self.タイムアウト)
+    for 字 in KANJI_RANGE.Extract(漢字):
+      self.RemoteSources[source][0](字, self.ConstructStrokeOrderDiagramPath(字, source), self.タイムアウト)
+      self.__RecordDownloaded(字, source)
+
+  def DownloadAll(self, 漢字, callback, max_connections_per_host=4, max_downloads=None, retries=DOWNLOAD_RETRIES):
+    """ Download the stroke order diagrams that haven't been downloaded yet
+        for the 漢字 characters in the specified iterable from all of the
+        EnabledSources.  The downloads run concurrently on a
+        TAsyncHTTPDownloader, which reuses connections to each source's
+        host.  This blocks until all of the downloads finish.
+
+        'callback' is invoked with the 漢字, the source, and None after each
+        successful download, or with the 漢字, the source, and an exception
+        after each failed download.  'max_connections_per_host',
+        'max_downloads', and 'retries' have the same meanings as they do
+        for TAsyncHTTPDownloader.
+
+        The downloads that haven't finished are recorded in the
+        TDownloadManifest at DownloadManifestPath.  Downloads that an
+        earlier invocation didn't finish, because it was interrupted or
+        because they failed with errors that might be temporary, are added
+        to this invocation's downloads; see CountPendingDownloads()."""
+    manifest = TDownloadManifest(self.DownloadManifestPath)
+    jobs = []
+    for source in self.EnabledSources:
+      source_dir = os.path.join(self.ImageDirectory, source)
+      if not os.path.exists(source_dir):
+        os.mkdir(source_dir)
+      for 字 in sorted(manifest.GetPending(source) | KANJI_RANGE.Extract("".join(漢字))):
+        if not self.Downloaded(字, source) and not self.IsKnownMissing(字, source):
+          manifest.Add(字, source)
+          jobs.append((self.RemoteSources[source][1](字), self.ConstructStrokeOrderDiagramPath(字, source), (字, source)))
+        else:
+          manifest.Remove(字, source)
+    def HandleResult(context, error):
+      字, source = context
+      if error is None:
+        self.__RecordDownloaded(字, source)
+      elif isinstance(error, urllib.error.HTTPError) and error.code in self.MISSING_STATUS_CODES:
+        self.__RecordMissing(字, source)
+      if error is None or not IsTransientDownloadError(error):
+        manifest.Remove(字, source)
+        manifest.Save(force=False)
+      callback(字, source, error)
+    manifest.Save()
+    downloader = TAsyncHTTPDownloader(self.タイムアウト, max_connections_per_host, max_downloads, retries)
+    try:
+      downloader.DownloadAll(jobs, HandleResult)
+    finally:
+      manifest.Save()
+      self.SaveMissingDiagrams()
+
+  def CountPendingDownloads(self):
+    """ Get the number of downloads from the EnabledSources that the
+        download manifest records as unfinished.  DownloadAll() makes them
+        even if it isn't given their 漢字."""
+    manifest = TDownloadManifest(self.DownloadManifestPath)
+    return sum(len(manifest.GetPending(source)) for source in self.EnabledSources)
 
   def Downloaded(self, 字, source):
     """ Determine whether the specified 漢字's stroke order diagram has already been downloaded from the specified source."""
-    return self.GetStrokeOrderDiagramPath(字, source) is not False
+    assert source in self.EnabledSources
+    loose, pack = self.__SourceIndex(source)
+    return 字 in loose or (pack is not None and 字 in pack)
 
   def GetLocalStrokeOrderDiagramPaths(self, 字):
-    """ Get a list of paths to locally-stored stroke order diagrams for the specified 漢字 character."""
+    """ Get a list of paths to locally-stored stroke order diagrams for the specified 漢字 character.
+        Packed diagrams (see PackStrokeOrderDiagrams()) don't have paths of
+        their own, so they aren't included."""
     assert len(字) == 1
     assert ord(字) in KANJI_RANGE
-    local_sources = set(self.GetStrokeOrderDiagramSources()) ^ set(self.EnabledSources)
-    字 = 字 + os.extsep
-    パス名 = []
-    for source in local_sources:
-      パス = self.GetStrokeOrderDiagramPath(字, source)
-      if パス is not False:
-        パス名.append(パス)
-    return パス名
+    return [
+      os.path.join(self.ImageDirectory, source, 字 + os.extsep + self.RemoteSources[source][2])
+       for source in self.GetStrokeOrderDiagramSources() if 字 in self.__AvailableDiagrams(source)
+     ]
 
   def GetStrokeOrderDiagramPath(self, 字, source):
     """ Get the path to a stroke order diagram from the specified source for the specified 漢字.
         This function returns the path to the stroke order diagram if it is found.
-        Otherwise, this function returns False."""
+        Otherwise, this function returns False.  This consults the in-memory
+        index of diagrams on disk (see INDEX_REVALIDATION_INTERVAL), so it
+        usually doesn't touch the filesystem.  Packed diagrams don't have
+        paths of their own, so this returns False for them; use
+        Downloaded() or GetStrokeOrderDiagramData() instead."""
     assert len(字) == 1
     assert ord(字) in KANJI_RANGE
     assert source in self.EnabledSources
-    パス = self.ConstructStrokeOrderDiagramPath(字, source)
-    return パス if os.path.isfile(パス) else False
+    if 字 not in self.__AvailableDiagrams(source):
+      return False
+    return self.ConstructStrokeOrderDiagramPath(字, source)
+
+  def GetStrokeOrderDiagramData(self, 字, source):
+    """ Get a bytes-like object containing the specified 漢字's stroke order
+        diagram from the specified source, or None if the diagram hasn't
+        been downloaded."""
+    パス = self.GetStrokeOrderDiagramPath(字, source)
+    if パス is not False:
+      with open(パス, "rb") as f:
+        return f.read()
+    pack = self.__SourceIndex(source)[1]
+    return pack.Get(字) if pack is not None else None
 
   def GetStrokeOrderDiagramSources(self):
     """ Get a list of sources from which 漢字 stroke order diagrams were downloaded.
         'image_directory' must be a path to a root image directory that was
         previously managed by the download-kanji-images.py tool."""
-    sources = os.listdir(self.ImageDirectory)
-    for source in sources:
-      if not os.path.isdir(os.path.join(self.ImageDirectory, source)):
-        sys.stderr.write("image directory is corrupted: " + self.ImageDirectory + ": " + source + " is not a directory\n")
-        sys.exit(3)
-      if source not in self.RemoteSources:
-        sys.stderr.write("image directory is corrupted: " + self.ImageDirectory + ": " + source + " is not a recognized remote source\n")
-        sys.exit(3)
-    return sources
+    def Build(sources):
+      for source in sources:
+        if not os.path.isdir(os.path.join(self.ImageDirectory, source)):
+          sys.stderr.write("image directory is corrupted: " + self.ImageDirectory + ": " + source + " is not a directory\n")
+          sys.exit(3)
+        if source not in self.RemoteSources:
+          sys.stderr.write("image directory is corrupted: " + self.ImageDirectory + ": " + source + " is not a recognized remote source\n")
+          sys.exit(3)
+      return tuple(sources)
+    return list(self.__IndexDirectory(self.ImageDirectory, Build))
 
   def GetStrokeOrderDiagramURL(self, 字, source):
     """ Get a URL to the stroke order diagram from the specified source for the specified 漢字.
@@ -686,26 +2131,218 @@ class TStrokeOrderDiagramFSInfo(object):
         (UTF-8 encoding) if there is a local stroke order diagram for 字.
         If no local stroke order diagram exists for the specified
         字 from the specified source, then the returned URL will refer to a
-        remote stroke order diagram from the specified source."""
+        remote stroke order diagram from the specified source, unless the
+        source is known not to have the diagram (see IsKnownMissing()), in
+        which case this function returns None.  If ReadThrough is True,
+        then the URL refers to the local stroke order diagram even if it
+        hasn't been downloaded yet; see ServeStrokeOrderDiagram()."""
     assert len(字) == 1
     assert ord(字) in KANJI_RANGE
     assert source in self.EnabledSources
-    パス = self.GetStrokeOrderDiagramPath(字, source)
-    return (
-      self.RemoteSources[source][1](字)
-       if パス is False
-       else StrokeOrderDiagramURLBase + urllib.parse.quote(source) + "/" + str(ord(字))
-     )
-
-  def ServeStrokeOrderDiagram(self, 字, source):
+    if self.Downloaded(字, source):
+      return StrokeOrderDiagramURLBase + urllib.parse.quote(source) + "/" + str(ord(字))
+    if self.IsKnownMissing(字, source):
+      return None
+    if self.ReadThrough:
+      return StrokeOrderDiagramURLBase + urllib.parse.quote(source) + "/" + str(ord(字))
+    return self.RemoteSources[source][1](字)
+
+  def FetchStrokeOrderDiagram(self, 字, source):
+    """ Download the specified 漢字's stroke order diagram from the specified
+        source in a background thread unless it is already being
+        downloaded.  This returns a concurrent.futures.Future whose result
+        is the path to the diagram, or False if the source doesn't have the
+        diagram.  Concurrent requests for the same diagram share one
+        download."""
+    assert len(字) == 1
+    assert ord(字) in KANJI_RANGE
+    assert source in self.EnabledSources
+    with self.__lock:
+      future = self.__fetches.get((字, source))
+      if future is None:
+        if self.__fetch_executor is None:
+          self.__fetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.READ_THROUGH_WORKERS)
+        future = self.__fetches[(字, source)] = self.__fetch_executor.submit(self.__Fetch, 字, source)
+    return future
+
+  def IsKnownMissing(self, 字, source):
+    """ Determine whether the specified source responded that it doesn't
+        have the specified 漢字's stroke order diagram (see
+        MISSING_STATUS_CODES) less than MissingTTL seconds ago."""
+    checked = self.__MissingEntries(source).get(字)
+    return checked is not None and checked + self.__missing_ttl > time.time()
+
+  def PackStrokeOrderDiagrams(self, source):
+    """ Move the stroke order diagrams from the specified source that are
+        stored in their own files into the source's TStrokeOrderDiagramPack,
+        creating the pack if necessary.  The pack is replaced atomically
+        before the diagrams' files are deleted.  This returns the number
+        of diagrams that were moved."""
+    assert source in self.RemoteSources
+    source_dir = os.path.join(self.ImageDirectory, source)
+    with self.__lock:
+      self.__indexes.pop(source_dir, None)
+      loose, pack = self.__SourceIndex(source)
+      loose = set(loose)
+    if not loose:
+      return 0
+    diagrams = {}
+    if pack is not None:
+      for 字 in pack:
+        diagrams[字] = pack.Get(字)
+    パス名 = [os.path.join(source_dir, 字 + os.extsep + self.RemoteSources[source][2]) for 字 in loose]
+    diagrams.update(zip(loose, パス名))
+    TStrokeOrderDiagramPack.Write(os.path.join(source_dir, self.PACK_FILE_NAME), diagrams)
+    for パス in パス名:
+      os.unlink(パス)
+    with self.__lock:
+      self.__indexes.pop(source_dir, None)
+    return len(パス名)
+
+  def SaveMissingDiagrams(self):
+    """ Write the records of diagrams that sources don't have to the
+        sources' image directories.  DownloadAll() invokes this."""
+    with self.__lock:
+      self.__SaveMissingDiagrams()
+
+  def __SaveMissingDiagrams(self):
+    now = time.time()
+    for source, entries in self.__missing.items():
+      source_dir = os.path.join(self.ImageDirectory, source)
+      if not os.path.isdir(source_dir):
+        continue
+      パス = os.path.join(source_dir, self.MISSING_FILE_NAME)
+      temp_path = パス + os.extsep + "tmp"
+      with open(temp_path, "w", encoding="UTF-8") as f:
+        json.dump(dict((字, checked) for 字, checked in entries.items() if checked + self.__missing_ttl > now), f, ensure_ascii=False, sort_keys=True)
+      os.replace(temp_path, パス)
+
+  def __AvailableDiagrams(self, source):
+    """ Get the set of 漢字 whose stroke order diagrams from the specified
+        source are stored in their own files."""
+    return self.__SourceIndex(source)[0]
+
+  def __RecordDownloaded(self, 字, source):
+    """ Record that the specified 漢字's stroke order diagram from the
+        specified source was just downloaded to its own file."""
+    with self.__lock:
+      self.__AvailableDiagrams(source).add(字)
+      self.__MissingEntries(source).pop(字, None)
+      self.__generation += 1
+
+  def __RecordMissing(self, 字, source):
+    """ Record that the specified source just responded that it doesn't
+        have the specified 漢字's stroke order diagram."""
+    with self.__lock:
+      self.__MissingEntries(source)[字] = time.time()
+      self.__generation += 1
+
+  def __SourceIndex(self, source):
+    """ Get a tuple containing the set of 漢字 whose stroke order diagrams
+        from the specified source are stored in their own files and the
+        source's TStrokeOrderDiagramPack, or None if there isn't one."""
+    source_dir = os.path.join(self.ImageDirectory, source)
+    suffix = os.extsep + self.RemoteSources[source][2]
+    def Build(names):
+      loose = set(
+        name[0] for name in names
+         if len(name) == 1 + len(suffix) and name.endswith(suffix) and ord(name[0]) in KANJI_RANGE
+       )
+      pack = None
+      if self.PACK_FILE_NAME in names:
+        try:
+          pack = TStrokeOrderDiagramPack(os.path.join(source_dir, self.PACK_FILE_NAME))
+        except (OSError, ValueError) as e:
+          sys.stderr.write("ignoring the stroke order diagram pack for " + source + ": " + str(e) + "\n")
+      return (loose, pack)
+    return self.__IndexDirectory(source_dir, Build)
+
+  def __IndexDirectory(self, パス, build):
+    """ Get the index that 'build' made from the names of the entries in the
+        specified directory (an empty list if the directory doesn't exist).
+        Indexes are rebuilt only when their directories' modification times
+        change, and the modification times are checked at most once every
+        INDEX_REVALIDATION_INTERVAL seconds."""
+    now = time.monotonic()
+    entry = self.__indexes.get(パス)
+    if entry is not None and now < entry[0]:
+      return entry[2]
+    with self.__lock:
+      entry = self.__indexes.get(パス)
+      if entry is not None and now < entry[0]:
+        return entry[2]
+      try:
+        mtime = os.stat(パス).st_mtime_ns
+      except OSError:
+        mtime = None
+      if entry is not None and entry[1] == mtime:
+        index = entry[2]
+      else:
+        index = build(os.listdir(パス) if mtime is not None else [])
+        self.__generation += 1
+      self.__indexes[パス] = (now + self.INDEX_REVALIDATION_INTERVAL, mtime, index)
+      return index
+
+  def __Fetch(self, 字, source):
+    """ Download the specified 漢字's stroke order diagram for
+        FetchStrokeOrderDiagram()."""
+    パス = self.ConstructStrokeOrderDiagramPath(字, source)
+    try:
+      if not os.path.exists(パス):
+        os.makedirs(os.path.dirname(パス), exist_ok=True)
+        self.RemoteSources[source][0](字, パス, self.タイムアウト)
+      self.__RecordDownloaded(字, source)
+      return パス
+    except urllib.error.HTTPError as e:
+      if e.code not in self.MISSING_STATUS_CODES:
+        raise
+      with self.__lock:
+        self.__RecordMissing(字, source)
+        self.__SaveMissingDiagrams()
+      return False
+    finally:
+      with self.__lock:
+        del self.__fetches[(字, source)]
+
+  def __MissingEntries(self, source):
+    """ Get the dictionary mapping 漢字 to the times at which the specified
+        source reported that it doesn't have their diagrams, loading it from
+        the source's image directory the first time."""
+    entries = self.__missing.get(source)
+    if entries is None:
+      with self.__lock:
+        entries = self.__missing.get(source)
+        if entries is None:
+          entries = {}
+          if self.__missing_ttl > 0:
+            try:
+              with open(os.path.join(self.ImageDirectory, source, self.MISSING_FILE_NAME), "r", encoding="UTF-8") as f:
+                entries = dict((字, float(checked)) for 字, checked in json.load(f).items())
+            except (OSError, ValueError, AttributeError, TypeError):
+              pass
+          self.__missing[source] = entries
+    return entries
+
+  def ServeStrokeOrderDiagram(self, 字, source, wait=False):
     """ Serve the locally-stored stroke order diagram for the specified 漢字.
         字 must be the Unicode code point of a 漢字 expressed as an integer.
         This function must be invoked while handling a GET request.
         If all of the parameters are valid, then this will serve the stroke
         order diagram for the specified 漢字: The return value will be the
-        value returned by Bottle's static_file() function.  If 'source'
-        is None but 字 is valid, then this function will return the empty
-        string.  Otherwise, an HTTP error will be generated."""
+        value returned by Bottle's static_file() function, or by
+        TStrokeOrderDiagramPack.Serve() if the diagram is packed.  If
+        'source' is None but 字 is valid, then this function will return
+        the empty string.  Otherwise, an HTTP error will be generated.
+
+        If ReadThrough is True and the diagram isn't on disk, then this
+        starts downloading it (see FetchStrokeOrderDiagram()) and serves it
+        from disk from then on.  If 'wait' is True, then this waits up to
+        READ_THROUGH_WAIT seconds for the download; servers that handle one
+        request at a time must not wait, because nothing else is served in
+        the meantime.  If the download fails or hasn't finished, then the
+        browser is redirected to the source; the download continues in the
+        background.  This responds with 404 if the source doesn't have the
+        diagram."""
     try:
       字 = chr(int(字))
     except Exception as e:
@@ -717,8 +2354,28 @@ class TStrokeOrderDiagramFSInfo(object):
     data = ""
     if source is not None and source in self.EnabledSources:
       local_path = self.GetStrokeOrderDiagramPath(字, source)
+      pack = self.__SourceIndex(source)[1]
+      if local_path is False and pack is not None and 字 in pack:
+        content_type = mimetypes.guess_type("diagram" + os.extsep + self.RemoteSources[source][2])[0]
+        data = pack.Serve(字, content_type)
+      elif local_path is False and self.ReadThrough:
+        if self.IsKnownMissing(字, source):
+          abort(404, "The source doesn't have this diagram.")
+        try:
+          local_path = self.FetchStrokeOrderDiagram(字, source).result(timeout=self.READ_THROUGH_WAIT if wait else 0)
+        except Exception:
+          local_path = None
+        if local_path is None:
+          redirect(self.RemoteSources[source][1](字))
+        if local_path is False:
+          abort(404, "The source doesn't have this diagram.")
       if local_path is not False:
         data = static_file(os.path.basename(local_path), os.path.dirname(local_path))
+      if data != "" and data.status in (200, 304):
+        # Diagrams rarely change, so let browsers reuse them for a while.
+        # static_file() and TStrokeOrderDiagramPack.Serve() handle
+        # revalidation via Last-Modified.
+        data.headers['Cache-Control'] = "public, max-age=604800"
     return data
 
   @property
@@ -741,6 +2398,39 @@ class TStrokeOrderDiagramFSInfo(object):
   def ImageDirectory(self):
     return self.__image_directory
 
+  @property
+  def MissingTTL(self):
+    """the number of seconds for which IsKnownMissing() trusts a source's
+    report that it doesn't have a diagram; zero disables the records"""
+    return self.__missing_ttl
+
+  @property
+  def DownloadManifestPath(self):
+    """the path to the TDownloadManifest file for DownloadAll()"""
+    return self.__download_manifest_path
+
+  @property
+  def Generation(self):
+    """a number that changes whenever this object learns that stroke order
+    diagrams were downloaded, found missing, or packed, so that caches of
+    markup that depends on them (see TSourcedフラッシュカード.ContentCache)
+    can tell when it is stale; reading it revalidates the enabled sources'
+    directory indexes, so it also notices other processes' changes"""
+    for source in self.EnabledSources:
+      self.__SourceIndex(source)
+    return self.__generation
+
+  @property
+  def ReadThrough(self):
+    """whether servers download stroke order diagrams that aren't on disk
+    when browsers request them (see ServeStrokeOrderDiagram())"""
+    return self.__read_through
+
+  @property
+  def ScanCachePath(self):
+    """the path to the T漢字ScanCache file for the files to scan"""
+    return self.__scan_cache_path
+
 
 
 ################################################################################
@@ -1012,6 +2702,19 @@ class TCardDeck(object):
     self.__current_card_marked = True
     self.Statistics.CardPassed(self.__current_card, write_to_log)
 
+  @property
+  def Cards(self):
+    """a tuple of the cards that have not been drawn, including failed cards
+       that will be drawn again"""
+    return tuple(self.__cards) + tuple(self.__failed_cards)
+
+  def PeekCard(self):
+    """ Get the card that the next GetCard() invocation will return without
+        drawing it.  This returns None if the next card is not known yet,
+        which happens when the deck must recycle failed cards (they are
+        shuffled when they are drawn) or the deck is empty."""
+    return self.__cards[-1] if self.__cards else None
+
   @property
   def CurrentCard(self):
     """the current card (that is, the card that was last drawn from the deck)"""
@@ -1137,6 +2840,10 @@ class TCardDeckFactory(object):
       This class relies heavily on CreateFlashcardStubMap() and
       ApplyStatsToStubMap()."""
 
+  """the number of seconds by which the timestamps of records passed to
+  ValidateStatsRecords() may be ahead of the server's clock"""
+  MAX_CLOCK_SKEW = 24 * 60 * 60
+
   def __init__(self, flashcard_parser_cb, log_parser_cb, buckets):
     """ Construct a new factory.  This constructor expects three arguments:
 
@@ -1238,6 +2945,58 @@ class TCardDeckFactory(object):
     assert self.__num_new_cards <= self.__num_due_cards # New cards are always due.
     self.__card_count = len(self.__hashes_to_stubs)
 
+  def ApplyStatsRecords(self, records):
+    """ Apply performance records to the flashcard stubs without parsing
+        the stats log again.  This is meant for records that were just
+        appended to the stats log.  'records' must be a sequence of records
+        returned by ValidateStatsRecords()."""
+    ApplyStatsToStubMap(
+      lambda log_record_handler: [log_record_handler(record) for record in records],
+      self.__hashes_to_stubs,
+      self.__buckets,
+      self.__now
+     )
+    self.__num_new_cards = sum(1 for stub in self.__hashes_to_stubs.values() if stub.IsNewCard)
+    self.__num_due_cards = sum(bucket.DueCardCount for bucket in self.__buckets)
+
+  def ValidateStatsRecords(self, records):
+    """ Check performance records submitted by clients and return them in the
+        stats log's format.  Each record must be a sequence containing a
+        timestamp, the hash of one of the factory's flashcards, and the
+        number of times the user retried the flashcard (see
+        TCardDeckStatistics.CardPassed()).  This returns a list of
+        (float, str, int) tuples.  It raises TInvalidFlashcardStatsRecord
+        for the first invalid record; the exception's Line is the record's
+        zero-based index.  Timestamps must be finite and no more than
+        MAX_CLOCK_SKEW seconds in the future."""
+    validated = []
+    latest = time.time() + self.MAX_CLOCK_SKEW
+    for index, record in enumerate(records):
+      if len(record) != 3:
+        raise TInvalidFlashcardStatsRecord(index, "record does not have three fields")
+      try:
+        if isinstance(record[0], bool):
+          raise TypeError("timestamp is a boolean")
+        date_touched = float(record[0])
+      except (TypeError, ValueError):
+        raise TInvalidFlashcardStatsRecord(index, "timestamp field is not a float")
+      if not math.isfinite(date_touched):
+        raise TInvalidFlashcardStatsRecord(index, "timestamp field is not finite")
+      if date_touched > latest:
+        raise TInvalidFlashcardStatsRecord(index, "timestamp field is in the future")
+      if not isinstance(record[1], str) or record[1] not in self.__hashes_to_stubs:
+        raise TInvalidFlashcardStatsRecord(index, "unknown flashcard hash: " + str(record[1]))
+      try:
+        if isinstance(record[2], bool) or (isinstance(record[2], float) and not record[2].is_integer()):
+          raise TypeError("num_retries is not integral")
+        num_retries = int(record[2])
+      except (TypeError, ValueError, OverflowError):
+        raise TInvalidFlashcardStatsRecord(index, "num_retries field is not an integer")
+      if num_retries < 0:
+        raise TInvalidFlashcardStatsRecord(index, "num_retries field is negative")
+      validated.append((date_touched, record[1], num_retries))
+    return validated
+
   def RenderConfigPage(self,
     title,
     session_token,
@@ -1245,7 +3004,8 @@ class TCardDeckFactory(object):
     default_time=('', '', ''),
     default_max_deck_size='',
     default_max_new_cards='',
-    image_settings=None
+    image_settings=None,
+    template_name='deckconfig.html'
    ):
     """ Generate an HTML page that displays a deck configuration screen.
         This method has the following parameters:
@@ -1268,7 +3028,10 @@ class TCardDeckFactory(object):
           image_settings :: TStrokeOrderDiagramFSInfo
             the stroke order diagram image manager for 漢字 stroke order
             diagram sources or None if the user should not be allowed to
-            select a remote source for stroke order diagrams"""
+            select a remote source for stroke order diagrams
+          template_name :: str
+            the name of the template that renders the page; it must accept
+            deckconfig.html's parameters (see quizapp.html)"""
     fieldsets = []
     template_contents = {
       'title': title,
@@ -1297,7 +3060,7 @@ class TCardDeckFactory(object):
        })
 
     template_contents['fieldsets'] = fieldsets
-    return JinjaEnvironment.get_template('deckconfig.html').render(template_contents)
+    return JinjaEnvironment.get_template(template_name).render(template_contents)
 
   @property
   def Buckets(self):
@@ -1329,6 +3092,11 @@ class TSourcedフラッシュカード(TFlashcard):
   """ Instances of this class are Leitner flashcards with three parts: a front,
       a back, and the card's source."""
 
+  """ a TLRUCache mapping cards' hashes, RenderContent() arguments, and
+      the stroke order diagram image manager's Generation to the content
+      that RenderContent() generated for them"""
+  ContentCache = TLRUCache(1024)
+
   class TFormatError(Exception):
     """ ParseSourceFile() raises this exception whenever a flashcard row is formatted incorrectly."""
     pass
@@ -1353,16 +3121,12 @@ class TSourcedフラッシュカード(TFlashcard):
     title,
     post_handler_url,
     session_token,
-    前cb=lambda 前: 前,
-    後ろcb=lambda 後ろ: 後ろ,
-    source_cb=lambda source: source,
-    enable_ruby=True,
-    enable_kanji_highlighting=True,
-    enable_furigana_display=True,
-    image_settings=None,
-    image_source=None,
     timeout_secs=0,
-    deck_stats=None
+    deck_stats=None,
+    content=None,
+    diagram_bundle_url=None,
+    prefetch_urls=(),
+    **content_options
    ):
     """ Generate an HTML page that displays this flashcard.  This method has
         the following parameters:
@@ -1374,6 +3138,70 @@ class TSourcedフラッシュカード(TFlashcard):
             results sent from the client
           session_token :: int | str
             the current session's token
+          timeout_secs :: int
+            the number of seconds remaining in the quiz; zero or negative if
+            there is no timeout
+          deck_stats :: TCardDeckStatistics
+            the current card deck's statistics or None if statistics shouldn't
+            be displayed
+          content :: dict
+            the card's content as returned by RenderContent() or None if
+            this method should invoke RenderContent() itself
+          diagram_bundle_url :: str
+            the URL of the deck's stroke order diagram bundle (see
+            TStrokeOrderDiagramFSInfo.BuildDiagramBundle()) or None if
+            there is no bundle
+          prefetch_urls :: [str]
+            URLs that the browser should fetch in the background because the
+            next card will need them, such as its stroke order diagrams
+
+        If 'content' is None, then the remaining keyword arguments are passed
+        to RenderContent(); otherwise, they are ignored.  Rendering the
+        content ahead of time keeps the expensive parts of rendering off of
+        the path between the user's answer and the next card."""
+    template_contents = {
+      'title': title,
+      'handler_url': post_handler_url,
+      'session_token': session_token,
+      'rts': timeout_secs,
+      'show_stats': deck_stats is not None,
+      'diagram_bundle_url': diagram_bundle_url,
+      'prefetch_urls': prefetch_urls
+     }
+
+    if deck_stats is not None:
+      assert isinstance(deck_stats, TCardDeckStatistics)
+      template_contents.update({
+        'num_cards_passed': deck_stats.NumPassedOnFirstTry,
+        'num_cards_failed': deck_stats.NumFailedOnFirstTry,
+        'num_cards_seen': deck_stats.NumAttempts,
+        'num_cards_left': deck_stats.NumCardsLeft,
+        'num_cards_total': deck_stats.NumCards
+       })
+
+    template_contents.update(content if content is not None else self.RenderContent(**content_options))
+    return JinjaEnvironment.get_template('sourcedflashcard.html').render(template_contents)
+
+  def RenderContent(self,
+    前cb=lambda 前: 前,
+    後ろcb=lambda 後ろ: 後ろ,
+    source_cb=lambda source: source,
+    enable_ruby=True,
+    enable_kanji_highlighting=True,
+    enable_furigana_display=True,
+    image_settings=None,
+    image_source=None,
+    bundled_kanji=frozenset(),
+    compact_ruby=False
+   ):
+    """ Generate the HTML fragments that make up this flashcard's page,
+        excluding the parts that change from request to request (the title,
+        session token, timer, and statistics).  This returns a dictionary
+        of template parameters for sourcedflashcard.html that Render()
+        accepts as its 'content' parameter.  The results are cached in
+        ContentCache, so callers must not modify them.  This method has the
+        following parameters:
+
           前cb :: str => str
             a function that transforms the 前 content into the text that
             will be rendered as the "front" of the flashcard
@@ -1404,12 +3232,28 @@ class TSourcedフラッシュカード(TFlashcard):
             if 漢字 stroke order diagrams shouldn't be displayed (non-None
             values automatically set enable_ruby if image_settings is
             also non-None)
-          timeout_secs :: int
-            the number of seconds remaining in the quiz; zero or negative if
-            there is no timeout
-          deck_stats :: TCardDeckStatistics
-            the current card deck's statistics or None if statistics shouldn't
-            be displayed"""
+          bundled_kanji :: frozenset<str>
+            the 漢字 whose stroke order diagrams are in the bundle that the
+            page will load (see Render() and
+            TStrokeOrderDiagramFSInfo.BuildDiagramBundle()); the page takes
+            those diagrams from the bundle instead of requesting them one
+            by one once the bundle has loaded
+          compact_ruby :: boolean
+            True if ruby text should be generated by GenerateCompactHTML5Ruby(),
+            which produces much smaller pages, False if it should be
+            generated by GenerateHTML5Ruby()"""
+    # Only this card's bundled 漢字 affect its content, so cards that don't
+    # share 漢字 with a deck whose bundle changed keep their cached content.
+    if bundled_kanji:
+      bundled_kanji = bundled_kanji & KANJI_RANGE.Extract(self.前 + self.後ろ + self.Source)
+    cache_key = (self.Hash, 前cb, 後ろcb, source_cb, enable_ruby,
+     enable_kanji_highlighting, enable_furigana_display, image_settings,
+     image_settings.Generation if image_settings is not None else None,
+     image_source, bundled_kanji, compact_ruby)
+    template_contents = self.ContentCache.Get(cache_key)
+    if template_contents is not None:
+      return template_contents
+
     前 = 前cb(self.前)
     後ろ = 後ろcb(self.後ろ)
     source = source_cb(self.Source)
@@ -1418,38 +3262,35 @@ class TSourcedフラッシュカード(TFlashcard):
     selectors = []
     css = []
     js = []
-
-    template_contents = {
-      'title': title,
-      'handler_url': post_handler_url,
-      'session_token': session_token,
-      'rts': timeout_secs,
-      'show_stats': deck_stats is not None
-     }
-
-    if deck_stats is not None:
-      assert isinstance(deck_stats, TCardDeckStatistics)
-      template_contents.update({
-        'num_cards_passed': deck_stats.NumPassedOnFirstTry,
-        'num_cards_failed': deck_stats.NumFailedOnFirstTry,
-        'num_cards_seen': deck_stats.NumAttempts,
-        'num_cards_left': deck_stats.NumCardsLeft,
-        'num_cards_total': deck_stats.NumCards
-       })
+    template_contents = {}
 
     if kanji_sods_enabled:
       enable_ruby = True
-      漢字 = set(字 for 字 in 前 + 後ろ + source if ord(字) in KANJI_RANGE)
+      漢字 = KANJI_RANGE.Extract(前 + 後ろ + source)
+      # The images get their sources when the user enables the 漢字 view
+      # (see kanjisod.js), so the page doesn't download them up front.
+      # Bundled diagrams keep their URLs, which kanjisod.js uses until the
+      # bundle arrives.  漢字 whose diagrams the source is known not to have
+      # get no images; kanjisod.js ignores them.
+      def DiagramSource(字):
+        url = image_settings.GetStrokeOrderDiagramURL(字, image_source)
+        attributes = []
+        if 字 in bundled_kanji:
+          attributes.append('data-kanji="' + 字 + '"')
+        if url is not None:
+          attributes.append('data-src="' + url + '"')
+        return " ".join(attributes) or None
+      diagram_sources = ((字, DiagramSource(字)) for 字 in 漢字)
       bottom_content = "".join(
-        '<img name="漢字diagram' + 字 + '" style="display: none" alt="漢字 Diagram" src="' +
-         image_settings.GetStrokeOrderDiagramURL(字, image_source) + '" />' for 字 in 漢字
+        '<img name="漢字diagram' + 字 + '" style="display: none" alt="漢字 Diagram" ' +
+         diagram_source + ' />' for 字, diagram_source in diagram_sources if diagram_source is not None
        )
-      js.append("/static/kanjisod.js")
+      js.append(StaticURL("kanjisod.js"))
       selectors.append('<input type="button" name="show_kanji" value="漢字の書き方を見せて" onclick="enableKanjiView()"/>')
 
     if enable_furigana_display:
       enable_ruby = True
-      js.append("/static/furigana.js")
+      js.append(StaticURL("furigana.js"))
       selectors.append("""<input type="button" name="振り仮名を見せて" value="振り仮名を見せて" onclick="toggle_visibility('furigana')"/>""")
 
     if enable_kanji_highlighting:
@@ -1461,17 +3302,22 @@ class TSourcedフラッシュカード(TFlashcard):
         return """window.open('http://jisho.org/kanji/details/""" + quoted + """', '""" + quoted + """')"""
       def GenerateRuby(言葉と振り仮名):
         buf = io.StringIO()
-        GenerateHTML5Ruby(言葉と振り仮名, buf,
-         "kanji" if enable_kanji_highlighting else "nhlkanji",
-         GenerateDictionaryJS,
-         (lambda 字: "showKanjiImage('" + 字 + "')") if kanji_sods_enabled else None,
-         (lambda 字: "hideKanjiImage('" + 字 + "')") if kanji_sods_enabled else None,
-         "furigana", False)
+        if compact_ruby:
+          GenerateCompactHTML5Ruby(言葉と振り仮名, buf,
+           "kanji" if enable_kanji_highlighting else "nhlkanji")
+        else:
+          GenerateHTML5Ruby(言葉と振り仮名, buf,
+           "kanji" if enable_kanji_highlighting else "nhlkanji",
+           GenerateDictionaryJS,
+           (lambda 字: "showKanjiImage('" + 字 + "')") if kanji_sods_enabled else None,
+           (lambda 字: "hideKanjiImage('" + 字 + "')") if kanji_sods_enabled else None,
+           "furigana", False)
         return buf.getvalue()
-      producer = T言葉と振り仮名Producer()
-      前 = GenerateRuby(producer.ProcessAndReset(前))
-      後ろ = GenerateRuby(producer.ProcessAndReset(後ろ))
-      source = GenerateRuby(producer.ProcessAndReset(source))
+      if compact_ruby:
+        js.append(StaticURL("kanji.js"))
+      前 = GenerateRuby(Parse言葉と振り仮名(前))
+      後ろ = GenerateRuby(Parse言葉と振り仮名(後ろ))
+      source = GenerateRuby(Parse言葉と振り仮名(source))
 
     template_contents['front_content'] = 前
     template_contents['back_content'] = 後ろ
@@ -1482,7 +3328,52 @@ class TSourcedフラッシュカード(TFlashcard):
     if selectors:
       selectors = ["<form>"] + selectors + ["</form>"]
     template_contents['selectors_content'] = ''.join(selectors)
-    return JinjaEnvironment.get_template('sourcedflashcard.html').render(template_contents)
+    self.ContentCache.Put(cache_key, template_contents)
+    return template_contents
+
+  def RenderClientData(self, image_settings=None, image_source=None):
+    """ Generate a JSON-compatible dictionary describing this flashcard for
+        clients that render flashcards themselves, such as quizapp.js.
+        The dictionary has the following keys:
+
+          hash :: str
+            the card's hash (see TFlashcard.Hash)
+          front :: [[str, str]]
+            the 前 parsed into [言葉, 振り仮名] pairs (振り仮名 is empty for
+            text that has none)
+          back :: [[str, str]]
+            the 後ろ parsed into [言葉, 振り仮名] pairs
+          source :: [[str, str]]
+            the Source parsed into [言葉, 振り仮名] pairs
+          diagrams :: dict<str,str>
+            a map of each 漢字 in the card to the URL of its stroke order
+            diagram (empty if stroke order diagrams are disabled)
+
+        'image_settings' and 'image_source' have the same meanings as they
+        do for RenderContent()."""
+    def Segments(text):
+      return [[ペア.言葉, ペア.振り仮名] for ペア in Parse言葉と振り仮名(text)]
+    return {
+      'hash': self.Hash,
+      'front': Segments(self.前),
+      'back': Segments(self.後ろ),
+      'source': Segments(self.Source),
+      'diagrams': self.GetStrokeOrderDiagramURLs(image_settings, image_source)
+     }
+
+  def GetStrokeOrderDiagramURLs(self, image_settings, image_source):
+    """ Get a dictionary mapping each 漢字 in this flashcard to the URL of
+        its stroke order diagram from the specified source.  The dictionary
+        is empty if 'image_settings' is None or 'image_source' is not one
+        of its EnabledSources.  漢字 whose diagrams the source is known not
+        to have are omitted."""
+    diagrams = {}
+    if image_settings is not None and image_source in image_settings.EnabledSources:
+      for 字 in KANJI_RANGE.Extract(self.前 + self.後ろ + self.Source):
+        url = image_settings.GetStrokeOrderDiagramURL(字, image_source)
+        if url is not None:
+          diagrams[字] = url
+    return diagrams
 
   def __init__(self, 前, 後ろ, source):
     """ Construct a new flashcard."""
@@ -1561,9 +3452,167 @@ def ツールの設定ファイルを分析する(パス名, ハンドラ):
     sys.exit(error_code)
   ハンドラ(parser, パス名, PrintErrorAndExit)
 
+_ENTITY_TAG = re.compile(r'(?:W/)?("[^"]*")|(\*)')
+
+def MatchesEntityTag(if_none_match, etag):
+  """ Determine whether the specified If-None-Match header value, a
+      comma-separated list of entity tags or "*", matches the specified
+      strong entity tag.  If-None-Match uses weak comparison, so W/ prefixes
+      are ignored."""
+  return any(star or tag == etag for tag, star in _ENTITY_TAG.findall(if_none_match))
+
+def AcceptsContentCoding(accept_encoding, coding):
+  """ Determine whether the specified Accept-Encoding header value accepts
+      the specified content coding, such as "gzip".  Codings with a q-value
+      of zero are refused, and "*" stands for codings that aren't listed."""
+  qualities = {}
+  for entry in accept_encoding.split(","):
+    name, _, parameters = entry.partition(";")
+    name = name.strip().lower()
+    if not name:
+      continue
+    quality = 1.0
+    for parameter in parameters.split(";"):
+      key, _, value = parameter.partition("=")
+      if key.strip().lower() == "q":
+        try:
+          quality = float(value)
+        except ValueError:
+          quality = 0.0
+    qualities[name] = quality
+  return qualities.get(coding, qualities.get("*", 0.0)) > 0
+
+class TStaticAsset(object):
+  """ Instances of this class hold a static file's contents in memory along
+      with a gzip-compressed copy and a content hash.  They serve the file
+      with an ETag derived from the hash, so browsers can revalidate cheaply
+      or, when the request's URL contains the file's fingerprint (see
+      StaticURL()), cache the file indefinitely.  The compressed copy's ETag
+      has a "-gz" suffix because its bytes differ."""
+
+  def __init__(self, data, file_name):
+    """ Compress and hash the specified bytes.  'file_name' determines the
+        asset's content type."""
+    self.__data = data
+    self.__gzipped = gzip.compress(self.__data, 9)
+    self.__fingerprint = hashlib.sha1(self.__data).hexdigest()
+    content_type = mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+    if content_type.startswith("text/") or content_type.endswith("javascript"):
+      content_type += "; charset=UTF-8"
+    self.__content_type = content_type
+    super().__init__()
+
+  def Serve(self, fingerprinted):
+    """ Serve the file.  This must be invoked while handling a GET request.
+        If 'fingerprinted' is True, then the request's URL contains this
+        asset's fingerprint and the response may be cached forever.
+        This returns a Bottle HTTPResponse."""
+    header = {
+      'Content-Type': self.__content_type,
+      'ETag': '"' + self.Fingerprint + '"',
+      'Cache-Control': "public, max-age=31536000, immutable" if fingerprinted else "no-cache",
+      'Vary': "Accept-Encoding"
+     }
+    body = self.__data
+    if len(self.__gzipped) < len(body) and AcceptsContentCoding(request.environ.get('HTTP_ACCEPT_ENCODING', ''), "gzip"):
+      body = self.__gzipped
+      header['ETag'] = '"' + self.Fingerprint + '-gz"'
+      header['Content-Encoding'] = "gzip"
+    if MatchesEntityTag(request.environ.get('HTTP_IF_NONE_MATCH', ''), header['ETag']):
+      header.pop('Content-Encoding', None)
+      return HTTPResponse(status=304, header=header)
+    header['Content-Length'] = str(len(body))
+    return HTTPResponse(b'' if request.method == 'HEAD' else body, header=header)
+
+  @property
+  def Data(self):
+    """the file's uncompressed contents as bytes"""
+    return self.__data
+
+  @property
+  def Fingerprint(self):
+    """the SHA-1 hash of the file's contents as a hex string"""
+    return self.__fingerprint
+
+""" This maps the names of files in TemplateDirectory and of bundles to
+    TStaticAssets.  LoadStaticAssets() fills it."""
+StaticAssets = {}
+
+""" This maps bundle names to the files in TemplateDirectory that the
+    bundles concatenate, in order.  Each page type gets one CSS bundle and
+    one JS bundle that contain every file the page might use; see
+    sourcedflashcard.html and quizapp.html."""
+StaticBundles = {
+  "sourcedflashcard.bundle.css": ["sourceflashcard.css"],
+  "sourcedflashcard.bundle.js": ["timeout.js", "kanjisod.js", "furigana.js", "kanji.js"],
+  "quizapp.bundle.css": ["sourceflashcard.css"],
+  "quizapp.bundle.js": ["quizapp.js"]
+ }
+
+def MinifyStaticText(text):
+  """ Make CSS or JS text smaller by removing block comments, indentation,
+      and blank lines.  Line breaks are kept so that JS code that relies on
+      automatic semicolon insertion still works."""
+  text = re.sub(r"/\*.*?\*/", "", text, flags=re.DOTALL)
+  return "\n".join(line.strip() for line in text.splitlines() if line.strip()) + "\n"
+
+def LoadStaticAssets(extensions=("css", "js")):
+  """ Load the files in TemplateDirectory that have the specified extensions
+      into StaticAssets and build the StaticBundles.  Servers should invoke
+      this once at startup; until they do, static files are served straight
+      from the filesystem without compression or caching headers and pages
+      load their files individually."""
+  for name in os.listdir(TemplateDirectory):
+    if name.rpartition(os.extsep)[2] in extensions:
+      with open(os.path.join(TemplateDirectory, name), "rb") as f:
+        StaticAssets[name] = TStaticAsset(f.read(), name)
+  for bundle_name, file_names in StaticBundles.items():
+    bundle = "".join(
+      MinifyStaticText(str(StaticAssets[file_name].Data, encoding="UTF-8"))
+       for file_name in file_names
+     )
+    StaticAssets[bundle_name] = TStaticAsset(bytes(bundle, encoding="UTF-8"), bundle_name)
+
+def StaticBundleURL(bundle_name):
+  """ Get the fingerprinted URL of the specified bundle or None if the
+      bundles have not been built."""
+  return StaticURL(bundle_name) if bundle_name in StaticAssets else None
+
+def StaticURL(filename):
+  """ Get the URL of the specified file in TemplateDirectory.  If the file
+      is one of the StaticAssets, then the URL contains the file's
+      fingerprint, so browsers may cache the file forever."""
+  asset = StaticAssets.get(filename, None)
+  return "/static/" + filename + ("" if asset is None else "?v=" + asset.Fingerprint)
+
+JinjaEnvironment.globals['static_url'] = StaticURL
+JinjaEnvironment.globals['static_bundle_url'] = StaticBundleURL
+
 @get("/static/<filename>")
 def ServeStaticContent(filename):
-  return static_file(filename, TemplateDirectory)
+  asset = StaticAssets.get(filename, None)
+  if asset is None:
+    return static_file(filename, TemplateDirectory)
+  return asset.Serve(request.query.v == asset.Fingerprint)
+
+class TThreadedWSGIRefServer(ServerAdapter):
+  """ This Bottle server adapter is like Bottle's WSGIRefServer, except that
+      it services each request in its own thread.  A slow request, such as
+      a request for a large stroke order diagram, therefore does not stall
+      other requests.  Applications that use this adapter must guard their
+      shared state with locks.  Pass this class as the 'server' argument of
+      Bottle's run() function."""
+
+  def run(self, handler):
+    from wsgiref.simple_server import make_server, WSGIRequestHandler, WSGIServer
+    class TThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+      daemon_threads = True
+    if self.quiet:
+      class QuietHandler(WSGIRequestHandler):
+        def log_request(*args, **kw): pass
+      self.options['handler_class'] = QuietHandler
+    srv = make_server(self.host, self.port, handler, server_class=TThreadingWSGIServer, **self.options)
+    srv.serve_forever()
 
 
 